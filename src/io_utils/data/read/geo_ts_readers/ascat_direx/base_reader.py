@@ -13,6 +13,16 @@ class DirexTs(GriddedNcOrthoMultiTs, OrthoMultiTsCellReaderMixin):
         grid = load_grid(grid_path)
         super().__init__(ts_path, grid, **kwargs)
 
+    # read_cells() passes the cell data to read(), see _read_cached_ts()
+    _reads_cell_data = True
+
+    def read(self, *args, **kwargs):
+        # Points in cached or preloaded cells are read from memory
+        df = self._read_cached_ts(*args, **kwargs)
+        if df is None:
+            df = super().read(*args, **kwargs)
+        return df
+
 
 class GeoDirexTs(DirexTs):
 
@@ -24,7 +24,13 @@ class ERATs(GriddedNcOrthoMultiTs, OrthoMultiTsCellReaderMixin):
         grid = nc.load_grid(grid_path)
         super(ERATs, self).__init__(ts_path, grid, **kwargs)
 
+    # read_cells() passes the cell data to read(), see _read_cached_ts()
+    _reads_cell_data = True
+
     def read(self, *args, **kwargs):
-        df = super(ERATs, self).read(*args, **kwargs)
+        # Points in cached or preloaded cells are read from memory
+        df = self._read_cached_ts(*args, **kwargs)
+        if df is None:
+            df = super(ERATs, self).read(*args, **kwargs)
 
         return df
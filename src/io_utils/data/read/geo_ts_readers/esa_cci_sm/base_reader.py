@@ -32,7 +32,10 @@ import xarray as xr
 from pygeogrids import CellGrid
 
 from io_utils.data.read.geo_ts_readers.mixins import OrthoMultiTsCellReaderMixin, ContiguousRaggedTsCellReaderMixin
+from io_utils.parallel import SharedArray
 from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor
+import copy
 
 from cadati.jd_date import julian2date
 import pytz
@@ -257,11 +260,17 @@ class SmecvTs(GriddedNcOrthoMultiTs, OrthoMultiTsCellReaderMixin):
             return df[(df.index >= self.clip_dates[0]) &
                       (df.index <= self.clip_dates[1])]
 
+    # read_cells() passes the cell data to read(), see _read_cached_ts()
+    _reads_cell_data = True
+
     def read(self, *args, **kwargs) -> pd.DataFrame:
         """
         Read time series based on lonlat or gpi
         """
-        df = super(SmecvTs, self).read(*args, **kwargs)
+        # Points in cached or preloaded cells are read from memory
+        df = self._read_cached_ts(*args, **kwargs)
+        if df is None:
+            df = super(SmecvTs, self).read(*args, **kwargs)
 
         if self.exact_index:
             try:
@@ -292,7 +301,9 @@ class SmecvTs(GriddedNcOrthoMultiTs, OrthoMultiTsCellReaderMixin):
         param_fill_val:dict=None,
         param_scalf:dict=None,
         param_dtype:dict=None,
-        as_xr=False):
+        as_xr=False,
+        start=None,
+        end=None):
         """
         Read aggregated data for a cell.
 
@@ -317,29 +328,61 @@ class SmecvTs(GriddedNcOrthoMultiTs, OrthoMultiTsCellReaderMixin):
             See read_agg_cell_data()
         as_xr : bool, optional (default: False)
             Read as xarray DataSet.
+        start : datetime or str, optional (default: None)
+            First time stamp to read from the cell file. If None, the first
+            time stamp in dt_index is used.
+        end : datetime or str, optional (default: None)
+            Last time stamp to read from the cell file. If None, the last
+            time stamp in dt_index is used.
 
         Returns
         -------
 
         """
+        if param_fill_val is None:
+            param_fill_val = {}
 
-        def _template(gpis, timestamps, name=None, fill_value=np.nan, dtype='float64'):
-            if name is None:
-                columns = gpis
-            else:
-                columns = pd.MultiIndex.from_product([[name], gpis], names=['var', 'gpi'])
+        data_arr, timestamps, (cell_lons, cell_lats, cell_gpi) = \
+            self._read_cell_cube(cell, dt_index, params,
+                                 param_fill_val=param_fill_val,
+                                 param_scalf=param_scalf,
+                                 param_dtype=param_dtype,
+                                 start=start, end=end)
 
-            df = pd.DataFrame(index=timestamps, columns=columns,
-                              data=fill_value, dtype=dtype)
-            # ser = pd.Series(index=np.sort(gpis),
-            #                 data=[np.full(len(dt_index), fill_value, dtype=dtype)] * len(gpis))
-            # ser.name = name
-            return df
+        #timestamps.name = 'time'
+        if as_xr:
+            data_vars = {}
+            for name in data_arr.keys():
+                attrs = {'dtype': str(data_arr[name].dtype)}
+                if name in param_fill_val.keys():
+                    attrs['_FillValue'] = data_arr[name].fill_value
+                data_vars[name] = (['time', 'lat', 'lon'],
+                                   data_arr[name].filled(),
+                                   attrs)
+
+            cube = xr.Dataset(
+                data_vars=data_vars,
+                coords={'time': timestamps.astype('datetime64[s]'),
+                        'lon': np.array(np.unique(cell_lons.flatten()), np.float32),
+                        'lat': np.array(np.unique(cell_lats.flatten()), np.float32)})
+
+            return cube
+        else:
+            return data_arr, {'lon': cell_lons, 'lat': cell_lats, 'gpi': cell_gpi}
 
+    def _read_cell_cube(self, cell, dt_index, params, param_fill_val=None,
+                        param_scalf=None, param_dtype=None, start=None,
+                        end=None) -> (dict, np.ndarray, tuple):
+        # Read the data cubes (time, lat, lon) of all parameters for a cell,
+        # see read_agg_cell_cube(). Returns the masked data cubes, the
+        # time stamps and the lon, lat and gpi arrays of the cell.
         cell_gpi = self.grid.gpis[self.grid.arrcell == cell]
         cell_lons, cell_lats = self.grid.gpi2lonlat(cell_gpi)
         cell_gpi_shape = tuple([int(self.grid.cellsize / self.grid.resolution)] * 2)
 
+        # position of each gpi in the flattened (lat, lon) plane of the cube
+        sorted_gpi = np.sort(cell_gpi)
+
         cell_gpi = np.flipud(cell_gpi.reshape(cell_gpi_shape))
         cell_lats = np.flipud(cell_lats.reshape(cell_gpi_shape))
         cell_lons = cell_lons.reshape(cell_gpi_shape)
@@ -355,11 +398,6 @@ class SmecvTs(GriddedNcOrthoMultiTs, OrthoMultiTsCellReaderMixin):
             for p in param_scalf:
                 if p not in param_fill_val:
                     warnings.warn(f"{p} : Value is scaled but not replaced, are you sure?")
-        try:
-            data_df = self.read_agg_cell_data(cell,
-                                              param=params)
-        except FileNotFoundError:
-            data_df = None
 
         for p in params:
             if p not in param_fill_val.keys():
@@ -367,93 +405,223 @@ class SmecvTs(GriddedNcOrthoMultiTs, OrthoMultiTsCellReaderMixin):
             if p not in param_dtype.keys():
                 param_dtype[p] = 'float64'
 
-        if data_df is None:  # file not found
-            _dfs = []
-            # data_df = pd.DataFrame(index=dt_index,
-            #                        columns=pd.MultiIndex.from_product([params, cell_gpi.flatten()]))
-            #data_df = {'index': dt_index}
-            for p in params:
-                fill_value = param_fill_val[p]
-                dtype = param_dtype[p]
-                df = _template(name=p,
-                               gpis=np.sort(cell_gpi.flatten()),
-                               timestamps=dt_index,
-                               fill_value=fill_value,
-                               dtype=dtype)
-                _dfs.append(df)
-            data_df = pd.concat(_dfs, axis=1)
-
-        if 'index' in data_df.columns:
-            timestamps = data_df.pop('index')
-        else:
-            timestamps = data_df.index.values
+        try:
+            if len(dt_index) > 0:
+                start = dt_index.min() if start is None else start
+                end = dt_index.max() if end is None else end
+            loc_id, timestamps, variables = self._read_orthomulti_cell(
+                cell, list(params), start=start, end=end)
+            timestamps = timestamps.values
+        except FileNotFoundError:  # all values are filled
+            loc_id, timestamps, variables = np.array([]), dt_index, {}
 
         sel = np.isin(timestamps, dt_index)
+        t_idx = np.nonzero(sel)[0]
+
+        loc_id = np.ma.getdata(loc_id)
+        loc_pos = np.searchsorted(sorted_gpi, loc_id)
+        in_cell = loc_pos < sorted_gpi.size
+        in_cell[in_cell] = sorted_gpi[loc_pos[in_cell]] == loc_id[in_cell]
+        loc_pos = loc_pos[in_cell]
+
+        param_scalf = {} if param_scalf is None else param_scalf
 
-        names = np.unique(data_df.columns.get_level_values('var').values)
         data_arr = {}
-        for name in names:
-            ds = data_df[name]
-            if ds.index.size != cell_gpi.size:
-                missing_gpis = np.setdiff1d(cell_gpi, ds.columns.values)
-                fill_val = param_fill_val[name]
-                if len(missing_gpis) > 0:
-                    ds_missing_gpis = _template(
-                        name=name,
-                        timestamps=timestamps,
-                              gpis=missing_gpis,
-                              fill_value=fill_val)
-                    # ds_missing_gpis = pd.Series(
-                    #     index=missing_gpis,
-                    #     data=[np.repeat(fill_val, len(timestamps))] * len(missing_gpis))
-
-                    data_df = pd.concat([data_df, ds_missing_gpis], axis=1)
-                    data_df = data_df[data_df.columns.sortlevel(1)[0]]
-                    #data_df = data_df.sort_values(data_df.columns.sortlevel('gpi'), axis=1)
-                    #data_df[name, tuple(missing_gpis)] = ds_missing_gpis
-                    #data_df.insert((name, 0), ds_missing_gpis)
-                    #data_df[name, missing_gpis] = pd.concat([ds, ds_missing_gpis], axis=1, sort=True)
-                    assert len(data_df[name].columns) == cell_gpi.size, "Unexpected number of gpis"
-
-            #data_df[name] = data_df[name, np.sort(data_df[name].columns)]
-
-            # from (time, gpi) to (gpi, time)
-            #arr = np.ndarray.view(np.transpose(np.vstack(data_df[name].values))) # transpose?
-
-            newshape = (len(timestamps), *cell_gpi_shape)
-            arr = np.reshape(data_df[name].values, newshape)[sel, :, :] #flip?
-
-            data_arr[name] = np.ma.masked_equal(arr.astype(param_dtype[name]),
-                                                param_fill_val[name],
-                                                copy=False)
-
-            param_scalf = {} if param_scalf is None else param_scalf
+        for name in np.unique(params):
+            dtype = np.dtype(param_dtype[name])
+            fill_val = param_fill_val[name]
+            if (dtype.kind not in 'fc') and np.isnan(fill_val):
+                raise ValueError(f"{name}: A fill value is required for "
+                                 f"dtype {dtype}")
+
+            # cube is allocated once, points are scattered into the
+            # flattened (lat, lon) plane.
+            arr = np.full((t_idx.size, *cell_gpi_shape), fill_val,
+                          dtype=dtype)
+            if name in variables:
+                values = variables[name][in_cell][:, t_idx]
+                if dtype.kind in 'fc':  # missing observations as NaN
+                    values = np.ma.filled(values.astype(dtype), np.nan)
+                else:
+                    values = np.ma.filled(values, fill_val).astype(dtype)
+                arr.reshape(t_idx.size, -1)[:, loc_pos] = values.T
+
+            data_arr[name] = np.ma.masked_equal(arr, fill_val, copy=False)
 
             if name in param_scalf.keys():
                 data_arr[name] *= param_scalf[name]
 
         timestamps = timestamps[sel]
 
-        #timestamps.name = 'time'
-        if as_xr:
-            data_vars = {}
-            for name in data_arr.keys():
-                attrs = {'dtype': str(data_arr[name].dtype)}
-                if name in param_fill_val.keys():
-                    attrs['_FillValue'] = data_arr[name].fill_value
-                data_vars[name] = (['time', 'lat', 'lon'],
-                                   data_arr[name].filled(),
-                                   attrs)
+        return data_arr, timestamps, (cell_lons, cell_lats, cell_gpi)
 
-            cube = xr.Dataset(
-                data_vars=data_vars,
-                coords={'time': timestamps.astype('datetime64[s]'),
-                        'lon': np.array(np.unique(cell_lons.flatten()), np.float32),
-                        'lat': np.array(np.unique(cell_lats.flatten()), np.float32)})
+    def read_region_cube(
+        self,
+        dt_index:pd.Index,
+        params:list,
+        bbox:tuple=None,
+        cells:list=None,
+        param_fill_val:dict=None,
+        param_scalf:dict=None,
+        param_dtype:dict=None,
+        n_workers:int=1) -> xr.Dataset:
+        """
+        Read aggregated data for a region of multiple cells into one data
+        cube. The cube for the whole region is allocated once and the
+        data of each cell is written into its slice directly. With
+        n_workers > 1, the cells are read in separate processes, which
+        write into the cube in shared memory (see SharedArray).
 
-            return cube
+        Parameters
+        ----------
+        dt_index : pd.Index
+            Index of time stamps to read data for, this is also the time
+            dimension of the cube.
+            e.g. pd.date_range('2000-01-01', '2000-12-31', freq='D')
+        params : list
+            List of parameters to read
+        bbox : tuple, optional (default: None)
+            Bounding box of the region (min_lon, min_lat, max_lon, max_lat).
+            Either bbox or cells must be passed.
+        cells : list, optional (default: None)
+            Cells of the region. Either bbox or cells must be passed.
+        param_fill_val : dict['str': float | int], optional (default: None)
+            Fill values for each parameter to use for missing values,
+            e.g. {'sm' : np.nan}
+        param_scalf : dict[str: float | int], optional (default: None)
+            Parameter names and scale factors, i.e. values that a parameter
+            time series is multiplied with after reading.
+        param_dtype : dict[str: str], optional (default: None)
+            Data types that the parameter columns are converted into.
+        n_workers : int, optional (default: 1)
+            Number of processes that read cells in parallel. netCDF/HDF5
+            is not thread safe, so there is no thread based option.
+
+        Returns
+        -------
+        cube : xr.Dataset
+            Data cube with the same layout as read_agg_cell_cube(as_xr=True)
+        """
+        if (bbox is None) == (cells is None):
+            raise ValueError("Pass either a bbox or cells")
+
+        if bbox is not None:
+            min_lon, min_lat, max_lon, max_lat = bbox
+            gpis = self.grid.get_bbox_grid_points(
+                latmin=min_lat, latmax=max_lat, lonmin=min_lon,
+                lonmax=max_lon)
+            cells = np.unique(self.grid.gpi2cell(gpis))
         else:
-            return data_arr, {'lon': cell_lons, 'lat': cell_lats, 'gpi': cell_gpi}
+            cells = np.atleast_1d(cells)
+            gpis = self.grid.grid_points_for_cell(list(cells))[0]
+
+        lons, lats = self.grid.gpi2lonlat(gpis)
+        region_lons, region_lats = np.unique(lons), np.unique(lats)
+        times = np.unique(np.asarray(dt_index, dtype='datetime64[ns]'))
+
+        param_fill_val = {} if param_fill_val is None else \
+            param_fill_val.copy()
+        param_dtype = {} if param_dtype is None else param_dtype.copy()
+        for p in params:
+            if p not in param_fill_val.keys():
+                param_fill_val[p] = np.nan
+            if p not in param_dtype.keys():
+                param_dtype[p] = 'float64'
+
+        shape = (times.size, region_lats.size, region_lons.size)
+        for name in np.unique(params):
+            dtype = np.dtype(param_dtype[name])
+            if (dtype.kind not in 'fc') and np.isnan(param_fill_val[name]):
+                raise ValueError(f"{name}: A fill value is required for "
+                                 f"dtype {dtype}")
+
+        kwargs = dict(dt_index=dt_index, params=params, times=times,
+                      region_lons=region_lons, region_lats=region_lats,
+                      param_fill_val=param_fill_val, param_scalf=param_scalf,
+                      param_dtype=param_dtype)
+
+        if n_workers > 1:
+            data_arr = {name: SharedArray(shape, param_dtype[name],
+                                          fill_value=param_fill_val[name])
+                        for name in np.unique(params)}
+            # Workers get a copy of the reader without the open cell file,
+            # which can not be pickled.
+            reader = copy.copy(self)
+            reader.fid, reader.previous_cell = None, None
+            try:
+                with ProcessPoolExecutor(
+                        n_workers, initializer=_init_region_worker,
+                        initargs=(reader, data_arr, kwargs)) as executor:
+                    list(executor.map(_read_cell_into_region_in_worker,
+                                      cells))
+                cube_arr = {name: arr.to_numpy()
+                            for name, arr in data_arr.items()}
+            finally:
+                for arr in data_arr.values():
+                    arr.close()
+            data_arr = cube_arr
+        else:
+            data_arr = {name: np.full(shape, param_fill_val[name],
+                                      dtype=param_dtype[name])
+                        for name in np.unique(params)}
+            for cell in cells:
+                self._read_cell_into_region(cell, data_arr, **kwargs)
+
+        data_vars = {}
+        for name, arr in data_arr.items():
+            attrs = {'dtype': str(arr.dtype),
+                     '_FillValue': np.array(param_fill_val[name],
+                                            dtype=arr.dtype)[()]}
+            data_vars[name] = (['time', 'lat', 'lon'], arr, attrs)
+
+        cube = xr.Dataset(
+            data_vars=data_vars,
+            coords={'time': times.astype('datetime64[s]'),
+                    'lon': np.array(region_lons, np.float32),
+                    'lat': np.array(region_lats, np.float32)})
+
+        return cube
+
+    def _read_cell_into_region(self, cell, data_arr, dt_index, params, times,
+                               region_lons, region_lats, param_fill_val=None,
+                               param_scalf=None, param_dtype=None):
+        # Read the cube of a cell and write it into its slice of the region
+        # cube in data_arr (arrays or SharedArrays), see read_region_cube()
+        cell_arr, timestamps, (cell_lons, cell_lats, _) = \
+            self._read_cell_cube(cell, dt_index, params,
+                                 param_fill_val=param_fill_val.copy(),
+                                 param_scalf=param_scalf,
+                                 param_dtype=param_dtype.copy())
+        # the cube of a cell is sorted by lat, lon
+        cell_lats = np.unique(cell_lats)
+        cell_lons = np.unique(cell_lons)
+        lat_sel = np.isin(cell_lats, region_lats)
+        lon_sel = np.isin(cell_lons, region_lons)
+        if not (lat_sel.any() and lon_sel.any()):
+            return
+
+        t = np.searchsorted(
+            times, np.asarray(timestamps, dtype='datetime64[ns]'))
+        r0 = np.searchsorted(region_lats, cell_lats[lat_sel][0])
+        c0 = np.searchsorted(region_lons, cell_lons[lon_sel][0])
+        r1, c1 = r0 + lat_sel.sum(), c0 + lon_sel.sum()
+        for name, arr in cell_arr.items():
+            data_arr[name][t, r0:r1, c0:c1] = \
+                arr.filled()[:, lat_sel][:, :, lon_sel]
+
+
+# Reader, output arrays and settings of the worker processes of
+# SmecvTs.read_region_cube, sent to each worker once.
+_region_worker = {}
+
+
+def _init_region_worker(reader, data_arr, kwargs):
+    _region_worker.update(reader=reader, data_arr=data_arr, kwargs=kwargs)
+
+
+def _read_cell_into_region_in_worker(cell):
+    _region_worker['reader']._read_cell_into_region(
+        cell, _region_worker['data_arr'], **_region_worker['kwargs'])
 
 
 class CCIDs(GriddedTsBase):
@@ -25,8 +25,14 @@ class LPRMTs(GriddedNcOrthoMultiTs, OrthoMultiTsCellReaderMixin):
         if exact_index and (self.parameters is not None):
             self.parameters.append(self._t0)
 
+    # read_cells() passes the cell data to read(), see _read_cached_ts()
+    _reads_cell_data = True
+
     def read(self, *args, **kwargs):
-        df = super(LPRMTs, self).read(*args, **kwargs)
+        # Points in cached or preloaded cells are read from memory
+        df = self._read_cached_ts(*args, **kwargs)
+        if df is None:
+            df = super(LPRMTs, self).read(*args, **kwargs)
         if self.exact_index:
             df[self._t0] = jd2dt(mjd2jd(df[self._t0].values))
             df = df.set_index(self._t0)  # drop nan index
@@ -2,99 +2,646 @@ import warnings
 import os
 import numpy as np
 import pandas as pd
-from datetime import datetime, timedelta
+from datetime import datetime
 import netCDF4 as nc
 from pygeogrids.grids import CellGrid
 import xarray as xr
 from typing import Callable
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from io_utils.data.read.geo_ts_readers.ts_cache import nc_lock
 
-class ContiguousRaggedTsCellReaderMixin:
 
+def _decode_time(time, unit_time) -> pd.DatetimeIndex:
     """
-    Adds functionality to read whole cells. Can be added to time series
-    readers that use the cell file structure of pynetcf.
+    Convert numeric time stamps (in days) to a DatetimeIndex.
+
+    Gives the same result as adding ``datetime.timedelta(t)`` for each t to
+    the reference date, i.e. days are split into whole days and a fraction
+    that is rounded (half even) to microseconds, but uses datetime64
+    arithmetic instead of python objects.
+
+    Parameters
+    ----------
+    time: np.ndarray
+        Time stamps as days since the reference date.
+    unit_time: str
+        Units attribute of the time variable, of form '<unit> since <refdate>'
+
+    Returns
+    -------
+    index: pd.DatetimeIndex
+        Decoded time stamps.
     """
+    since = pd.Timestamp(unit_time.split('since ')[1]).to_datetime64()
+    frac, whole = np.modf(np.asarray(time, dtype='float64'))
+    us = whole.astype('int64') * 86400000000 + \
+        np.round(frac * 86400e6).astype('int64')
 
-    path: str
-    grid: CellGrid
+    return pd.DatetimeIndex(
+        (since + us.astype('timedelta64[us]')).astype('datetime64[ns]'))
 
-    read: Callable
 
-    def read_cell(self, cell, param='sm', fill_value=None):
+def _in_window(time, start=None, end=None) -> np.ndarray:
+    # Boolean mask of datetime64 time stamps between start and end (included)
+    keep = np.ones(len(time), dtype=bool)
+    if start is not None:
+        keep &= time >= pd.Timestamp(start).to_datetime64()
+    if end is not None:
+        keep &= time <= pd.Timestamp(end).to_datetime64()
+    return keep
+
+
+def _runs(mask) -> (np.ndarray, np.ndarray):
+    # Start and stop indices of all runs of True values in a boolean mask
+    d = np.diff(np.concatenate([[0], mask.astype('int8'), [0]]))
+    return np.nonzero(d == 1)[0], np.nonzero(d == -1)[0]
+
+
+def _merge_ranges(starts, stops, max_gap=0) -> (np.ndarray, np.ndarray):
+    """
+    Merge sorted, non-overlapping index ranges [start, stop) that are less
+    than `max_gap` elements apart, so that they can be read in one go.
+
+    Parameters
+    ----------
+    starts: np.ndarray
+        First index of each range
+    stops: np.ndarray
+        Index after the last element of each range
+    max_gap: int, optional (default: 0)
+        Maximum number of elements between two ranges that are merged.
+        0 means that only ranges that directly follow each other are merged.
+
+    Returns
+    -------
+    starts: np.ndarray
+        Start indices of the merged ranges
+    stops: np.ndarray
+        Stop indices of the merged ranges
+    """
+    starts, stops = np.asarray(starts), np.asarray(stops)
+    if starts.size == 0:
+        return starts, stops
+    new = np.concatenate([[True], (starts[1:] - stops[:-1]) > max_gap])
+    last = np.concatenate([new[1:], [True]])
+    return starts[new], stops[last]
+
+
+class RaggedCellData:
+    """
+    Time series of all locations in a cell in contiguous ragged layout, i.e.
+    the observations of all locations are stored one after another in flat
+    arrays, and `row_size` holds the number of observations per location.
+    Nothing is padded with fill values, data for a single location can be
+    accessed as views of the flat arrays.
+
+    Parameters
+    ----------
+    location_id: np.ndarray
+        Location ids (gpis) in the order they are stored in.
+    row_size: np.ndarray
+        Number of observations for each location.
+    time: np.ndarray
+        Time stamp of each observation, datetime64.
+    data: dict[str, np.ndarray]
+        Flat values of each variable, same length as `time`.
+    fill_values: dict[str, float or int], optional (default: None)
+        Fill value of each variable, used when converting to a dense layout.
+    """
+
+    def __init__(self, location_id, row_size, time, data, fill_values=None):
+        self.location_id = np.asarray(location_id)
+        self.row_size = np.asarray(row_size, dtype='int64')
+        self.time = np.asarray(time, dtype='datetime64[ns]')
+        self.data = data
+        self.fill_values = fill_values if fill_values is not None else {}
+
+        self.offsets = np.concatenate([[0], np.cumsum(self.row_size)])
+
+        n_obs = self.offsets[-1]
+        for p, values in self.data.items():
+            if not (len(self.time) == len(values) == n_obs):
+                raise ValueError("Time and data must have same length")
+
+        self._loc_pos = None
+        self._layout = None
+
+    @classmethod
+    def from_orthomulti(cls, location_id, time, data):
         """
-        Reads a single variable for all points of a cell.
+        Convert data from an orthomulti file (all locations share the same
+        time stamps) into the ragged layout. Only time stamps where at least
+        one of the variables is not masked are kept for each location,
+        masked values of the other variables are set to NaN.
 
         Parameters
         ----------
-        cell: int
-            Cell number, will look for a file <cell>.nc that must exist.
-            The file must contain a variable `location_id` and `time`.
-            Time must have an attribute of form '<unit> since <refdate>'
-        param: str, optional (default: 'sm')
-            Variable to extract from files
+        location_id: np.ndarray
+            Location ids (gpis)
+        time: pd.DatetimeIndex or np.ndarray
+            Common time stamps of all locations.
+        data: dict[str, np.ma.MaskedArray]
+            Variables of shape (locations, time)
+        """
+        time = np.asarray(time, dtype='datetime64[ns]')
+        valid = np.zeros((len(location_id), len(time)), dtype=bool)
+        for values in data.values():
+            valid |= ~np.ma.getmaskarray(values)
+
+        loc_pos, time_pos = np.nonzero(valid)
+
+        flat = {}
+        for p, values in data.items():
+            if np.ma.is_masked(values):
+                if values.dtype.kind not in 'fc':
+                    values = values.astype('float64')
+                values = values.filled(np.nan)
+            flat[p] = np.ma.getdata(values)[loc_pos, time_pos]
+
+        return cls(location_id, valid.sum(axis=1), time[time_pos], flat)
+
+    @property
+    def parameters(self) -> list:
+        return list(self.data.keys())
+
+    def _slice(self, gpi) -> slice:
+        # Position of the observations of a location in the flat arrays
+        if self._loc_pos is None:
+            self._loc_pos = {g: i for i, g in enumerate(self.location_id)}
+        i = self._loc_pos[gpi]
+        return slice(self.offsets[i], self.offsets[i + 1])
+
+    def gpi_view(self, gpi) -> (np.ndarray, dict):
+        """
+        Time stamps and values of all variables for a location, as views
+        of the flat arrays (no data is copied).
+
+        Parameters
+        ----------
+        gpi: int
+            Location id to select
+
+        Returns
+        -------
+        time: np.ndarray
+            Time stamps of the observations of the location.
+        data: dict[str, np.ndarray]
+            Values of each variable of the location.
+        """
+        s = self._slice(gpi)
+        return self.time[s], {p: v[s] for p, v in self.data.items()}
+
+    def clip(self, start=None, end=None):
+        """
+        Keep only observations between start and end (both included).
+
+        Returns
+        -------
+        clipped: RaggedCellData
+            Data for the selected period
+        """
+        keep = _in_window(self.time, start, end)
+
+        loc_pos = np.repeat(np.arange(self.row_size.size), self.row_size)
+        row_size = np.bincount(loc_pos[keep], minlength=self.row_size.size)
+
+        return RaggedCellData(self.location_id, row_size, self.time[keep],
+                              {p: v[keep] for p, v in self.data.items()},
+                              self.fill_values)
+
+    def to_dense(self, param, fill_value=None) -> pd.DataFrame:
+        """
+        Create a dense (time x location) data frame for a variable, gaps
+        are filled with the fill value.
+
+        Parameters
+        ----------
+        param: str
+            Variable to convert.
         fill_value: float or int, optional (default: None)
-            Value to use for gaps, None uses fill value from file
+            Value to use for gaps, None uses the fill value of the variable,
+            or NaN if there is none.
 
         Returns
         -------
         df: pd.DataFrame
-            A data frame holding all data for the cell.
+            Data frame with time stamps as index and gpis as columns.
+        """
+        if fill_value is None:
+            fill_value = self.fill_values.get(param, np.nan)
+
+        if self._layout is None:
+            self._layout = np.unique(self.time, return_inverse=True)
+        index, time_pos = self._layout
+
+        loc_pos = np.repeat(np.arange(self.row_size.size), self.row_size)
+        filled = np.full((len(index), len(self.row_size)),
+                         fill_value=fill_value)
+        filled[time_pos, loc_pos] = self.data[param]
+
+        return pd.DataFrame(index=pd.DatetimeIndex(index), data=filled,
+                            columns=self.location_id)
+
+    def to_timegpi(self) -> pd.DataFrame:
+        """
+        Create a long format data frame of all observations, with time as
+        first and gpi as second index level, sorted by time and gpi.
         """
+        index = pd.MultiIndex.from_arrays(
+            [self.time, np.repeat(self.location_id, self.row_size)],
+            names=['time', 'gpi'])
+        df = pd.DataFrame(self.data, index=index)
 
+        return df.sort_index(level=[0, 1])
+
+    def to_gpidict(self, cache_size=0):
+        """
+        Create a dict-like object with one data frame (time stamps as index)
+        for each location that has observations, with the gpi as key.
+        Data frames are only created when a gpi is accessed.
+
+        Parameters
+        ----------
+        cache_size: int, optional (default: 0)
+            Number of created data frames to keep, see LazyGpiDict.
+
+        Returns
+        -------
+        data: LazyGpiDict
+            Read-only mapping of gpi to time series.
+        """
+        return LazyGpiDict(self, cache_size=cache_size)
+
+
+class LazyGpiDict(Mapping):
+    """
+    Read-only mapping of gpi to a time series data frame for all gpis of a
+    cell that have observations. Works like a dict, but the data for a gpi
+    is only converted to a data frame when it is accessed. The data frames
+    are built on slices of the shared cell arrays, changes to their values
+    therefore also affect the cell data.
+
+    Parameters
+    ----------
+    ragged: RaggedCellData
+        Data of all gpis in the cell.
+    cache_size: int, optional (default: 0)
+        Number of most recently accessed data frames to keep, so that
+        repeated access of the same gpi returns the same object.
+        0 means that a new data frame is created on each access.
+    """
+
+    def __init__(self, ragged, cache_size=0):
+        self.ragged = ragged
+        self.cache_size = cache_size
+
+        self._gpis = np.sort(ragged.location_id[ragged.row_size > 0])
+        self._valid = set(self._gpis.tolist())
+        self._cache = OrderedDict()
+
+    def __getitem__(self, gpi) -> pd.DataFrame:
+        if gpi not in self._valid:
+            raise KeyError(gpi)
+
+        if gpi in self._cache:
+            self._cache.move_to_end(gpi)
+            return self._cache[gpi]
+
+        time, values = self.ragged.gpi_view(gpi)
+        df = pd.DataFrame(values, index=pd.DatetimeIndex(time), copy=False)
+        if not df.index.is_monotonic_increasing:
+            df = df.sort_index()
+
+        if self.cache_size > 0:
+            self._cache[gpi] = df
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        return df
+
+    def __contains__(self, gpi) -> bool:
+        return gpi in self._valid
+
+    def __iter__(self):
+        return iter(self._gpis)
+
+    def __len__(self) -> int:
+        return len(self._gpis)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({len(self)} gpis, " \
+               f"parameters={self.ragged.parameters})"
+
+
+class CellCache:
+    """
+    Least recently used cache for decoded cell file arrays, shared by all
+    cell readers in the process. Entries are keyed by
+    (file path, modification time, variable, time window), so that
+    changed files are not served from the cache. When the total size of
+    the stored arrays exceeds the byte budget, the least recently used
+    entries are evicted. Cached arrays are read-only.
+
+    Parameters
+    ----------
+    max_bytes: int, optional (default: 0)
+        Byte budget of the cache, 0 disables caching.
+    """
+
+    def __init__(self, max_bytes=0):
+        self.max_bytes = int(max_bytes)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def _nbytes(value) -> int:
+        if isinstance(value, np.ndarray):
+            nbytes = value.nbytes
+            if np.ma.isMaskedArray(value) and \
+                    (value.mask is not np.ma.nomask):
+                nbytes += value.mask.nbytes
+            return nbytes
+        elif isinstance(value, pd.Index):
+            return value.nbytes
+        else:
+            return 0
+
+    def get(self, key):
+        """
+        Get a cached value, or None if there is no entry for the key.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            else:
+                self.misses += 1
+                return None
+
+    def put(self, key, value):
+        """
+        Store a value in the cache. Arrays are set to read-only. Values
+        that are larger than the byte budget are not stored.
+        """
+        nbytes = self._nbytes(value)
+        if (not self.enabled) or (nbytes > self.max_bytes):
+            return
+
+        if isinstance(value, np.ndarray):
+            value.flags.writeable = False
+            if np.ma.isMaskedArray(value) and \
+                    (value.mask is not np.ma.nomask):
+                value.mask.flags.writeable = False
+
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            self._evict()
+
+    def _evict(self):
+        # Drop least recently used entries until the budget is kept
+        while (self.nbytes > self.max_bytes) and (len(self._entries) > 0):
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self.nbytes -= nbytes
+            self.evictions += 1
+
+    def resize(self, max_bytes):
+        """
+        Change the byte budget, 0 disables caching and drops all entries.
+        """
+        with self._lock:
+            self.max_bytes = int(max_bytes)
+            self._evict()
+
+    def clear(self):
+        """
+        Drop all entries and reset the counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> dict:
+        """
+        Hit, miss and eviction counters and the current size of the cache.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'entries': len(self._entries),
+                    'nbytes': self.nbytes, 'max_bytes': self.max_bytes}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({len(self)} entries, " \
+               f"{self.nbytes}/{self.max_bytes} bytes)"
+
+
+# Cell cache shared by all readers, disabled by default.
+# Enable it with e.g. `cell_cache.resize(2 * 1024**3)`
+cell_cache = CellCache()
+
+class ContiguousRaggedTsCellReaderMixin:
+
+    """
+    Adds functionality to read whole cells. Can be added to time series
+    readers that use the cell file structure of pynetcf.
+    """
+
+    path: str
+    grid: CellGrid
+
+    read: Callable
+
+    def _cell_file_path(self, cell) -> str:
+        # Path to the netcdf file for a cell
         try:
             fnformat = getattr(self, 'fn_format') + '.nc'
         except AttributeError:
             fnformat = "{:04d}.nc"
 
-        file_path = os.path.join(self.path, fnformat.format(cell))
+        return os.path.join(self.path, fnformat.format(cell))
+
+    # Gaps (number of observations) between the time ranges of neighbouring
+    # locations up to which they are read at once.
+    _max_read_gap = 4096
+
+    def _time_window(self, start=None, end=None) -> (pd.Timestamp,
+                                                     pd.Timestamp):
+        # Combine the passed period with `clip_dates` of the reader
+        start = pd.Timestamp(start) if start is not None else None
+        end = pd.Timestamp(end) if end is not None else None
+
+        if hasattr(self, 'clip_dates') and self.clip_dates:
+            if hasattr(self, '_clip_dates'):
+                c_start, c_end = [pd.Timestamp(d) for d in self.clip_dates]
+                start = c_start if start is None else max(start, c_start)
+                end = c_end if end is None else min(end, c_end)
+            else:
+                warnings.warn("No method `_clip_dates` found.")
+
+        return start, end
+
+    def _apply_dtypes_scaling(self, df, param=None) -> pd.DataFrame:
+        # Apply the dtypes, scale factors and offsets of the pynetcf reader,
+        # as it would be done when reading a single point. If a param is
+        # passed, all columns of df are values of this parameter (e.g. one
+        # column per gpi).
+        def _columns(col):
+            if param is None:
+                return [col] if col in df.columns else []
+            return list(df.columns) if col == param else []
+
+        if getattr(self, 'dtypes', None) is not None:
+            for col, dtype in self.dtypes.items():
+                for c in _columns(col):
+                    df[c] = df[c].astype(dtype)
+
+        if getattr(self, 'scale_factors', None) is not None:
+            for col, scale_factor in self.scale_factors.items():
+                for c in _columns(col):
+                    df[c] *= scale_factor
+
+        if getattr(self, 'offsets', None) is not None:
+            for col, offset in self.offsets.items():
+                for c in _columns(col):
+                    df[c] += offset
+
+        return df
+
+    def _read_ragged_cell(self, cell, params, fill_value=None, start=None,
+                          end=None) -> RaggedCellData:
+        # Read the variables for all points of a cell without densifying.
+        # If a time window is set, only the ranges of each row that are in
+        # the window are read.
+        start, end = self._time_window(start, end)
+
+        file_path = self._cell_file_path(cell)
 
         with nc.Dataset(file_path) as ncfile:
             loc_id = ncfile.variables['location_id'][:]
             loc_id = loc_id[~loc_id.mask].data.flatten()
             row_size = ncfile.variables['row_size'][:]
-            row_size = row_size[~row_size.mask].data
+            row_size = row_size[~row_size.mask].data.flatten()
 
             time = ncfile.variables['time'][:].data
             unit_time = ncfile.variables['time'].units
-            variable = ncfile.variables[param][:]
-            if fill_value is None:
-                fill_value = variable.fill_value
-            variable = variable.filled(fill_value)
 
-        if fill_value is None:
-            fill_value = np.nan
+            for p in params:
+                if not (len(time) == ncfile.variables[p].shape[0]):
+                    raise ValueError("Time and data must have same length")
 
-        cutoff_points = np.cumsum(row_size)
-        index = np.sort(np.unique(time))
-        times = np.split(time, cutoff_points)[:-1]
-        datas = np.split(variable, cutoff_points)[:-1]
+            # Decode only the unique time stamps, the layout is kept for
+            # densifying later.
+            n_obs = int(np.sum(row_size))
+            index, time_pos = np.unique(time[:n_obs], return_inverse=True)
+            index = _decode_time(index, unit_time).values
 
-        if not (len(times) == len(datas)):
-            raise ValueError("Time and data must have same length")
+            keep = None
+            if (start is not None) or (end is not None):
+                keep = _in_window(index, start, end)[time_pos]
+                if keep.all():
+                    keep = None
 
-        filled = np.full((len(datas), len(index)), fill_value=fill_value)
-        idx = np.array([np.isin(index, t) for t in times])
-        filled[idx] = variable
+            variables, fill_values = {}, {}
+            if keep is None:
+                for p in params:
+                    variable = ncfile.variables[p][:]
+                    fill_values[p] = variable.fill_value \
+                        if fill_value is None else fill_value
+                    variables[p] = variable.filled(fill_values[p])[:n_obs]
+            else:
+                starts, stops = _merge_ranges(*_runs(keep),
+                                              max_gap=self._max_read_gap)
+                in_buffer = np.zeros(n_obs, dtype=bool)
+                for a, b in zip(starts, stops):
+                    in_buffer[a:b] = True
+                sel = keep[in_buffer]
 
-        delta = lambda t: timedelta(t)
-        vfunc = np.vectorize(delta)
-        since = pd.Timestamp(unit_time.split('since ')[1])
-        index = since + vfunc(index)
+                for p in params:
+                    ncvar = ncfile.variables[p]
+                    variable = np.ma.concatenate(
+                        [ncvar[a:b] for a, b in zip(starts, stops)]) \
+                        if len(starts) > 0 else ncvar[0:0]
+                    fill_values[p] = variable.fill_value \
+                        if fill_value is None else fill_value
+                    variables[p] = variable.filled(fill_values[p])[sel]
 
-        filled = np.transpose(np.array(filled))
+        if keep is None:
+            data = RaggedCellData(loc_id, row_size, index[time_pos],
+                                  variables, fill_values)
+            data._layout = (index, time_pos)
+        else:
+            loc_pos = np.repeat(np.arange(row_size.size), row_size)
+            row_size = np.bincount(loc_pos[keep], minlength=row_size.size)
+            data = RaggedCellData(loc_id, row_size, index[time_pos[keep]],
+                                  variables, fill_values)
 
-        data = pd.DataFrame(index=index, data=filled, columns=loc_id)
+        return data
 
-        if hasattr(self, 'clip_dates') and self.clip_dates:
-            if hasattr(self, '_clip_dates'):
-                data = self._clip_dates(data)
-            else:
-                warnings.warn("No method `_clip_dates` found.")
+    def read_cell(self, cell, param='sm', fill_value=None, start=None,
+                  end=None):
+        """
+        Reads one or multiple variables for all points of a cell.
+        All variables are read from the file in a single pass.
 
-        return data
+        Parameters
+        ----------
+        cell: int
+            Cell number, will look for a file <cell>.nc that must exist.
+            The file must contain a variable `location_id` and `time`.
+            Time must have an attribute of form '<unit> since <refdate>'
+        param: str or list, optional (default: 'sm')
+            Variable(s) to extract from files
+        fill_value: float or int, optional (default: None)
+            Value to use for gaps, None uses fill value from file
+        start: datetime or str, optional (default: None)
+            First time stamp to read, None to read from the beginning (or
+            from `clip_dates`, if the reader has them).
+            Only the data in the selected period is read from the file.
+        end: datetime or str, optional (default: None)
+            Last time stamp to read, None to read until the end (or
+            until `clip_dates`, if the reader has them).
+
+        Returns
+        -------
+        df: pd.DataFrame or dict
+            A data frame holding all data for the cell if a single variable
+            is passed, otherwise a dict of data frames (with the same index
+            and columns) with the variable names as keys.
+        """
+        ragged = self._read_ragged_cell(cell, np.atleast_1d(param),
+                                        fill_value=fill_value, start=start,
+                                        end=end)
+
+        data = {p: ragged.to_dense(p) for p in ragged.parameters}
+
+        if isinstance(param, str):
+            return data[param]
+        else:
+            return data
 
     def read_agg_cell_data(self, cell, param, format='pd_multicol_vargpi',
-                           swap_levels=False) -> dict or pd.DataFrame:
+                           swap_levels=False, gpidict_cache_size=0,
+                           start=None, end=None) -> dict or pd.DataFrame:
         """
         Read all time series for a single variable in the selected cell.
 
@@ -116,17 +663,31 @@ class ContiguousRaggedTsCellReaderMixin:
                 second index level.
             * gpidict
                 Returns a dictionary of dataframe where the keys are the gpis
-                and the values are the time series data.
+                and the values are the time series data. The dictionary is
+                a LazyGpiDict, data frames are only created on access.
+            * ragged
+                Returns a RaggedCellData object with the flat observations
+                of all gpis, the number of observations per gpi and the
+                time stamps, without padding to a common time index.
         swap_levels: bool, optional (default: False)
             If True, the index levels are swapped. So e.g. instead of a
             variable and gpi column level, you get a gpi and variable column
             level. Only works for ``pd_multiXXX_XXX`` formats.
+        gpidict_cache_size: int, optional (default: 0)
+            Number of accessed data frames that the LazyGpiDict keeps.
+            Only used for the ``gpidict`` format.
+        start: datetime or str, optional (default: None)
+            First time stamp to read, None to read from the beginning (or
+            from `clip_dates`, if the reader has them).
+            Only the data in the selected period is read from the file.
+        end: datetime or str, optional (default: None)
+            Last time stamp to read, None to read until the end (or
+            until `clip_dates`, if the reader has them).
 
         Returns
         -------
-        data : dict or pd.DataFrame
-            A DataFrame if a single variable was passed, otherwise
-            a dict of DataFrames with parameter name as key.
+        data : dict or pd.DataFrame or RaggedCellData
+            Cell data in the selected format.
         """
         if hasattr(self, 'exact_index') and self.exact_index:
             warnings.warn("Reading cell with exact index not yet supported. "
@@ -134,10 +695,34 @@ class ContiguousRaggedTsCellReaderMixin:
 
         format = format.lower()
 
+        if format not in ["pd_multicol_vargpi", "pd_multidx_vartime",
+                          "pd_multidx_timegpi", "gpidict", "ragged"]:
+            raise NotImplementedError(f"Format {format} not implemented")
+
+        params = [str(p) for p in np.atleast_1d(param)]
+
+        # All variables are read in one pass over the cell file.
+        # Long formats are created from the ragged data directly, without
+        # the dense (time x gpi) intermediate.
+        if format in ["ragged", "pd_multidx_timegpi", "gpidict"]:
+            ragged = self._read_ragged_cell(cell, params, start=start,
+                                            end=end)
+            if format == "ragged":
+                return ragged
+            elif format == "gpidict":
+                return ragged.to_gpidict(cache_size=gpidict_cache_size)
+            else:
+                dfs = ragged.to_timegpi()
+                if swap_levels:
+                    dfs = dfs.swaplevel(0, 1).sort_index(level=[0, 1])
+                return dfs
+
+        cell_data = self.read_cell(cell, params, start=start, end=end)
+
         if format == "pd_multicol_vargpi":
             dfs = []
-            for p in np.atleast_1d(param):
-                df = self.read_cell(cell, p)
+            for p in params:
+                df = cell_data[p]
                 df.columns = pd.MultiIndex.from_product([[p], df.columns])\
                                           .set_names(['var', 'gpi'])
                 dfs.append(df)
@@ -149,10 +734,10 @@ class ContiguousRaggedTsCellReaderMixin:
 
             return dfs.sort_index(level=[0, 1], axis=1)
 
-        elif format == "pd_multidx_vartime":
+        else:  # pd_multidx_vartime
             dfs = []
-            for p in np.atleast_1d(param):
-                df = self.read_cell(cell, p)
+            for p in params:
+                df = cell_data[p]
                 df.index = pd.MultiIndex.from_product([[p], df.index])\
                                         .set_names(['var', 'time'])
                 dfs.append(df)
@@ -163,34 +748,79 @@ class ContiguousRaggedTsCellReaderMixin:
 
             return dfs.sort_index(level=[0, 1], axis=0)
 
-        elif format == "pd_multidx_timegpi":
-            dfs = []
-            for p in np.atleast_1d(param):
-                df = self.read_cell(cell, p)
-                df = df.stack().to_frame(p)
-                dfs.append(df)
-            dfs = pd.concat(dfs, axis=1)
-            dfs.index = dfs.index.set_names(['time', 'gpi'])
 
-            if swap_levels:
-                dfs = dfs.swaplevel(0, 1)
+    def iter_cells(self, cells, params, format='pd_multicol_vargpi',
+                   prefetch=2, **kwargs):
+        """
+        Iterate over the data of multiple cells. While the data of the
+        current cell is processed by the caller, the following cells are
+        read in a background thread.
 
-            return dfs.sort_index(level=[0, 1])
+        netCDF/HDF5 is not thread safe, the background thread holds
+        `io_utils.data.read.geo_ts_readers.ts_cache.nc_lock` while it reads.
+        Code in the loop that reads or writes netCDF/HDF5 files (also via
+        other libraries, e.g. xarray) must hold this lock as well:
 
-        elif format == "gpidict":
-            dfs = []
-            for p in np.atleast_1d(param):
-                df = self.read_cell(cell, p)
-                df = df.stack().to_frame(p)
-                dfs.append(df)
-            dfs = pd.concat(dfs, axis=1).sort_index(level=[0, 1])
-            dfs['gpi'] = dfs.index.get_level_values(1)
-            dfs.index = dfs.index.droplevel(1)
-            data = dict(tuple(dfs.groupby(dfs.pop('gpi'))))
-            return data
-        else:
-            raise NotImplementedError(f"Format {format} not implemented")
+            for cell, data in reader.iter_cells(cells, 'sm'):
+                result = process(data)
+                with nc_lock:
+                    result.to_netcdf(f"{cell}.nc")
+
+        Or use prefetch=0 to read the cells in the calling thread.
+
+        Parameters
+        ----------
+        cells: list or np.ndarray
+            Cells to read, in the order in which they are yielded.
+        params: list or str
+            Name of the variable(s) to read.
+        format: str, optional (default: 'pd_multicol_vargpi')
+            Format of the cell data, see read_agg_cell_data()
+        prefetch: int, optional (default: 2)
+            Number of cells that are read ahead of the current one. At most
+            prefetch + 1 cells are kept in memory at once. 0 reads each
+            cell when it is requested, without a background thread.
+        kwargs:
+            Additional kwargs are passed to read_agg_cell_data()
+
+        Yields
+        ------
+        cell: int
+            Cell number
+        data: dict or pd.DataFrame or RaggedCellData
+            Cell data in the selected format.
+        """
+        cells = iter(np.atleast_1d(cells))
+        prefetch = max(int(prefetch), 0)
+
+        def _read(cell):
+            return self.read_agg_cell_data(cell, params, format=format,
+                                           **kwargs)
 
+        def _read_locked(cell):
+            with nc_lock:
+                return _read(cell)
+
+        if prefetch == 0:
+            for cell in cells:
+                yield cell, _read(cell)
+            return
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        queue = deque()
+        try:
+            for cell in cells:
+                queue.append((cell, executor.submit(_read_locked, cell)))
+                if len(queue) > prefetch:
+                    cell, future = queue.popleft()
+                    yield cell, future.result()
+            while len(queue) > 0:
+                cell, future = queue.popleft()
+                yield cell, future.result()
+        finally:
+            for _, future in queue:
+                future.cancel()
+            executor.shutdown(wait=True)
 
     # def read_agg_cell_data(self, cell, param, format='pd_multicol_vargpi') \
     #         -> dict or pd.DataFrame:
@@ -293,10 +923,213 @@ class OrthoMultiTsCellReaderMixin:
     read: Callable
     # Methods from compatible Mixins:
     read_agg_cell_data = ContiguousRaggedTsCellReaderMixin.read_agg_cell_data
+    iter_cells = ContiguousRaggedTsCellReaderMixin.iter_cells
+
+    _cell_file_path = ContiguousRaggedTsCellReaderMixin._cell_file_path
+    _time_window = ContiguousRaggedTsCellReaderMixin._time_window
+    _apply_dtypes_scaling = \
+        ContiguousRaggedTsCellReaderMixin._apply_dtypes_scaling
+
+    # Cache for decoded cell arrays, see CellCache
+    _cell_cache = cell_cache
+
+    # Set to True in readers whose read() passes its kwargs to
+    # _read_cached_ts(), so that read_cells() can pass the rows of a cell
+    # it has read at once as `cell_data`.
+    _reads_cell_data = False
+
+    @staticmethod
+    def _cell_cache_key(file_path, name, start=None, end=None) -> tuple:
+        # Key of a variable of a cell file in the cell cache
+        return file_path, os.path.getmtime(file_path), name, start, end
+
+    def _read_orthomulti_cell(self, cell, params, start=None, end=None,
+                              gpis=None) \
+            -> (np.ndarray, pd.DatetimeIndex, dict):
+        # Read location ids, time stamps and the (masked) variables of shape
+        # (locations, time) from a cell file. If a time window is set, only
+        # the according slice of the time dimension is read. If gpis are
+        # set, only the rows of these locations are read (neighbouring rows
+        # in one slice). If params is None, all time series are read.
+        # Variables that are in the cell cache are not read again, full
+        # variables that are read are added to the cache.
+        start, end = self._time_window(start, end)
+
+        file_path = self._cell_file_path(cell)
+
+        cache = self._cell_cache if self._cell_cache.enabled else None
+
+        loc_id, time, variables = None, None, {}
+        if cache is not None:
+            def _key(name):
+                return self._cell_cache_key(file_path, name, start, end)
+
+            loc_id = cache.get(_key('location_id'))
+            time = cache.get(_key('time'))
+            if params is None:
+                params = cache.get(_key('__variables__'))
+            for p in ([] if params is None else params):
+                values = cache.get(_key(p))
+                if values is not None:
+                    variables[p] = values
+        cached = list(variables.keys())
+
+        in_gpis = None
+        if (loc_id is None) or (time is None) or (params is None) or \
+                (len(variables) < len(params)):
+            with nc.Dataset(file_path) as ncfile:
+                loc_id = ncfile.variables['location_id'][:]
+                loc_dim = ncfile.variables['location_id'].dimensions[0]
+
+                if params is None:
+                    params = [name for name, ncvar in
+                              ncfile.variables.items()
+                              if (ncvar.ndim == 2) and
+                              (loc_dim in ncvar.dimensions) and
+                              ('time' in ncvar.dimensions)]
+                    # only the full list of variables is cached
+                    if cache is not None:
+                        cache.put(_key('__variables__'), tuple(params))
+
+                row_ranges = None
+                if gpis is not None:
+                    in_gpis = np.isin(np.ma.getdata(loc_id), gpis)
+                    row_ranges = list(zip(*_runs(in_gpis)))
+
+                time = ncfile.variables['time'][:]
+                unit_time = ncfile.variables['time'].units
+                time = _decode_time(time, unit_time)
+
+                t_sel = slice(None)
+                if (start is not None) or (end is not None):
+                    if time.is_monotonic_increasing:
+                        i0 = 0 if start is None else \
+                            time.searchsorted(start, side='left')
+                        i1 = len(time) if end is None else \
+                            time.searchsorted(end, side='right')
+                        t_sel = slice(i0, max(i0, i1))
+                    else:
+                        t_sel = np.nonzero(
+                            _in_window(time.values, start, end))[0]
+                    time = time[t_sel]
+
+                for p in params:
+                    if p in variables:
+                        continue
+                    ncvar = ncfile.variables[p]
+                    slicer = [slice(None)] * ncvar.ndim
+                    slicer[ncvar.dimensions.index('time')] = t_sel
+                    if row_ranges is None:
+                        variables[p] = ncvar[tuple(slicer)]
+                        if cache is not None:
+                            cache.put(_key(p), variables[p])
+                    else:
+                        loc_axis = ncvar.dimensions.index(loc_dim)
+                        rows = []
+                        for a, b in row_ranges:
+                            slicer[loc_axis] = slice(a, b)
+                            rows.append(ncvar[tuple(slicer)])
+                        if len(rows) > 0:
+                            variables[p] = np.ma.concatenate(
+                                rows, axis=loc_axis)
+                        else:
+                            slicer[loc_axis] = slice(0, 0)
+                            variables[p] = ncvar[tuple(slicer)]
+
+            if cache is not None:
+                cache.put(_key('location_id'), loc_id)
+                cache.put(_key('time'), time)
+
+        if gpis is not None:
+            if in_gpis is None:
+                in_gpis = np.isin(np.ma.getdata(loc_id), gpis)
+            for p in cached:
+                variables[p] = variables[p][in_gpis]
+            loc_id = loc_id[in_gpis]
+
+        return loc_id, time, {p: variables[p] for p in params}
+
+    def _point_ts(self, data, time, period=None) -> pd.DataFrame:
+        # Time series of a point from its (already read) variables
+        df = pd.DataFrame(data, index=time)
+        if period is not None:
+            df = df[period[0]:period[1]]
+        return self._apply_dtypes_scaling(df)
+
+    def _read_cached_ts(self, *args, cell_data=None, **kwargs) \
+            -> pd.DataFrame or None:
+        # Time series of a point (gpi or lon, lat) from memory, as pynetcf
+        # would read it: from the passed cell_data, a tuple of the location
+        # index ({gpi: row}), time stamps and variables of a cell as
+        # read_cells() reads them, or from the cell cache. None if the data
+        # is not in memory.
+        if ((cell_data is None) and (not self._cell_cache.enabled)) or \
+                (hasattr(self, 'exact_index') and self.exact_index) or \
+                (len(set(kwargs.keys()) - {'max_dist', 'period'}) > 0):
+            return None
+
+        if len(args) == 1:
+            gpi = args[0]
+        elif len(args) == 2:
+            gpi, _ = self.grid.find_nearest_gpi(
+                args[0], args[1], kwargs.get('max_dist', np.inf))
+        else:
+            return None
+
+        if (cell_data is not None) and (gpi in cell_data[0]):
+            loc_index, time, variables = cell_data
+            i = loc_index[gpi]
+            return self._point_ts({p: v[i] for p, v in variables.items()},
+                                  time, kwargs.get('period'))
+
+        if not self._cell_cache.enabled:
+            return None
+
+        file_path = self._cell_file_path(self.grid.gpi2cell(gpi))
+        if not os.path.isfile(file_path):
+            return None
 
-    def read_cell(self, cell, param='sm'):
+        start, end = self._time_window()
+        cache = self._cell_cache
+
+        def _key(name):
+            return self._cell_cache_key(file_path, name, start, end)
+
+        params = getattr(self, 'parameters', None)
+        if params is None:
+            params = cache.get(_key('__variables__'))
+        loc_id = cache.get(_key('location_id'))
+        time = cache.get(_key('time'))
+        if (params is None) or (loc_id is None) or (time is None):
+            return None
+
+        i = np.nonzero(np.ma.getdata(loc_id) == gpi)[0]
+        if i.size == 0:
+            return None
+
+        data = {}
+        for p in params:
+            values = cache.get(_key(p))
+            if values is None:
+                return None
+            data[p] = values[i[0]]
+
+        return self._point_ts(data, time, kwargs.get('period'))
+
+    def _read_ragged_cell(self, cell, params, start=None, end=None) \
+            -> RaggedCellData:
+        # Read the variables for all points of a cell without the time
+        # stamps where all variables are masked.
+        loc_id, time, variables = self._read_orthomulti_cell(
+            cell, params, start=start, end=end)
+
+        return RaggedCellData.from_orthomulti(np.ma.getdata(loc_id), time,
+                                              variables)
+
+    def read_cell(self, cell, param='sm', start=None, end=None):
         """
-        Reads a single variable for all points of a cell.
+        Reads one or multiple variables for all points of a cell.
+        All variables are read from the file in a single pass.
 
         Parameters
         ----------
@@ -304,50 +1137,47 @@ class OrthoMultiTsCellReaderMixin:
             Cell number, will look for a file <cell>.nc that must exist.
             The file must contain a variable `location_id` and `time`.
             Time must have an attribute of form '<unit> since <refdate>'
-        param: str, optional (default: 'sm')
-            Variable to extract from files
+        param: str or list, optional (default: 'sm')
+            Variable(s) to extract from files
+        start: datetime or str, optional (default: None)
+            First time stamp to read, None to read from the beginning (or
+            from `clip_dates`, if the reader has them).
+            Only the data in the selected period is read from the file.
+        end: datetime or str, optional (default: None)
+            Last time stamp to read, None to read until the end (or
+            until `clip_dates`, if the reader has them).
 
         Returns
         -------
-        df: pd.DataFrame
-            A data frame holding all data for the cell.
+        df: pd.DataFrame or dict
+            A data frame holding all data for the cell if a single variable
+            is passed, otherwise a dict of data frames (with the same index
+            and columns) with the variable names as keys.
         """
+        loc_id, time, variables = self._read_orthomulti_cell(
+            cell, np.atleast_1d(param), start=start, end=end)
 
-        try:
-            fnformat = getattr(self, 'fn_format') + '.nc'
-        except AttributeError:
-            fnformat = "{:04d}.nc"
-
-        file_path = os.path.join(self.path, fnformat.format(cell))
-
-        with nc.Dataset(file_path) as ncfile:
-            loc_id = ncfile.variables['location_id'][:]
-            time = ncfile.variables['time'][:]
-            unit_time = ncfile.variables['time'].units
-            delta = lambda t: timedelta(t)
-            vfunc = np.vectorize(delta)
-            since = pd.Timestamp(unit_time.split('since ')[1])
-            time = since + vfunc(time)
-
-            variable = ncfile.variables[param][:]
+        data = {}
+        for p, variable in variables.items():
             variable = np.transpose(variable)
-            data = pd.DataFrame(variable, columns=loc_id, index=time)
-
-        if hasattr(self, 'clip_dates') and self.clip_dates:
-            if hasattr(self, '_clip_dates'):
-                data = self._clip_dates(data)
-            else:
-                warnings.warn("No method `_clip_dates` found.")
+            data[p] = pd.DataFrame(variable, columns=loc_id, index=time)
 
-        return data
+        if isinstance(param, str):
+            return data[param]
+        else:
+            return data
 
-    def read_cells(self, cells, param=None):
+    def read_cells(self, cells, param=None, gpis=None):
         """
         Read all data for one or multiple cells as a data frame.
         Can read multiple parameters at once, and will return a dataframe
         with a MultiIndex as columns.
-        This will iterate over each point in each cell. So it is much slower
-        than the `read_cell_file` function!
+        Each cell file is opened once and only the rows of the selected
+        points are read (neighbouring rows at once), if the read() function
+        of the reader passes `cell_data` to _read_cached_ts() (see
+        `_reads_cell_data`). For other readers and readers with an exact
+        index, this will read each point in each cell from the file, which
+        is much slower.
 
         Parameters:
         -----------
@@ -356,16 +1186,58 @@ class OrthoMultiTsCellReaderMixin:
         params: list or str, optional (default: None)
             Parameter(s) to read from the file.
             If None are passed, all are selected.
+        gpis: list or np.ndarray, optional (default: None)
+            Points to read, points that are not in the passed cells are
+            ignored. If None are passed, all points in the cells are read.
         """
+        cells = np.atleast_1d(cells)
+
         cell_data = []
-        gpis, lons, lats = self.grid.grid_points_for_cell(list(cells))
-        for gpi, lon, lat in zip(gpis, lons, lats):
-            df = self.read(lon, lat)
-            if param is not None:
-                df = df[np.atleast_1d(param)]
-            df.columns = pd.MultiIndex.from_tuples((gpi, c) for c in df.columns)
-            if not df.empty:
-                cell_data.append(df)
+
+        if (not self._reads_cell_data) or \
+                (hasattr(self, 'exact_index') and self.exact_index):
+            cell_gpis, lons, lats = self.grid.grid_points_for_cell(
+                list(cells))
+            if gpis is not None:
+                sel = np.isin(cell_gpis, gpis)
+                cell_gpis, lons, lats = \
+                    cell_gpis[sel], lons[sel], lats[sel]
+            for gpi, lon, lat in zip(cell_gpis, lons, lats):
+                df = self.read(lon, lat)
+                if param is not None:
+                    df = df[np.atleast_1d(param)]
+                df.columns = pd.MultiIndex.from_tuples(
+                    (gpi, c) for c in df.columns)
+                if not df.empty:
+                    cell_data.append(df)
+        else:
+            for cell in cells:
+                cell_gpis = self.grid.grid_points_for_cell(cell)[0]
+                if gpis is not None:
+                    cell_gpis = cell_gpis[np.isin(cell_gpis, gpis)]
+                if (len(cell_gpis) == 0) or \
+                        not os.path.isfile(self._cell_file_path(cell)):
+                    continue
+
+                loc_id, time, variables = self._read_orthomulti_cell(
+                    cell, getattr(self, 'parameters', None), gpis=cell_gpis)
+                loc_index = {gpi: i for i, gpi in
+                             enumerate(np.ma.getdata(loc_id))}
+
+                # Points are passed through the reader's read() chain, so
+                # that all post-processing is applied, but the data comes
+                # from the bulk read above.
+                for gpi in cell_gpis:
+                    if gpi not in loc_index:
+                        continue
+                    df = self.read(gpi,
+                                   cell_data=(loc_index, time, variables))
+                    if param is not None:
+                        df = df[np.atleast_1d(param)]
+                    df.columns = pd.MultiIndex.from_tuples(
+                        (gpi, c) for c in df.columns)
+                    if not df.empty:
+                        cell_data.append(df)
 
         if len(cell_data) == 0:
             return pd.DataFrame()
@@ -377,7 +1249,6 @@ class OrthoMultiTsCellReaderMixin:
             return pd.concat(cell_data, axis=axis)
 
 
-
 if __name__ == '__main__':
     from io_utils.data.read.geo_ts_readers import GriddedNcContiguousRaggedTsCompatible, SmecvTs
     from smecv_grid.grid import SMECV_Grid_v052
@@ -42,8 +42,14 @@ class SMAPTs(GriddedNcOrthoMultiTs, OrthoMultiTsCellReaderMixin):
         df = df[df.index.notnull()]
         return  df
 
+    # read_cells() passes the cell data to read(), see _read_cached_ts()
+    _reads_cell_data = True
+
     def read(self, *args, **kwargs):
-        df = super(SMAPTs, self).read(*args, **kwargs)
+        # Points in cached or preloaded cells are read from memory
+        df = self._read_cached_ts(*args, **kwargs)
+        if df is None:
+            df = super(SMAPTs, self).read(*args, **kwargs)
         if self.exact_index:
             df = self._to_datetime(df)
         return df
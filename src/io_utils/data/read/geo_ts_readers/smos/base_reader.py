@@ -52,8 +52,14 @@ class SMOSTs(GriddedNcOrthoMultiTs, OrthoMultiTsCellReaderMixin):
         df = df[df.index.notnull()]
         return df
 
+    # read_cells() passes the cell data to read(), see _read_cached_ts()
+    _reads_cell_data = True
+
     def read(self, *args, **kwargs):
-        df = super(SMOSTs, self).read(*args, **kwargs)
+        # Points in cached or preloaded cells are read from memory
+        df = self._read_cached_ts(*args, **kwargs)
+        if df is None:
+            df = super(SMOSTs, self).read(*args, **kwargs)
         if self.exact_index:
             df = self._to_datetime(df)
 
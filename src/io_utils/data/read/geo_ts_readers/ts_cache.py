@@ -0,0 +1,257 @@
+"""
+On-disk cache for the processed time series of GeoTsReader.
+"""
+
+import os
+import json
+import hashlib
+import threading
+import types
+import warnings
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import netCDF4 as nc
+from pygeogrids.grids import BasicGrid
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+# netCDF/HDF5 files must not be accessed from multiple threads at once.
+# All netCDF I/O that can run in parallel threads holds this lock, e.g.
+# the cache files here and the prefetching of cell readers.
+nc_lock = threading.RLock()
+
+
+def _token(obj, depth=0) -> str:
+    # A string that describes the object and is the same in each session
+    # (unlike e.g. the repr of most objects, which contains their address).
+    if depth > 10:
+        return type(obj).__qualname__
+
+    if obj is None or isinstance(obj, (bool, int, float, str, bytes)):
+        return repr(obj)
+    elif isinstance(obj, np.generic):
+        return repr(obj.item())
+    elif isinstance(obj, dict):
+        items = sorted([f"{_token(k, depth + 1)}:{_token(v, depth + 1)}"
+                        for k, v in obj.items()])
+        return '{' + ','.join(items) + '}'
+    elif isinstance(obj, (set, frozenset)):
+        return '{' + ','.join(sorted([_token(v, depth + 1)
+                                      for v in obj])) + '}'
+    elif isinstance(obj, (list, tuple)):
+        return '[' + ','.join([_token(v, depth + 1) for v in obj]) + ']'
+    elif isinstance(obj, np.ndarray):
+        data = hashlib.sha1(np.ascontiguousarray(obj).tobytes()).hexdigest()
+        return f"array({obj.dtype},{obj.shape},{data})"
+    elif isinstance(obj, BasicGrid):
+        # the kd-tree etc. are built on demand, only the points matter
+        arrays = [obj.arrlon, obj.arrlat, obj.activegpis,
+                  getattr(obj, 'activearrcell', None)]
+        return f"{type(obj).__qualname__}({_token(arrays, depth + 1)})"
+    elif isinstance(obj, (type, types.FunctionType, types.BuiltinFunctionType,
+                          types.MethodType, np.ufunc)):
+        return f"{getattr(obj, '__module__', '')}.{obj.__qualname__}" \
+            if hasattr(obj, '__qualname__') else obj.__name__
+    elif hasattr(obj, '__dict__'):
+        attrs = {k: v for k, v in vars(obj).items() if not k.startswith('_')}
+        return f"{type(obj).__qualname__}({_token(attrs, depth + 1)})"
+    else:
+        return type(obj).__qualname__
+
+
+def config_key(*settings) -> str:
+    """
+    Create a stable hash for the passed reader settings.
+
+    Objects are described by their type and public attributes, functions and
+    classes by their (qualified) name. Note that therefore e.g. all lambda
+    functions in a module give the same hash.
+
+    Parameters
+    ----------
+    settings:
+        Any objects that change the data that a reader returns.
+
+    Returns
+    -------
+    key: str
+        Hash of the settings.
+    """
+    return hashlib.sha1(_token(settings).encode('utf-8')).hexdigest()[:16]
+
+
+class ResultCache:
+    """
+    Stores processed time series in one netcdf file per cell, with a group
+    for each gpi that holds the time stamps and one variable per column.
+    A cell file is replaced when the source file that the data was read
+    from has changed (based on modification time and size).
+
+    The cache can be shared by multiple processes: a lock file per cell
+    (exclusive for writing, shared for reading) keeps processes from
+    accessing a cell file while it is changed. New cell files are written
+    to a temporary file first and then moved into place. File locks need
+    fcntl, i.e. they are not available on windows, where a cache must
+    only be used by a single process.
+
+    Parameters
+    ----------
+    path: str
+        Root directory of the cache.
+    key: str
+        Hash of the reader settings, see config_key(). Data for each key
+        is stored in a separate sub directory.
+    source_file: Callable
+        Function that returns the path to the source file for a cell.
+    """
+
+    def __init__(self, path, key, source_file):
+        self.path = os.path.join(path, key)
+        self.source_file = source_file
+
+        if fcntl is None:
+            warnings.warn("File locks are not available, the result cache "
+                          "must only be used by a single process.")
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.path})"
+
+    def _cache_file(self, cell) -> str:
+        return os.path.join(self.path, f"{int(cell):04d}.nc")
+
+    @contextmanager
+    def _locked(self, cell, shared=False):
+        # Lock the file of a cell for the threads of this process and
+        # (with a lock file) for other processes
+        with nc_lock:
+            if fcntl is None:
+                yield
+                return
+            os.makedirs(self.path, exist_ok=True)
+            with open(self._cache_file(cell) + '.lock', 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _source_state(self, cell) -> tuple or None:
+        # Modification time and size of the source file, or None
+        try:
+            stat = os.stat(self.source_file(cell))
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    @staticmethod
+    def _is_valid(ds, state) -> bool:
+        return (ds.getncattr('source_mtime_ns'),
+                ds.getncattr('source_size')) == state
+
+    def get(self, cell, gpi) -> pd.DataFrame or None:
+        """
+        Load the time series for a gpi from the cache.
+
+        Returns
+        -------
+        df: pd.DataFrame or None
+            Cached data, or None if it is not in the cache or outdated.
+        """
+        file_path = self._cache_file(cell)
+        if not os.path.exists(file_path):
+            return None
+        state = self._source_state(cell)
+
+        # outdated files are replaced by the next put()
+        with self._locked(cell, shared=True):
+            try:
+                with nc.Dataset(file_path) as ds:
+                    if (state is None) or not self._is_valid(ds, state) or \
+                            (str(gpi) not in ds.groups):
+                        return None
+                    grp = ds.groups[str(gpi)]
+                    grp.set_auto_mask(False)
+                    index = pd.DatetimeIndex(
+                        grp.variables['time'][:].astype('datetime64[ns]'),
+                        name=json.loads(grp.index_name))
+                    columns = json.loads(grp.columns)
+                    data = {c: grp.variables[f"v{i}"][:]
+                            for i, c in enumerate(columns)}
+            except OSError:  # e.g. left incomplete by a crashed process
+                return None
+
+        return pd.DataFrame(data, index=index, columns=columns)
+
+    def put(self, cell, gpi, df) -> bool:
+        """
+        Store the time series for a gpi in the cache.
+        Only data frames with a DatetimeIndex and numeric columns with
+        JSON-serializable names are stored.
+
+        Returns
+        -------
+        stored: bool
+            Whether the data was stored.
+        """
+        if not isinstance(df.index, pd.DatetimeIndex) or \
+                any([dtype.kind not in 'iuf' for dtype in df.dtypes]):
+            return False
+        try:
+            columns = json.dumps(list(df.columns))
+            index_name = json.dumps(df.index.name)
+        except TypeError:
+            return False
+
+        state = self._source_state(cell)
+        if state is None:
+            return False
+
+        file_path = self._cache_file(cell)
+        with self._locked(cell):
+            valid = False
+            if os.path.exists(file_path):
+                try:
+                    with nc.Dataset(file_path) as ds:
+                        valid = self._is_valid(ds, state)
+                except OSError:
+                    pass
+
+            if not valid:
+                # create the file completely before it replaces the old one
+                os.makedirs(self.path, exist_ok=True)
+                tmp_path = f"{file_path}.{os.getpid()}.tmp"
+                with nc.Dataset(tmp_path, 'w') as ds:
+                    ds.setncattr('source_mtime_ns', np.int64(state[0]))
+                    ds.setncattr('source_size', np.int64(state[1]))
+                os.replace(tmp_path, file_path)
+
+            with nc.Dataset(file_path, 'a') as ds:
+                if str(gpi) in ds.groups:
+                    return False
+                grp = ds.createGroup(str(gpi))
+                grp.createDimension('time', len(df.index))
+                time = grp.createVariable('time', 'i8', ('time',),
+                                          fill_value=False)
+                time[:] = df.index.values.astype('datetime64[ns]') \
+                    .astype('int64')
+                for i, (_, values) in enumerate(df.items()):
+                    grp.createVariable(f"v{i}", values.dtype, ('time',),
+                                       zlib=True, fill_value=False)[:] = \
+                        values.values
+                grp.columns = columns
+                grp.index_name = index_name
+
+        return True
+
+    def clear(self):
+        """ Remove all cached data for the settings """
+        if not os.path.exists(self.path):
+            return
+        for f in os.listdir(self.path):
+            if f.endswith('.nc'):
+                with self._locked(int(f[:-len('.nc')])):
+                    os.remove(os.path.join(self.path, f))
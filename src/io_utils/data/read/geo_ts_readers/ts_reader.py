@@ -6,12 +6,20 @@ Combines dataset config readers, adapters and some more features for all readers
 
 # TODO: pass multiple selfmasking adapters that are applied sequentially?
 
+import os
 import pandas as pd
 import numpy as np
-from io_utils.utils import filter_months, ddek
+from io_utils.utils import filter_months, ddek, split_by_weight
 import warnings
+import threading
+import time
+import types
+import functools
+from contextlib import contextmanager, nullcontext
 from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor
 import io_utils.data.read.geo_ts_readers.adapters as _geoadapters
+from io_utils.data.read.geo_ts_readers.ts_cache import ResultCache, config_key
 
 
 def load_settings(setts_file):
@@ -20,6 +28,79 @@ def load_settings(setts_file):
     return settings
 
 
+class StageTimer:
+    """
+    Collects the wall time and the number of calls of named stages.
+    The time of a stage does not include the time of other stages that
+    are nested in it (in the same thread).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._local = threading.local()  # open stages of each thread
+
+    def reset(self):
+        """ Remove all collected times """
+        with self._lock:
+            self._stats = {}
+
+    def add(self, name, seconds):
+        """ Add a call of a stage that took the passed time """
+        with self._lock:
+            calls, total = self._stats.get(name, (0, 0.))
+            self._stats[name] = (calls + 1, total + seconds)
+
+    @contextmanager
+    def stage(self, name):
+        """ Time the code in the with block as a call of a stage """
+        if not hasattr(self._local, 'nested'):
+            self._local.nested = []
+        # time of the stages in this one, per thread
+        nested = self._local.nested
+        nested.append(0.)
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - t0
+            inner = nested.pop()
+            if len(nested) > 0:
+                nested[-1] += seconds
+            self.add(name, seconds - inner)
+
+    def wrap(self, name, func):
+        """ Time each call of the passed function as a call of a stage """
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            with self.stage(name):
+                return func(*args, **kwargs)
+        return timed
+
+    def seconds(self, prefix='') -> float:
+        """ Total time of all stages whose name starts with prefix """
+        with self._lock:
+            return sum([total for name, (_, total) in self._stats.items()
+                        if name.startswith(prefix)])
+
+    def to_dict(self) -> dict:
+        """ Number of calls and total time [s] for each stage """
+        with self._lock:
+            return {name: {'calls': calls, 'time': total}
+                    for name, (calls, total) in self._stats.items()}
+
+    def to_frame(self) -> pd.DataFrame:
+        """ Number of calls, total and mean time [s] for each stage """
+        df = pd.DataFrame.from_dict(self.to_dict(), orient='index',
+                                    columns=['calls', 'time'])
+        df.index.name = 'stage'
+        df['mean'] = df['time'] / df['calls']
+        return df
+
+
+_no_timing = nullcontext()
+
+
 class GeoTsReader:
 
     def __init__(self,
@@ -30,7 +111,10 @@ class GeoTsReader:
                  resample=None,
                  filter_months=None,
                  params_rename=None,
-                 remove_nans=None):
+                 remove_nans=None,
+                 timing=False,
+                 cache_path=None,
+                 lazy=False):
 
         """
         Collects geopath-readers and calls them based on the dataset name,
@@ -75,6 +159,24 @@ class GeoTsReader:
                 - dict of form {parameter : val_to_set_NaN ...}
                 - A number to replace this number with nan anywhere
                 - None to do nothing
+        timing : bool, optional (default: False)
+            Collect the time and number of calls for each stage of reading
+            (reading from the base reader, each adapter, nan removal, month
+            filtering, resampling, renaming), see timings. Can also be
+            switched later with enable_timing().
+        cache_path : str, optional (default: None)
+            Directory where the processed time series that read() returns
+            for a gpi are stored. Repeated reads (also in later sessions)
+            with the same reader settings take the data from there,
+            without reading and adapting it again. The data for a cell is
+            removed from the cache when the source cell file changes.
+            Only works for readers with cell files and when read() is
+            called with a gpi or lon/lat only.
+        lazy : bool, optional (default: False)
+            Create the base reader and the adapters only when they are
+            first used. Pickled readers only contain the settings, and are
+            always lazy after unpickling, so they can be sent to other
+            processes cheaply.
         """
 
         if reader_kwargs is None:
@@ -85,6 +187,14 @@ class GeoTsReader:
                 reader_kwargs['network'].lower() in ['all', 'none']:
                 reader_kwargs['network'] = None
 
+        # to create the same reader again, e.g. in other processes
+        self._init_kwargs = dict(
+            cls=cls, reader_kwargs=reader_kwargs,
+            read_func_name=read_func_name, adapters=adapters,
+            resample=resample, filter_months=filter_months,
+            params_rename=params_rename, remove_nans=remove_nans,
+            cache_path=cache_path)
+
         self.reader_kwargs = reader_kwargs
         self.read_func_name = read_func_name
         self.params_rename = params_rename
@@ -99,16 +209,66 @@ class GeoTsReader:
 
         self.adapters = adapters
 
-        cls = cls(**self.reader_kwargs)
+        self._base_reader = None  # the unadaptered input reader
+        self._reader = None  # the adapted reader to use
+        self._grid = None
 
-        self.grid = cls.grid if hasattr(cls, 'grid') else None
+        if cache_path is not None:
+            key = config_key(self._init_kwargs['cls'], reader_kwargs,
+                             read_func_name, adapters, resample,
+                             filter_months, params_rename, remove_nans)
+            self._cache = ResultCache(cache_path, key, self._source_file)
+        else:
+            self._cache = None
 
-        self.base_reader = cls # the unadaptered input reader
-        self._adapt(self.base_reader) # the adapted reader to use
+        self._stage_timer = StageTimer()
+        self._timer = None  # only set while timing is enabled
+        self.enable_timing(timing)
 
+        if not lazy:
+            self._setup()
 
         setattr(self, read_func_name, self._read)
 
+    def _setup(self):
+        """ Create the base reader and the adapters """
+        cls = self._init_kwargs['cls'](**self.reader_kwargs)
+
+        self._grid = cls.grid if hasattr(cls, 'grid') else None
+
+        self._base_reader = cls
+        self._adapt(self._base_reader)
+
+        self.enable_timing(self._timer is not None)
+
+    @property
+    def base_reader(self):
+        """ The unadaptered input reader """
+        if self._base_reader is None:
+            self._setup()
+        return self._base_reader
+
+    @property
+    def reader(self):
+        """ The adapted reader to use """
+        if self._reader is None:
+            self._setup()
+        return self._reader
+
+    @property
+    def grid(self):
+        if self._base_reader is None:
+            self._setup()
+        return self._grid
+
+    def __getstate__(self) -> dict:
+        # Only the settings, readers are created again when they are used
+        return {'init_kwargs': self._init_kwargs,
+                'timing': self._timer is not None}
+
+    def __setstate__(self, state):
+        self.__init__(**state['init_kwargs'], timing=state['timing'],
+                      lazy=True)
 
     @property
     def parameters(self):
@@ -127,6 +287,41 @@ class GeoTsReader:
         return '{} with {}'.format(reader_class_str, adapters_str)
 
 
+    def enable_timing(self, enable=True):
+        """
+        Start or stop collecting the time and number of calls for each
+        stage of reading. Stopping keeps the collected times.
+
+        Parameters
+        ----------
+        enable : bool, optional (default: True)
+            Whether to collect times.
+        """
+        self._timer = self._stage_timer if enable else None
+        if self._reader is None:
+            return  # adapters are wrapped when they are created
+
+        names = ['BasicAdapter'] + list((self.adapters or {}).keys())
+        for name, adapter in zip(names, self._adapter_chain()):
+            # the timed version shadows the method of the adapter instance
+            adapter.__dict__.pop('_adapt', None)
+            if enable:
+                adapter._adapt = self._timer.wrap(f'adapter:{name}',
+                                                  adapter._adapt)
+
+    @property
+    def timings(self) -> pd.DataFrame:
+        """
+        Number of calls, total and mean time [s] for each stage of reading
+        since the last reset. Time spent in the adapters is not included
+        in the time for reading from the base reader.
+        """
+        return self._stage_timer.to_frame()
+
+    def reset_timings(self):
+        """ Remove all collected times, see timings """
+        self._stage_timer.reset()
+
     def _adapt(self, reader):
         """ Apply adapters to reader, e.g. anomaly adapter, mask adapter, ... """
         reader = _geoadapters.BasicAdapter(reader, read_name=self.read_func_name)
@@ -145,31 +340,73 @@ class GeoTsReader:
                 reader = Adapter(reader, read_name=self.read_func_name,
                                  **adapter_kwargs)
 
-        self.reader = reader
+        self._reader = reader
+
+    def _source_file(self, cell) -> str:
+        """ Path to the cell file that the base reader reads """
+        if hasattr(self.base_reader, '_cell_file_path'):
+            return self.base_reader._cell_file_path(cell)
+        fn_format = getattr(self.base_reader, 'fn_format', '{:04d}') + '.nc'
+        return os.path.join(self.base_reader.path, fn_format.format(cell))
 
     def _read(self, *args, **kwargs):
         """ Read data for a location, by gpi or by lonlat """
+        if (self._cache is None) or (self.grid is None) or kwargs or \
+                (len(args) not in [1, 2]):
+            return self._read_processed(*args, **kwargs)
+
+        if len(args) == 2:
+            gpi = self.grid.find_nearest_gpi(*args)[0]
+        else:
+            gpi = args[0]
+        cell = self.grid.gpi2cell(gpi)
+
+        with self._stage('cache'):
+            df = self._cache.get(cell, gpi)
+        if df is None:
+            df = self._read_processed(gpi)
+            with self._stage('cache'):
+                self._cache.put(cell, gpi, df)
+
+        return df
+
+    def _read_processed(self, *args, **kwargs):
+        """ Read and process data for a location, by gpi or by lonlat """
+        # the adapters are nested stages, i.e. not included in 'read'
+        with self._stage('read'):
+            df: pd.DataFrame = getattr(self.reader,
+                                       self.read_func_name)(*args, **kwargs)
 
-        df: pd.DataFrame = getattr(self.reader,
-                                   self.read_func_name)(*args, **kwargs)
+        return self._postprocess(df)
 
+    def _stage(self, name):
+        """ Context to time a stage of reading, if timing is enabled """
+        return _no_timing if self._timer is None else self._timer.stage(name)
+
+    def _postprocess(self, df):
+        """ Filter, resample and rename the adapted data for a location """
         if self.remove_nans:
-            if isinstance(self.remove_nans, (int, float)):
-                df = df.replace(self.remove_nans, np.nan)
-            else:
-                df = df.replace(self.remove_nans)
+            with self._stage('remove_nans'):
+                if isinstance(self.remove_nans, (int, float)):
+                    df = df.replace(self.remove_nans, np.nan)
+                else:
+                    df = df.replace(self.remove_nans)
 
         # filtering is done after adapting
         if self.filter_months is not None:
-            df = filter_months(df, months=self.filter_months, dropna=False)
+            with self._stage('filter_months'):
+                df = filter_months(df, months=self.filter_months,
+                                   dropna=False)
 
         # Resampling is done AFTER reading the original data, masking, climadapt.etc
         if self.resample is not None:
-            df = self._resample(df)
+            with self._stage('resample'):
+                df = self._resample(df)
 
         # Renaming is done last.
         if self.params_rename is not None:
-            df.rename(columns=self.params_rename, inplace=True)
+            with self._stage('rename'):
+                df.rename(columns=self.params_rename, inplace=True)
 
         return df
 
@@ -178,7 +415,10 @@ class GeoTsReader:
         df = df.select_dtypes(np.number)
 
         if self.resample[0].lower() == 'ddekad':
-            groups = df.groupby(ddek)
+            # labels for all time stamps at once (passing the function
+            # would call it for each time stamp)
+            groups = df.groupby(pd.DatetimeIndex(ddek(df.index),
+                                                 name=df.index.name))
         else:
             groups = None
 
@@ -196,7 +436,160 @@ class GeoTsReader:
 
         return df
 
-    def read_multiple(self, locs, var='sm', dtype='float32', verbose=False):
+    def _adapter_chain(self) -> list:
+        """ All adapter layers around the base reader, innermost first """
+        chain = []
+        reader = self.reader
+        while reader is not self.base_reader:
+            chain.insert(0, reader)
+            reader = reader.cls
+        return chain
+
+    def _cell_mode_supported(self) -> bool:
+        """
+        Whether reading cells gives the same time series as read(). The
+        dtypes, scale factors and offsets of the base reader are applied to
+        the cell data, other changes of single time series are not.
+        """
+        base = self.base_reader
+        if (self.read_func_name != 'read') or \
+                getattr(base, 'exact_index', False) or \
+                not hasattr(base, '_apply_dtypes_scaling'):
+            return False
+        # time stamps without data are NaN in cells
+        dtypes = getattr(base, 'dtypes', None) or {}
+        return all([np.dtype(d).kind == 'f' for d in dtypes.values()])
+
+    def _read_cell_multiple(self, cell, gpis, var, dtype) -> dict:
+        """
+        Read the selected gpis of a cell from a single cell file read.
+
+        The dtypes, scale factors and offsets of the base reader are
+        applied as for single time series. Without adapters, nan removal,
+        month filtering and resampling are applied to the (time x gpi)
+        frame of each variable. Adapters work on single time series, so
+        they (and the remaining steps) are applied to the data of each
+        gpi, which is taken from the cell data in memory.
+
+        Returns
+        -------
+        data : dict
+            Data frame (time x gpi) for each (renamed) variable in var.
+        """
+        rename = self.params_rename or {}
+        inv_rename = {new: old for old, new in rename.items()}
+        var_params = [inv_rename.get(v, v) for v in var]
+
+        if self.adapters:
+            # adapters might need other variables than the selected ones
+            params = self.base_reader.parameters
+            if params is None:
+                params = var_params
+        else:
+            params = var_params
+
+        with self._stage('read_cell'):
+            ragged = self.base_reader.read_agg_cell_data(
+                cell, list(params), format='ragged')
+
+        data = {}
+        if not self.adapters:
+            for v, p in zip(var, var_params):
+                df = ragged.to_dense(p, fill_value=np.nan)
+                df = df[[gpi for gpi in gpis if gpi in df.columns]]
+                df = self.base_reader._apply_dtypes_scaling(df, param=p)
+                if self.remove_nans:
+                    with self._stage('remove_nans'):
+                        if isinstance(self.remove_nans, (int, float)):
+                            df = df.replace(self.remove_nans, np.nan)
+                        elif p in self.remove_nans:
+                            df = df.replace(self.remove_nans[p])
+                if self.filter_months is not None:
+                    with self._stage('filter_months'):
+                        df = filter_months(df, months=self.filter_months,
+                                           dropna=False)
+                if self.resample is not None:
+                    with self._stage('resample'):
+                        df = self._resample(df)
+                data[v] = df.astype(dtype)
+        else:
+            chain = self._adapter_chain()
+            gpidict = ragged.to_gpidict()
+            data = {v: [] for v in var}
+            for gpi in gpis:
+                if gpi not in gpidict:
+                    continue
+                # adapters might change the data in place
+                df = self.base_reader._apply_dtypes_scaling(
+                    gpidict[gpi].copy())
+                for adapter in chain:
+                    df = adapter._adapt(df)
+                df = self._postprocess(df)
+                if df.empty:
+                    continue
+                for v in var:
+                    data[v].append(
+                        df[[v]].rename(columns={v: gpi}).astype(dtype))
+            data = {v: pd.concat(d, axis=1) if len(d) > 0 else None
+                    for v, d in data.items()}
+
+        return data
+
+    def _locs_by_cell(self, locs, max_dist=np.inf) -> dict:
+        """
+        Find the gpis for the passed locations (all lon/lat pairs are
+        looked up at once) and group them by cell.
+
+        Parameters
+        ----------
+        locs : list
+            Either a set of locations [gpi,...] or [(lon, lat), ...]
+        max_dist : float, optional (default: np.inf)
+            Maximum distance [m] between a lon/lat location and its gpi,
+            locations without a gpi in this distance are skipped.
+
+        Returns
+        -------
+        gpis : dict
+            Cells (in the order they first occur in locs) and the gpis
+            (in the order of locs) in each cell.
+        """
+        locs = list(locs)
+        is_lonlat = np.array([isinstance(loc, Iterable) for loc in locs],
+                             dtype=bool)
+
+        gpis = np.zeros(len(locs), dtype='int64')
+        valid = np.ones(len(locs), dtype=bool)
+
+        if np.any(is_lonlat):
+            lonlats = np.array([locs[i] for i in np.flatnonzero(is_lonlat)],
+                               dtype='float64').reshape(-1, 2)
+            nearest, dist = self.grid.find_nearest_gpi(
+                lonlats[:, 0], lonlats[:, 1], max_dist=max_dist)
+            found = np.isfinite(dist)
+            if not np.all(found):
+                warnings.warn(f"No gpi found within {max_dist} m for "
+                              f"{np.sum(~found)} locations. Skip them.")
+            gpis[is_lonlat] = nearest
+            valid[is_lonlat] = found
+        if not np.all(is_lonlat):
+            gpis[~is_lonlat] = [locs[i] for i in np.flatnonzero(~is_lonlat)]
+
+        gpis = gpis[valid]
+        if gpis.size == 0:
+            return {}
+
+        cells = np.atleast_1d(self.grid.gpi2cell(gpis))
+
+        # stable sort keeps the order of gpis within each cell
+        order = np.argsort(cells, kind='stable')
+        cells, first = np.unique(cells[order], return_index=True)
+        groups = np.split(gpis[order], first[1:])
+
+        return {cells[i]: groups[i] for i in np.argsort(order[first])}
+
+    def read_multiple(self, locs, var='sm', dtype='float32', verbose=False,
+                      mode='gpi', max_dist=np.inf, n_workers=1):
         """
         Read a list of locations, either from gpis, from lonlats or from a grid.
         Applies all the filtering and conversion from the reader generation.
@@ -210,8 +603,35 @@ class GeoTsReader:
         var : str or list, optional (default: 'sm')
             Variable to take from the dataframe that the read() function returns.
             If multiple are passed, then a dict is returned
+        dtype : str, optional (default: 'float32')
+            Data type of the returned time series.
         verbose: bool, optional (default: False)
             Print some messages
+        mode : str, optional (default: 'gpi')
+            * gpi:
+                Call the read() function for each location.
+            * cell:
+                Read each cell once via the read_agg_cell_data() function of
+                the base reader and take the time series of all locations
+                in the cell from it. This is much faster for many locations,
+                but only works for cell based readers. The dtypes, scale
+                factors and offsets of the base reader are applied as in
+                read(). Readers that change single time series in other
+                ways (e.g. exact index handling, integer dtypes) are read
+                in gpi mode instead. Time stamps where a location has no
+                data are NaN. Errors while reading a cell are raised.
+        max_dist : float, optional (default: np.inf)
+            Maximum distance [m] between a (lon, lat) location and the
+            nearest gpi, locations without a gpi in this distance are
+            skipped.
+        n_workers : int, optional (default: 1)
+            Number of processes to read the cells in parallel. Each worker
+            creates its own reader (with the same settings as this one)
+            once, the cells are split between the workers so that each one
+            reads about the same number of locations. All settings of the
+            reader must be picklable. There is no thread based option, as
+            netCDF/HDF5 files must not be read from multiple threads at
+            once.
 
         Returns
         -------
@@ -222,39 +642,100 @@ class GeoTsReader:
         if self.grid is None:
             raise ValueError("No grid found for the current reader.")
 
-        var = np.atleast_1d(var)
-        gpis = {}
+        if mode not in ['gpi', 'cell']:
+            raise ValueError(f"Unknown mode: {mode}, use 'gpi' or 'cell'")
 
-        for loc in locs:
-            if isinstance(loc, Iterable):
-                gpi = self.grid.find_nearest_gpi(*loc)[0]
-            else:
-                gpi = loc
+        if (mode == 'cell') and \
+                not hasattr(self.base_reader, 'read_agg_cell_data'):
+            raise ValueError(f"Reader {self.base_reader.__class__.__name__} "
+                             f"can not read cells, use mode='gpi'")
 
-            cell = self.grid.gpi2cell(gpi)
-            if cell not in gpis.keys():
-                gpis[cell] = []
-            else:
-                gpis[cell].append(gpi)
+        if (mode == 'cell') and not self._cell_mode_supported():
+            warnings.warn(f"Reader {self.base_reader.__class__.__name__} "
+                          f"changes single time series in ways that "
+                          f"mode='cell' does not support, use mode='gpi'.")
+            mode = 'gpi'
+
+        var = np.atleast_1d(var)
+        gpis = self._locs_by_cell(locs, max_dist=max_dist)
 
         if verbose:
             print(f'Read {len(locs)} locations in {len(list(gpis.keys()))} cells')
 
-        data = {v: [] for v in var}
+        if n_workers > 1 and len(gpis) > 1:
+            # cells with the most locations first, for an even split
+            cells = sorted(gpis, key=lambda c: len(gpis[c]), reverse=True)
+            part = split_by_weight([len(gpis[c]) for c in cells], n_workers)
+            chunks = [{c: gpis[c] for c, p in zip(cells, part) if p == j}
+                      for j in range(n_workers)]
+            chunks = [chunk for chunk in chunks if len(chunk) > 0]
+            with ProcessPoolExecutor(len(chunks), initializer=_init_worker,
+                                     initargs=(self._init_kwargs,)) \
+                    as executor:
+                futures = [executor.submit(_read_grouped_in_worker, chunk,
+                                           var, dtype, verbose, mode)
+                           for chunk in chunks]
+                data = {}
+                for future in futures:
+                    data.update(future.result())
+        else:
+            data = self._read_grouped(gpis, var, dtype, verbose, mode)
+
+        # merge in the order of the cells
+        return {v: pd.concat([df for cell in gpis for df in data[cell][v]],
+                             axis=1, sort=True) for v in var}
+
+    def _read_grouped(self, gpis, var, dtype, verbose=False, mode='gpi') \
+            -> dict:
+        """
+        Read the time series for gpis grouped by cell, see read_multiple.
+
+        Returns
+        -------
+        data : dict
+            For each cell a dict of the data frames for each variable.
+        """
+        data = {}
 
         i = 0
+        n = sum([len(cell_gpis) for cell_gpis in gpis.values()])
         for cell, cell_gpis in gpis.items():
+            data[cell] = {v: [] for v in var}
+            if mode == 'cell':
+                if verbose:
+                    print(f'Reading cell {cell} with {len(cell_gpis)} locs')
+                cell_data = self._read_cell_multiple(
+                    cell, cell_gpis, var, dtype)
+                for v in var:
+                    if cell_data[v] is not None:
+                        data[cell][v].append(cell_data[v])
+                continue
+
             for gpi in cell_gpis:
                 if verbose:
-                    print(f'Reading loc {i} of {len(locs)}')
+                    print(f'Reading loc {i} of {n}')
                 try:
                     df = self._read(gpi)
                     for v in var:
                         if not df.empty:
-                            data[v].append(df[[v]].rename(columns={v: gpi}).astype(dtype))
+                            data[cell][v].append(
+                                df[[v]].rename(columns={v: gpi}).astype(dtype))
                 except:
                     warnings.warn(f'Reading TS for GPI {gpi} failed. Continue.')
                     continue
                 i += 1
 
-        return {n: pd.concat(d, axis=1, sort=True) for n, d in data.items()}
+        return data
+
+
+# Each worker process of read_multiple builds its own reader, as file
+# handles and caches of the readers can not be shared.
+_worker = types.SimpleNamespace()
+
+
+def _init_worker(init_kwargs):
+    _worker.reader = GeoTsReader(**init_kwargs)
+
+
+def _read_grouped_in_worker(gpis, var, dtype, verbose, mode):
+    return _worker.reader._read_grouped(gpis, var, dtype, verbose, mode)
@@ -8,19 +8,363 @@ os.environ['MKL_DYNAMIC'] = 'FALSE'
 os.environ['OPENBLAS_NUM_THREADS'] = '1'
 
 import numpy as np
+import pandas as pd
 from tqdm import tqdm
 import logging
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from multiprocessing import shared_memory
+import asyncio
 from datetime import datetime
 import sys
+import json
+import queue
+import threading
+import time
 from warnings import warn
+from pygeogrids.grids import CellGrid
+from io_utils.utils import gpis_per_cell
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
 
 # Note: Might not work under windows... Maybe with py 3.10?
 
+def _n_elements(ITER_KWARGS, STATIC_KWARGS) -> int:
+    # Check the passed kwargs and return the number of elements
+    n = np.array([len(v) for k, v in ITER_KWARGS.items()])
+    if len(n) == 0:
+        raise ValueError("No ITER_KWARGS passed")
+    if len(n) > 1:
+        if not np.all(np.diff(n) == 0):
+            raise ValueError(
+                "Different number of elements found in ITER_KWARGS."
+                f"All passed Iterable must have the same length."
+                f"Got: {n}")
+    n = n[0]
+
+    i1d = np.intersect1d(np.array(list(ITER_KWARGS.keys())),
+                         np.array(list(STATIC_KWARGS.keys())))
+    if len(i1d) > 0:
+        raise ValueError(
+            "Got duplicate(s) in ITER_KWARGS and STATIC_KWARGS. "
+            f"Must be unique. Duplicates: {i1d}")
+
+    return n
+
+
+def _element_key(kws) -> str:
+    # Identify an element by its kwargs from ITER_KWARGS
+    kws = {k: v.item() if isinstance(v, np.generic) else v
+           for k, v in kws.items()}
+    return json.dumps(kws, sort_keys=True, default=str)
+
+
+class Checkpoint:
+    """
+    Append-only record of the elements of a run that were processed, with
+    one JSON line per element. Each line is written to disk before the
+    next element is recorded, so that a crashed run can be resumed.
+
+    Parameters
+    ----------
+    path: str
+        Path to the checkpoint file, is created if it does not exist.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.status = {}  # key: (status, error) of the last record
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as f:
+            content = f.read()
+        for line in content.splitlines():
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # line that was only partly written in a crash
+            self.status[entry['key']] = (entry['status'], entry.get('error'))
+        if content and not content.endswith('\n'):
+            with open(self.path, 'a') as f:
+                f.write('\n')
+
+    def done(self, key) -> bool:
+        """ Whether the element was processed successfully """
+        return self.status.get(key, (None, None))[0] == 'ok'
+
+    def record(self, key, error=None):
+        """ Add the status of a processed element (failed if error) """
+        entry = {'key': key, 'status': 'ok' if error is None else 'failed'}
+        if error is not None:
+            entry['error'] = repr(error)
+        with self._lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                        exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.status[key] = (entry['status'], entry.get('error'))
+
+    def failed(self) -> dict:
+        """
+        Elements whose last run failed, in the form of ITER_KWARGS, so
+        that they can be processed again on their own.
+        """
+        failed = [json.loads(key) for key, (status, _) in self.status.items()
+                  if status == 'failed']
+        names = sorted(set([k for kws in failed for k in kws]))
+        return {k: [kws.get(k) for kws in failed] for k in names}
+
+
+class Telemetry:
+    """
+    Collects the start and end time, CPU time, peak memory and worker
+    process of each element that is processed in a run.
+
+    The peak memory is the maximum resident set size of the worker
+    process up to the end of the element. Workers are reused, so it only
+    shows the memory of the element itself when it raised the peak (use
+    maxtasksperchild=1 for exact values per element).
+    The CPU time is the time of the worker process (or of the worker thread
+    for the thread and asyncio backends; with asyncio it includes other
+    tasks that ran while the element was awaiting).
+    """
+
+    columns = ['element', 'pid', 'start', 'end', 'wall', 'cpu',
+               'peak_rss_mb', 'failed']
+
+    def __init__(self):
+        self.records = []
+
+    def add(self, key, stats, error=None):
+        """ Add the stats of a processed element (failed if error) """
+        self.records.append({'element': key, **stats,
+                             'failed': error is not None})
+
+    @property
+    def table(self) -> pd.DataFrame:
+        """ One row per element, times in seconds """
+        df = pd.DataFrame(self.records, columns=[
+            c for c in self.columns if c != 'wall'])
+        df.insert(df.columns.get_loc('end') + 1, 'wall',
+                  df['end'] - df['start'])
+        for c in ['start', 'end']:
+            df[c] = pd.to_datetime(df[c], unit='s')
+        return df
+
+    def to_file(self, path):
+        """
+        Write the table to a .csv or .parquet file (needs pyarrow or
+        fastparquet).
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if path.endswith('.parquet'):
+            self.table.to_parquet(path, index=False)
+        else:
+            self.table.to_csv(path, index=False)
+
+    def summary(self, n=5) -> str:
+        """
+        Describe the n slowest and the n most memory-hungry elements.
+        """
+        df = self.table
+        if len(df) == 0:
+            return "No elements processed."
+        lines = [f"{len(df)} elements, wall time: total {df['wall'].sum():.1f}"
+                 f" s, median {df['wall'].median():.2f} s, CPU time: total "
+                 f"{df['cpu'].sum():.1f} s"]
+        for col, title, unit in [('wall', 'Slowest', 's'),
+                                 ('peak_rss_mb', 'Largest peak memory', 'MB')]:
+            lines.append(f"{title} elements:")
+            for _, row in df.nlargest(n, col).iterrows():
+                lines.append(f"  {row[col]:.2f} {unit} (pid {row['pid']}): "
+                             f"{row['element']}")
+        return '\n'.join(lines)
+
+
+class SharedArray:
+    """
+    Numpy array in shared memory (or in a memory-mapped file), that the
+    workers of apply_to_elements() write their results to directly, instead
+    of returning them. This avoids sending large arrays back to the main
+    process and keeping a copy of each one in the list of results.
+
+    Pass it via `shared_output`, workers then only open the existing
+    memory, e.g. for a global image stack with one cell per element:
+
+        out = SharedArray((n_time, n_lat, n_lon))
+        def FUNC(cell, out):
+            out[:, rows, cols] = read_cell(cell)  # rows/cols of the cell
+        apply_to_elements(FUNC, {'cell': cells},
+                          shared_output={'out': out}, n_proc=8)
+        stack = out.to_numpy()
+        out.close()
+
+    Elements must write to separate parts of the array, there is no
+    locking.
+
+    Parameters
+    ----------
+    shape: tuple
+        Shape of the array.
+    dtype: str or np.dtype, optional (default: 'float32')
+        Data type of the array.
+    fill_value: optional (default: np.nan)
+        Initial value of all elements. None leaves them as they are (zeros
+        for new memory / files).
+    path: str, optional (default: None)
+        Create a memory-mapped array in this file instead of using shared
+        memory, for outputs that do not fit into memory. The file is kept
+        after close().
+    """
+
+    def __init__(self, shape, dtype='float32', fill_value=np.nan, path=None):
+        self.shape = tuple([int(s) for s in np.atleast_1d(shape)])
+        self.dtype = np.dtype(dtype)
+        self.path = path
+        self._owner = True
+        self._shm = None
+
+        if path is None:
+            nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+            self._shm = shared_memory.SharedMemory(create=True,
+                                                   size=max(nbytes, 1))
+            self.name = self._shm.name
+            self._array = np.ndarray(self.shape, self.dtype,
+                                     buffer=self._shm.buf)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)),
+                        exist_ok=True)
+            self.name = path
+            self._array = np.memmap(path, self.dtype, 'w+', shape=self.shape)
+
+        if fill_value is not None:
+            self._array[...] = fill_value
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.name}, shape={self.shape}," \
+               f" dtype={self.dtype})"
+
+    def __getstate__(self):
+        # Only the description is sent to the workers, not the data
+        return {'shape': self.shape, 'dtype': self.dtype, 'path': self.path,
+                'name': self.name}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._owner = False
+        self._shm = None
+        self._array = None
+
+    def _attach(self):
+        # Open the existing array in a worker
+        if self.path is None:
+            self._shm = shared_memory.SharedMemory(name=self.name)
+            self._array = np.ndarray(self.shape, self.dtype,
+                                     buffer=self._shm.buf)
+        else:
+            self._array = np.memmap(self.path, self.dtype, 'r+',
+                                    shape=self.shape)
+
+    @property
+    def array(self) -> np.ndarray:
+        """ View of the shared data """
+        if self._array is None:
+            self._attach()
+        return self._array
+
+    def __getitem__(self, item):
+        return self.array[item]
+
+    def __setitem__(self, item, value):
+        self.array[item] = value
+
+    def to_numpy(self) -> np.ndarray:
+        """ Copy of the data, that remains available after close() """
+        return np.array(self.array)
+
+    def close(self):
+        """
+        Release the array. Shared memory is freed when this is called on
+        the object that created it (all views of the array become invalid).
+        """
+        if isinstance(self._array, np.memmap):
+            self._array.flush()
+        self._array = None
+        if self._shm is not None:
+            self._shm.close()
+            if self._owner:
+                self._shm.unlink()
+            self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _shared_output(shared_output, STATIC_KWARGS) -> dict:
+    # Check the passed shared outputs, a single array is passed as `output`
+    if shared_output is None:
+        return {}
+    elif isinstance(shared_output, SharedArray):
+        shared_output = {'output': shared_output}
+    for name, arr in shared_output.items():
+        if not isinstance(arr, SharedArray):
+            raise TypeError(f"shared_output '{name}' must be a SharedArray, "
+                            f"got {type(arr)}")
+    duplicates = set(STATIC_KWARGS).intersection(shared_output)
+    if len(duplicates) > 0:
+        raise ValueError(f"Got duplicate(s) in STATIC_KWARGS and "
+                         f"shared_output: {duplicates}")
+    return dict(shared_output)
+
+
+def _telemetry(telemetry) -> Telemetry or None:
+    if telemetry is True:
+        return Telemetry()
+    elif telemetry is None or telemetry is False:
+        return None
+    elif isinstance(telemetry, Telemetry):
+        return telemetry
+    else:
+        raise TypeError(f"telemetry must be a bool or Telemetry, "
+                        f"got {type(telemetry)}")
+
+
+def failed_elements(checkpoint) -> dict:
+    """
+    Read the elements that failed in a run from its checkpoint file.
+
+    Parameters
+    ----------
+    checkpoint: str
+        Path to the checkpoint file of the run.
+
+    Returns
+    -------
+    ITER_KWARGS: dict
+        Kwargs of the failed elements, can be passed to apply_to_elements()
+        or iter_apply_to_elements() to retry them.
+    """
+    return Checkpoint(checkpoint).failed()
+
+
 def apply_to_elements(
         FUNC, ITER_KWARGS, STATIC_KWARGS=None, n_proc=1,
         show_progress_bars=True, ignore_errors=False, log_path=None,
-        debug_mode=False,
+        debug_mode=False, initializer=None, initargs=(),
+        maxtasksperchild=None, checkpoint=None, costs=None, backend='process',
+        telemetry=None, shared_output=None,
 ):
     """
     Applies the passed function to all elements of the passed iterables.
@@ -50,6 +394,60 @@ def apply_to_elements(
         If provided, a log file is created in the passed directory.
     debug_mode: float, optional (default: False)
         Print logging messages to stdout, useful for debugging.
+    initializer: Callable, optional (default: None)
+        Function that is called once in each worker (with initargs) before
+        the first element is processed, to create objects that should be
+        reused for all elements, e.g. readers or grids. It must return a
+        dict (or None), whose items are passed to FUNC as additional
+        kwargs.
+    initargs: tuple, optional (default: ())
+        Arguments for the initializer.
+    maxtasksperchild: int, optional (default: None)
+        Number of elements after which a worker process is replaced by
+        a new one (that calls the initializer again), e.g. to free leaked
+        memory. None keeps workers for the whole run.
+    checkpoint: str, optional (default: None)
+        Path to a file where each processed element is recorded (with its
+        kwargs from ITER_KWARGS). When the function is called again with
+        the same file, elements that were processed successfully are
+        skipped (their results are not returned again). Failed elements
+        (with ignore_errors) are processed again, failed_elements() lists
+        them.
+    costs: list or Callable or CellGrid, optional (default: None)
+        Expected cost (e.g. run time) of each element. Elements are then
+        submitted largest first, so that the free workers take the
+        remaining smaller ones at the end. Either
+            - a list of costs, one for each element
+            - a function that takes the kwargs of an element (from
+              ITER_KWARGS) and returns its cost, e.g. the size of its
+              input file: lambda kws: os.path.getsize(kws['file'])
+            - a CellGrid to use the number of gpis in the `cell` of each
+              element (ITER_KWARGS must contain 'cell')
+        None processes the elements in the passed order.
+        How much of the time the workers were busy is logged at the end.
+    backend: str, optional (default: 'process')
+        How the n_proc workers run
+            - process: Separate processes, for CPU-bound work.
+            - thread: Threads in the current process, for I/O-bound work.
+              Objects in STATIC_KWARGS are shared by all workers (and not
+              copied). The initializer is called in each thread.
+              maxtasksperchild is ignored.
+            - asyncio: Coroutines on an event loop in a separate thread,
+              FUNC must be a coroutine function (async def), at most n_proc
+              elements are processed at once. The initializer is called
+              once. maxtasksperchild is ignored.
+    telemetry: Telemetry or bool, optional (default: None)
+        Record the start and end time, CPU time, peak memory and worker
+        PID of each element. Pass a Telemetry object to access the table
+        after the run, or True. A summary of the slowest and most
+        memory-hungry elements is logged at the end and, with `log_path`,
+        the table is written to a csv file next to the log file.
+    shared_output: dict or SharedArray, optional (default: None)
+        Output arrays in shared memory that FUNC writes its results to
+        (instead of returning them), see SharedArray. Items are passed to
+        FUNC as additional kwargs (a single array as `output`). They are
+        sent to each worker only once, and are shared (not copied) with
+        processes as well as threads.
 
     Returns
     -------
@@ -87,29 +485,27 @@ def apply_to_elements(
             datefmt="%Y-%m-%d %H:%M:%S",
         )
 
-    n = np.array([len(v) for k, v in ITER_KWARGS.items()])
-    if len(n) == 0:
-        raise ValueError("No ITER_KWARGS passed")
-    if len(n) > 1:
-        if not np.all(np.diff(n) == 0):
-            raise ValueError(
-                "Different number of elements found in ITER_KWARGS."
-                f"All passed Iterable must have the same length."
-                f"Got: {n}")
-    n = n[0]
+    shared_output = _shared_output(shared_output, STATIC_KWARGS)
+    n = _n_elements(ITER_KWARGS, {**STATIC_KWARGS, **shared_output})
 
-    i1d = np.intersect1d(np.array(list(ITER_KWARGS.keys())),
-                         np.array(list(STATIC_KWARGS.keys())))
-    if len(i1d) > 0:
-        raise ValueError(
-            "Got duplicate(s) in ITER_KWARGS and STATIC_KWARGS. "
-            f"Must be unique. Duplicates: {i1d}")
+    checkpoint = Checkpoint(checkpoint) if checkpoint is not None else None
+    telemetry = _telemetry(telemetry)
+    cpu_clock = _cpu_clock(backend, telemetry)
 
-    process_kwargs = []
-    for i in range(n):
+    process_kwargs, keys = [], []
+    for i in _by_cost(costs, ITER_KWARGS, range(n)):
         kws = {k: v[i] for k, v in ITER_KWARGS.items()}
+        key = _element_key(kws) \
+            if (checkpoint is not None) or (telemetry is not None) else None
+        if (checkpoint is not None) and checkpoint.done(key):
+            continue
         kws.update(STATIC_KWARGS)
         process_kwargs.append(kws)
+        keys.append(key)
+
+    if len(process_kwargs) < n:
+        logging.info(f"Skip {n - len(process_kwargs)} elements that were "
+                     f"processed before.")
 
     if show_progress_bars:
         pbar = tqdm(total=len(process_kwargs), desc=f"Processed")
@@ -118,39 +514,87 @@ def apply_to_elements(
 
     results = []
 
-    def update(r) -> None:
+    def update(r, key=None) -> None:
+        if checkpoint is not None:
+            checkpoint.record(key)
         if r is not None:
             results.append(r)
         if pbar is not None:
             pbar.update()
 
-    def error(e) -> None:
+    def error(e, key=None) -> None:
         logging.error(e)
+        if checkpoint is not None:
+            checkpoint.record(key, error=e)
         if not ignore_errors:
             raise e
         if pbar is not None:
             pbar.update()
 
-    if n_proc == 1:
-        for kwargs in process_kwargs:
+    busy, t0 = {}, time.perf_counter()
+
+    def collect(out, key=None) -> None:
+        pid, seconds, [(_, r, e, stats)] = out
+        busy[pid] = busy.get(pid, 0.) + seconds
+        if telemetry is not None:
+            telemetry.add(key, stats, e)
+        if e is not None:
+            error(e, key)
+        else:
+            update(r, key)
+
+    if n_proc == 1 and backend != 'asyncio':
+        _init_worker(FUNC, shared_output, initializer, initargs, cpu_clock)
+        for i, (kwargs, key) in enumerate(zip(process_kwargs, keys)):
+            collect(_call_chunk([(i, kwargs)]), key)
+        _clear_worker()
+    else:
+        pool, call_chunk = _make_pool(
+            backend, n_proc,
+            (FUNC, shared_output, initializer, initargs, cpu_clock),
+            maxtasksperchild)
+        # Errors in the callbacks must not reach the thread of the pool
+        # that runs them (the pool would hang, or they would be lost), they
+        # are raised here once the pool is stopped.
+        errors, lock, finished = [], threading.Lock(), threading.Event()
+        pending = [len(process_kwargs)]
+
+        def handle(func, *args) -> None:
             try:
-                r = FUNC(**kwargs)
-                update(r)
+                func(*args)
             except Exception as e:
-                error(e)
-    else:
+                errors.append(e)
+                finished.set()
+            with lock:
+                pending[0] -= 1
+                if pending[0] == 0:
+                    finished.set()
+
+        if len(process_kwargs) == 0:
+            finished.set()
 
-        with Pool(n_proc) as pool:
-            for kwds in process_kwargs:
+        with pool:
+            for i, (kwds, key) in enumerate(zip(process_kwargs, keys)):
                 pool.apply_async(
-                    FUNC,
-                    kwds=kwds,
-                    callback=update,
-                    error_callback=error,
+                    call_chunk,
+                    args=([(i, kwds)],),
+                    callback=lambda out, key=key: handle(collect, out, key),
+                    error_callback=lambda e, key=key: handle(error, e, key),
                 )
+            finished.wait()
+            if len(errors) > 0:
+                raise errors[0]
             pool.close()
             pool.join()
 
+    logging.info(_load_report(busy, time.perf_counter() - t0, n_proc))
+
+    if telemetry is not None:
+        logging.info(telemetry.summary())
+        if log_file:
+            telemetry.to_file(
+                f"{os.path.splitext(log_file)[0]}_telemetry.csv")
+
     if pbar is not None:
         pbar.close()
 
@@ -163,3 +607,425 @@ def apply_to_elements(
         handler.close()
 
     return results
+
+
+# Function, static kwargs and the objects from the initializer in each
+# worker (process or thread), shipped / created once per worker.
+_worker = threading.local()
+
+
+def _init_worker(FUNC, STATIC_KWARGS, initializer=None, initargs=(),
+                 cpu_clock=None):
+    _worker.FUNC = FUNC
+    _worker.STATIC_KWARGS = STATIC_KWARGS
+    _worker.cpu_clock = cpu_clock  # None: no telemetry
+
+    resources = initializer(*initargs) if initializer is not None else None
+    if resources is None:
+        resources = {}
+    elif not isinstance(resources, dict):
+        raise TypeError(f"The initializer must return a dict or None, "
+                        f"got {type(resources)}")
+    _worker.resources = resources
+
+
+def _clear_worker():
+    vars(_worker).clear()
+
+
+def _call_element(kws):
+    # Call the function for one element in the worker
+    return _worker.FUNC(**kws, **_worker.STATIC_KWARGS, **_worker.resources)
+
+
+def _peak_rss_mb() -> float:
+    # Maximum resident set size of the current process so far
+    if resource is None:
+        return np.nan
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 ** 2 if sys.platform == 'darwin' else rss / 1024
+
+
+def _task_start():
+    if _worker.cpu_clock is None:
+        return None
+    return time.time(), _worker.cpu_clock()
+
+
+def _task_stats(start) -> dict or None:
+    # Telemetry for an element that was started at `start`
+    if start is None:
+        return None
+    t_start, cpu = start
+    return {'pid': os.getpid(), 'start': t_start, 'end': time.time(),
+            'cpu': _worker.cpu_clock() - cpu, 'peak_rss_mb': _peak_rss_mb()}
+
+
+def _call_chunk(chunk) -> tuple:
+    # Call the function for each (index, kwargs) of the chunk, errors are
+    # returned, so that the other elements of the chunk are still processed.
+    # Also returns the worker and the time it took.
+    t0 = time.perf_counter()
+    results = []
+    for i, kws in chunk:
+        start = _task_start()
+        try:
+            r, e = _call_element(kws), None
+        except Exception as ex:
+            r, e = None, ex
+        results.append((i, r, e, _task_stats(start)))
+    worker = (os.getpid(), threading.get_ident())
+    return worker, time.perf_counter() - t0, results
+
+
+async def _acall_chunk(chunk) -> tuple:
+    # Like _call_chunk, for coroutine functions. The time includes waiting
+    # for other tasks on the event loop.
+    t0 = time.perf_counter()
+    results = []
+    for i, kws in chunk:
+        start = _task_start()
+        try:
+            r, e = await _call_element(kws), None
+        except Exception as ex:
+            r, e = None, ex
+        results.append((i, r, e, _task_stats(start)))
+    worker = (os.getpid(), threading.get_ident())
+    return worker, time.perf_counter() - t0, results
+
+
+class _AsyncioPool:
+    """
+    Runs coroutines on an event loop in a separate thread, with at most
+    n_proc at once. Has the parts of the interface of multiprocessing.Pool
+    that are used here.
+    """
+
+    def __init__(self, n_proc, initializer=None, initargs=()):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever,
+                                        daemon=True)
+        self._thread.start()
+        self._futures = set()
+        self._handled = []  # set when the callback of a task has run
+        self._errors = []  # raised by callbacks, see join()
+        self._n_proc = n_proc
+        self._semaphore = None
+        try:
+            asyncio.run_coroutine_threadsafe(
+                self._setup(initializer, initargs), self._loop).result()
+        except BaseException:
+            self.terminate()
+            raise
+
+    async def _setup(self, initializer, initargs):
+        # the semaphore must be created in the loop, the worker state is
+        # stored in the thread of the loop
+        self._semaphore = asyncio.Semaphore(self._n_proc)
+        if initializer is not None:
+            initializer(*initargs)
+
+    async def _run(self, func, args):
+        async with self._semaphore:
+            return await func(*args)
+
+    def apply_async(self, func, args=(), callback=None, error_callback=None):
+        future = asyncio.run_coroutine_threadsafe(self._run(func, args),
+                                                  self._loop)
+
+        handled = threading.Event()
+
+        def done(f):
+            try:
+                if f.cancelled():
+                    return
+                e = f.exception()
+                if e is None:
+                    if callback is not None:
+                        callback(f.result())
+                elif error_callback is not None:
+                    error_callback(e)
+            except Exception as ex:
+                # would be swallowed in the thread of the event loop
+                self._errors.append(ex)
+            finally:
+                handled.set()
+
+        self._handled.append(handled)
+        future.add_done_callback(done)
+        self._futures.add(future)
+        return future
+
+    def close(self):
+        pass
+
+    def join(self):
+        """ Wait for all tasks, raises the first error of a callback """
+        for handled in self._handled:
+            handled.wait()
+        if len(self._errors) > 0:
+            raise self._errors[0]
+
+    def terminate(self):
+        if self._loop.is_closed():
+            return
+        for future in self._futures:
+            future.cancel()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.terminate()
+
+
+def _cpu_clock(backend, telemetry):
+    # Clock for the CPU time of elements, None when there is no telemetry
+    if telemetry is None:
+        return None
+    return time.process_time if backend == 'process' else time.thread_time
+
+
+def _make_pool(backend, n_proc, initargs, maxtasksperchild=None):
+    # Create the worker pool for a backend and the function that processes
+    # a chunk in it.
+    if backend == 'process':
+        pool = Pool(n_proc, initializer=_init_worker, initargs=initargs,
+                    maxtasksperchild=maxtasksperchild)
+        return pool, _call_chunk
+    elif backend == 'thread':
+        return ThreadPool(n_proc, initializer=_init_worker,
+                          initargs=initargs), _call_chunk
+    elif backend == 'asyncio':
+        if not asyncio.iscoroutinefunction(initargs[0]):
+            raise TypeError("FUNC must be a coroutine function (async def) "
+                            "for the asyncio backend")
+        return _AsyncioPool(n_proc, initializer=_init_worker,
+                            initargs=initargs), _acall_chunk
+    else:
+        raise ValueError(f"Unknown backend: {backend}, use one of "
+                         f"'process', 'thread', 'asyncio'")
+
+
+def _by_cost(costs, ITER_KWARGS, indices) -> list:
+    # Sort the element indices by their cost, largest first
+    if costs is None:
+        return list(indices)
+
+    if isinstance(costs, CellGrid):
+        costs = gpis_per_cell(costs, ITER_KWARGS['cell'])
+
+    if callable(costs):
+        c = [costs({k: v[i] for k, v in ITER_KWARGS.items()})
+             for i in indices]
+    else:
+        c = [costs[i] for i in indices]
+
+    order = np.argsort(-np.asarray(c, dtype='float64'), kind='stable')
+    return [indices[i] for i in order]
+
+
+def _load_report(busy, wall, n_proc) -> str:
+    # Describe how evenly the work was spread over the workers
+    busy = np.array(list(busy.values())) if len(busy) > 0 else np.zeros(1)
+    usage = busy.sum() / (n_proc * wall) if wall > 0 else 1.
+    return (f"Processing took {wall:.1f} s, workers were busy "
+            f"{usage:.0%} of the time (busy time per worker: "
+            f"min {busy.min():.1f} s, max {busy.max():.1f} s)")
+
+
+def _chunks(ITER_KWARGS, indices, chunksize):
+    # Create the kwargs for the elements only when the chunk is submitted
+    for start in range(0, len(indices), chunksize):
+        yield [(i, {k: v[i] for k, v in ITER_KWARGS.items()})
+               for i in indices[start:start + chunksize]]
+
+
+def _submit_bounded(pool, call_chunk, chunks, max_pending, ordered):
+    # Submit chunks to the pool, so that at most `max_pending` chunks are
+    # processed or wait to be yielded, and yield the results of each chunk.
+    done = queue.Queue()
+    chunks = enumerate(chunks)
+    pending, buffer, next_chunk = 0, {}, 0
+    exhausted = False
+
+    while True:
+        while not exhausted and (pending + len(buffer) < max_pending):
+            try:
+                c, chunk = next(chunks)
+            except StopIteration:
+                exhausted = True
+                break
+            pool.apply_async(
+                call_chunk, (chunk,),
+                callback=lambda r, c=c: done.put((c, r)),
+                error_callback=lambda e, c=c: done.put((c, e)))
+            pending += 1
+
+        if pending == 0:
+            break
+
+        c, r = done.get()
+        pending -= 1
+        if isinstance(r, BaseException):
+            raise r
+
+        if not ordered:
+            yield r
+        else:
+            buffer[c] = r
+            while next_chunk in buffer:
+                yield buffer.pop(next_chunk)
+                next_chunk += 1
+
+
+def iter_apply_to_elements(
+        FUNC, ITER_KWARGS, STATIC_KWARGS=None, n_proc=1, chunksize=1,
+        max_pending=None, ordered=False, show_progress_bars=True,
+        ignore_errors=False, initializer=None, initargs=(),
+        maxtasksperchild=None, checkpoint=None, costs=None, backend='process',
+        telemetry=None, shared_output=None,
+):
+    """
+    Applies the passed function to all elements of the passed iterables,
+    like apply_to_elements(), but yields the results as they come in.
+    Tasks are created and submitted only when there is room for them, so
+    memory use does not grow with the number of elements.
+
+    Parameters
+    ----------
+    FUNC: Callable
+        Function to call.
+    ITER_KWARGS: dict
+        Container that holds iterables to split up and call in parallel with
+        FUNC, see apply_to_elements(). Iterables must support len() and
+        indexing.
+    STATIC_KWARGS: dict, optional (default: None)
+        Kwargs that are passed to FUNC in addition to each element in
+        ITER_KWARGS. They are sent to each worker only once.
+    n_proc: int, optional (default: 1)
+        Number of parallel workers. If 1, everything is done in the current
+        process.
+    chunksize: int, optional (default: 1)
+        Number of elements that are sent to a worker in one task. Larger
+        chunks reduce the overhead for many small tasks.
+    max_pending: int, optional (default: None)
+        Maximum number of chunks that are processed or whose results wait
+        to be yielded at any time. None uses 2 * n_proc.
+    ordered: bool, optional (default: False)
+        Yield the results in the order of the elements. Otherwise results
+        are yielded as soon as their chunk is finished.
+    show_progress_bars: bool, optional (default: True)
+        Show how many elements were processed already.
+    ignore_errors: bool, optional (default: False)
+        Log errors and continue with the other elements, instead of
+        raising them. Nothing is yielded for elements that failed.
+    initializer: Callable, optional (default: None)
+        Function that creates objects to reuse in each worker, see
+        apply_to_elements().
+    initargs: tuple, optional (default: ())
+        Arguments for the initializer.
+    maxtasksperchild: int, optional (default: None)
+        Number of chunks after which a worker process is replaced by a new
+        one (that calls the initializer again).
+    checkpoint: str, optional (default: None)
+        Path to a file where each processed element is recorded, elements
+        that were processed successfully before are skipped, see
+        apply_to_elements().
+    costs: list or Callable or CellGrid, optional (default: None)
+        Expected cost (e.g. run time) of each element, elements are
+        submitted largest first, see apply_to_elements(). With `ordered`,
+        results are then also yielded in this order.
+    backend: str, optional (default: 'process')
+        Use processes, threads or asyncio for the workers, see
+        apply_to_elements().
+    telemetry: Telemetry, optional (default: None)
+        Record the run time, CPU time, peak memory and worker PID of each
+        element in the passed object, see apply_to_elements().
+    shared_output: dict or SharedArray, optional (default: None)
+        Output arrays in shared memory that FUNC writes its results to,
+        passed to FUNC as additional kwargs, see apply_to_elements().
+
+    Yields
+    ------
+    result: Any
+        Return value of each function call
+    """
+    if STATIC_KWARGS is None:
+        STATIC_KWARGS = dict()
+
+    shared_output = _shared_output(shared_output, STATIC_KWARGS)
+    STATIC_KWARGS = {**STATIC_KWARGS, **shared_output}
+
+    n = _n_elements(ITER_KWARGS, STATIC_KWARGS)
+    telemetry = _telemetry(telemetry)
+    cpu_clock = _cpu_clock(backend, telemetry)
+
+    def key(i):
+        return _element_key({k: v[i] for k, v in ITER_KWARGS.items()})
+
+    if checkpoint is not None:
+        checkpoint = Checkpoint(checkpoint)
+        indices = [i for i in range(n) if not checkpoint.done(key(i))]
+        if len(indices) < n:
+            logging.info(f"Skip {n - len(indices)} elements that were "
+                         f"processed before.")
+    else:
+        indices = range(n)
+
+    indices = _by_cost(costs, ITER_KWARGS, indices)
+    chunks = _chunks(ITER_KWARGS, indices, max(int(chunksize), 1))
+
+    if max_pending is None:
+        max_pending = 2 * n_proc
+
+    if show_progress_bars:
+        pbar = tqdm(total=len(indices), desc=f"Processed")
+    else:
+        pbar = None
+
+    pool = None
+    busy, t0 = {}, time.perf_counter()
+    try:
+        if n_proc == 1 and backend != 'asyncio':
+            _init_worker(FUNC, STATIC_KWARGS, initializer, initargs,
+                         cpu_clock)
+            finished = map(_call_chunk, chunks)
+        else:
+            pool, call_chunk = _make_pool(
+                backend, n_proc,
+                (FUNC, STATIC_KWARGS, initializer, initargs, cpu_clock),
+                maxtasksperchild)
+            finished = _submit_bounded(pool, call_chunk, chunks,
+                                       max(max_pending, 1), ordered)
+
+        for pid, seconds, results in finished:
+            busy[pid] = busy.get(pid, 0.) + seconds
+            for i, r, e, stats in results:
+                if pbar is not None:
+                    pbar.update()
+                if telemetry is not None:
+                    telemetry.add(key(i), stats, e)
+                if checkpoint is not None:
+                    checkpoint.record(key(i), error=e)
+                if e is not None:
+                    logging.error(f"Element {i}: {e}")
+                    if not ignore_errors:
+                        raise e
+                else:
+                    yield r
+
+        logging.info(_load_report(busy, time.perf_counter() - t0, n_proc))
+        if telemetry is not None:
+            logging.info(telemetry.summary())
+    finally:
+        if pool is None:
+            _clear_worker()
+        else:
+            pool.terminate()
+            pool.join()
+        if pbar is not None:
+            pbar.close()
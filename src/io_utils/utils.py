@@ -18,9 +18,9 @@ import numpy as np
 import pandas as pd
 from matplotlib.dates import date2num
 from pygeogrids.grids import CellGrid
-from cadati.dekad import dekad_startdate_from_date
 from typing import List
 import functools
+import heapq
 import inspect
 import warnings
 import pytz
@@ -115,7 +115,8 @@ def area_folder_name(cells_identifier):
 
     return  area_str
 
-def cells_for_process(ref_grid, cells_identifier='global', n_proc=1) -> np.array:
+def cells_for_process(ref_grid, cells_identifier='global', n_proc=1,
+                      contiguous=False) -> np.array:
     """
     Applies GridShpAdapter to grid to extract cells for the passed identifier.
 
@@ -129,6 +130,9 @@ def cells_for_process(ref_grid, cells_identifier='global', n_proc=1) -> np.array
         Default: 'global'
     n_proc: int, optional
         Number of processes to split the cells up for. Default: 1
+    contiguous: bool, optional
+        Give each process a range of neighbouring cells (with about the same
+        number of gpis), see split_cells_gpi_equal. Default: False
 
     Returns
     -------
@@ -143,20 +147,22 @@ def cells_for_process(ref_grid, cells_identifier='global', n_proc=1) -> np.array
 
     if isinstance(cells_identifier, str) and \
             cells_identifier.lower() == 'global':
-        cells = split_cells_gpi_equal(ref_grid.get_cells(),
-                                      n=n_proc, grid=ref_grid)
+        cells = split_cells_gpi_equal(ref_grid.get_cells(), n=n_proc,
+                                      grid=ref_grid, contiguous=contiguous)
     else:
         if isinstance(cells_identifier, str):
             cells_identifier = [cells_identifier]
 
         if isinstance(cells_identifier[0], (int, np.integer)):
             cells = split_cells_gpi_equal(cells_identifier, n=n_proc,
-                                          grid=ref_grid)
+                                          grid=ref_grid,
+                                          contiguous=contiguous)
         else:
             adapter = GridShpAdapter(ref_grid)
             ref_grid = adapter.create_subgrid(cells_identifier)
             cells = split_cells_gpi_equal(ref_grid.get_cells(),
-                                          n=n_proc, grid=ref_grid)
+                                          n=n_proc, grid=ref_grid,
+                                          contiguous=contiguous)
 
     return ref_grid, cells
 
@@ -231,7 +237,60 @@ def split(el, n):
     return parts
 
 
-def split_cells_gpi_equal(all_cells, n, grid):
+def gpis_per_cell(grid, cells) -> np.ndarray:
+    """
+    Count the (active) points of a grid in each of the passed cells.
+
+    Parameters
+    ----------
+    grid : pygeogrids.CellGrid
+        Grid on which the cells are
+    cells : list
+        Cell numbers to count the points for
+
+    Returns
+    -------
+    n_gpis : np.ndarray
+        Number of points for each cell (0 for cells not in the grid)
+    """
+    cells = np.asarray(cells, dtype='int64').flatten()
+    if cells.size == 0:
+        return np.zeros(0, dtype='int64')
+    # number of gpis per cell, for all cells at once
+    return np.bincount(grid.activearrcell.astype('int64'),
+                       minlength=cells.max() + 1)[cells]
+
+
+def split_by_weight(weights, n) -> np.ndarray:
+    """
+    Assign items to n parts, so that the sum of the weights in each part is
+    about the same. Each item (in the passed order) is added to the part
+    with the smallest sum so far, pass the items sorted by weight (largest
+    first) for a more even split.
+
+    Parameters
+    ----------
+    weights : list
+        Weight (e.g. number of gpis) of each item
+    n : int
+        Number of parts
+
+    Returns
+    -------
+    part : np.ndarray
+        Index of the part (0 to n-1) for each item
+    """
+    heap = [(0, j) for j in range(n)]
+    part = np.empty(len(weights), dtype='int64')
+    for k, w in enumerate(weights):
+        size, j = heapq.heappop(heap)
+        part[k] = j
+        heapq.heappush(heap, (size + w, j))
+
+    return part
+
+
+def split_cells_gpi_equal(all_cells, n, grid, contiguous=False):
     ''' Split a list of cells in equal parts. Consider the number of points
     per cell, so that in each part approx. the same number of gpis are
 
@@ -243,24 +302,31 @@ def split_cells_gpi_equal(all_cells, n, grid):
         Number of separate lists that the input is plit into
     grid : pygeogrids.CellGrid
         Grid on which the input and output cells are
+    contiguous : bool, optional (default: False)
+        If True, each part contains a range of consecutive cells from
+        all_cells (e.g. neighbouring cells, if they are sorted), with about
+        the same number of gpis in each range. Otherwise each cell is
+        added to the part with the least gpis so far.
 
     Returns
     --------
     rparts : tuple
         Tuple of lists of all parts (about equal number of gpis)
     '''
+    all_cells = np.asarray(all_cells, dtype='int64').flatten()
+    n_gpis = gpis_per_cell(grid, all_cells)
+
+    if contiguous:
+        # assign each cell by the center of its gpis in the cumulated gpis
+        total = n_gpis.sum()
+        center = np.cumsum(n_gpis) - n_gpis / 2.
+        part = np.floor(center / total * n).astype('int64') \
+            if total > 0 else np.zeros(all_cells.size, dtype='int64')
+        part = np.clip(part, 0, n - 1)
+    else:
+        part = split_by_weight(n_gpis, n)
 
-    parts = {i:[0, []] for i in range(n)}
-    min_part = 0
-    for cell in all_cells:
-        g = grid.grid_points_for_cell(cell)[0].size
-        parts[min_part][1] += [cell]
-        parts[min_part][0] += g
-
-        counter = {k: v[0] for k, v in parts.items()}
-        min_part = min(counter, key=counter.get)
-
-    rparts = tuple([np.array(parts[j][1]) for j in range(n)])
+    rparts = tuple([all_cells[part == j] for j in range(n)])
     return rparts
 
 
@@ -314,8 +380,11 @@ def ddek(index):
     """ Group index by c3s dekads,
     i.e. days 1-10 --> 1 11-21 --> 11, 21-31 -->21
     """
-    func = np.vectorize(dekad_startdate_from_date)
-    return func(index.to_pydatetime())
+    time = np.asarray(index, dtype='datetime64[ns]')
+    months = time.astype('datetime64[M]')
+    day = (time.astype('datetime64[D]') - months).astype('int64')
+    offset = np.minimum(day // 10, 2) * 10
+    return (months + offset.astype('timedelta64[D]')).astype('datetime64[ns]')
 
 
 def julian2datetimeindex(jd: np.ndarray, tz: pytz.BaseTzInfo = pytz.UTC):
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for the cell reader mixins on synthetic cell files.
+Not collected by pytest, run from the package root with
+    python -m tests.benchmarks.bench_cell_readers
+"""
+
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from tests.test_readers.cell_files import write_ragged_cell
+from tests.test_readers.test_cell_readers import (
+    RaggedCellReader,
+    read_cell_reference,
+)
+
+
+def timeit(func, *args, repeat=3, **kwargs):
+    # Best wall time of `repeat` calls, and the result of the last call
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        r = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, r
+
+
+def bench_ragged_read_cell(n_locs=(100, 1000, 2500), n_times=(5000, 15000),
+                           density=0.3, repeat=3):
+    """
+    Compare ContiguousRaggedTsCellReaderMixin.read_cell against the original
+    per location implementation for different cell sizes.
+    """
+    results = []
+    for n_l in n_locs:
+        for n_t in n_times:
+            path = tempfile.mkdtemp()
+            file_path = write_ragged_cell(path, 1, n_locs=n_l, n_times=n_t,
+                                          density=density)
+            reader = RaggedCellReader(path)
+
+            t_new, df = timeit(reader.read_cell, 1, 'sm', repeat=repeat)
+            t_ref, ref = timeit(read_cell_reference, file_path, 'sm',
+                                repeat=repeat)
+            pd.testing.assert_frame_equal(df, ref)
+
+            results.append({'n_locs': n_l, 'n_times': n_t,
+                            'reference [s]': t_ref, 'read_cell [s]': t_new,
+                            'speedup': t_ref / t_new})
+            os.remove(file_path)
+
+    return pd.DataFrame(results)
+
+
+if __name__ == '__main__':
+    with pd.option_context('display.width', 120):
+        print(bench_ragged_read_cell())
@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+
+import os
+import asyncio
+import time
+import uuid
+import pickle
+import tempfile
+import pytest
+import numpy as np
+import pandas as pd
+from pygeogrids.grids import CellGrid
+from io_utils.parallel import (
+    apply_to_elements,
+    iter_apply_to_elements,
+    failed_elements,
+    Telemetry,
+    SharedArray,
+    _AsyncioPool,
+)
+
+
+def _func(i, add, sleep=0.):
+    time.sleep(sleep)
+    if i < 0:
+        raise ValueError(f"Negative element {i}")
+    return i + add
+
+
+def _pid(i):
+    return os.getpid()
+
+
+@pytest.mark.parametrize("n_proc", [1, 2])
+@pytest.mark.parametrize("chunksize", [1, 3])
+def test_iter_apply_to_elements(n_proc, chunksize):
+    gen = iter_apply_to_elements(
+        _func, ITER_KWARGS={'i': list(range(10))}, STATIC_KWARGS={'add': 1},
+        n_proc=n_proc, chunksize=chunksize, ordered=True,
+        show_progress_bars=False)
+    assert not isinstance(gen, list)
+    assert list(gen) == list(range(1, 11))
+
+    results = iter_apply_to_elements(
+        _func, ITER_KWARGS={'i': list(range(10))}, STATIC_KWARGS={'add': 1},
+        n_proc=n_proc, chunksize=chunksize, show_progress_bars=False)
+    assert sorted(results) == list(range(1, 11))
+
+    with pytest.warns(DeprecationWarning):
+        assert sorted(apply_to_elements(
+            _func, ITER_KWARGS={'i': list(range(10))},
+            STATIC_KWARGS={'add': 1}, n_proc=n_proc,
+            show_progress_bars=False)) == list(range(1, 11))
+
+
+def test_iter_apply_to_elements_unordered():
+    # the first element takes longest, so it is returned last
+    results = list(iter_apply_to_elements(
+        _func, ITER_KWARGS={'i': [0, 1, 2, 3],
+                            'sleep': [1., 0., 0., 0.]},
+        STATIC_KWARGS={'add': 0}, n_proc=2, show_progress_bars=False))
+    assert results[-1] == 0
+    assert sorted(results) == [0, 1, 2, 3]
+
+
+def test_iter_apply_to_elements_bounded():
+    # tasks are only created when there is room for them
+    created = []
+
+    class Elements:
+        def __len__(self):
+            return 100
+
+        def __getitem__(self, i):
+            created.append(i)
+            return i
+
+    gen = iter_apply_to_elements(
+        _func, ITER_KWARGS={'i': Elements()}, STATIC_KWARGS={'add': 0},
+        n_proc=2, chunksize=2, max_pending=3, ordered=True,
+        show_progress_bars=False)
+    assert next(gen) == 0
+    assert len(created) <= 8
+    gen.close()
+
+
+def test_iter_apply_to_elements_errors():
+    kwargs = dict(ITER_KWARGS={'i': [1, -1, 2]}, STATIC_KWARGS={'add': 0},
+                  n_proc=2, ordered=True, show_progress_bars=False)
+    with pytest.raises(ValueError, match='Negative'):
+        list(iter_apply_to_elements(_func, **kwargs))
+    assert list(iter_apply_to_elements(_func, ignore_errors=True,
+                                       **kwargs)) == [1, 2]
+
+    with pytest.raises(ValueError, match='duplicate'):
+        next(iter_apply_to_elements(_func, ITER_KWARGS={'i': [1]},
+                                    STATIC_KWARGS={'i': 0}))
+
+
+def test_iter_apply_to_elements_workers():
+    pids = set(iter_apply_to_elements(
+        _pid, ITER_KWARGS={'i': list(range(20))}, n_proc=2,
+        show_progress_bars=False))
+    assert os.getpid() not in pids
+    assert len(pids) <= 2
+
+
+def _init_resource(prefix):
+    return {'resource': f"{prefix}-{os.getpid()}-{uuid.uuid4()}"}
+
+
+def _use_resource(i, resource):
+    return resource
+
+
+@pytest.mark.parametrize("n_proc", [1, 2])
+@pytest.mark.parametrize("maxtasksperchild", [None, 1])
+def test_initializer(n_proc, maxtasksperchild):
+    kwargs = dict(ITER_KWARGS={'i': list(range(6))}, n_proc=n_proc,
+                  show_progress_bars=False, initializer=_init_resource,
+                  initargs=('reader',), maxtasksperchild=maxtasksperchild)
+    if maxtasksperchild is None or n_proc == 1:
+        n_resources = [1] if n_proc == 1 else [1, 2]
+    else:
+        n_resources = [6]
+
+    resources = list(iter_apply_to_elements(_use_resource, **kwargs))
+    assert len(resources) == 6
+    assert all([r.startswith('reader-') for r in resources])
+    assert len(set(resources)) in n_resources
+
+    with pytest.warns(DeprecationWarning):
+        resources = apply_to_elements(_use_resource, **kwargs)
+    assert len(set(resources)) in n_resources
+
+
+@pytest.mark.parametrize("n_proc", [1, 2])
+def test_checkpoint_resume(n_proc):
+    checkpoint = os.path.join(tempfile.mkdtemp(), 'run', 'checkpoint.txt')
+    kwargs = dict(ITER_KWARGS={'i': [3, -1, 5, 6, -2, 8]},
+                  STATIC_KWARGS={'add': 0}, n_proc=n_proc, ordered=True,
+                  show_progress_bars=False, ignore_errors=True,
+                  checkpoint=checkpoint)
+
+    # run is interrupted after the first two successful elements
+    gen = iter_apply_to_elements(_func, chunksize=1, max_pending=1, **kwargs)
+    assert [next(gen), next(gen)] == [3, 5]
+    gen.close()
+    # and crashed while writing a record
+    with open(checkpoint, 'a') as f:
+        f.write('{"key": "{\\"i\\": 6}", "sta')
+
+    assert list(iter_apply_to_elements(_func, **kwargs)) == [6, 8]
+    assert failed_elements(checkpoint) == {'i': [-1, -2]}
+    assert list(iter_apply_to_elements(_func, **kwargs)) == []
+
+    with pytest.warns(DeprecationWarning):
+        assert apply_to_elements(_func, **{k: v for k, v in kwargs.items()
+                                           if k != 'ordered'}) == []
+    with open(checkpoint, 'r') as f:
+        assert len(f.readlines()) == 12
+
+    # retry the failed elements only
+    retry = os.path.join(os.path.dirname(checkpoint), 'retry.txt')
+    with pytest.warns(DeprecationWarning):
+        results = apply_to_elements(
+            _func, ITER_KWARGS={'i': [abs(i) for i in
+                                      failed_elements(checkpoint)['i']]},
+            STATIC_KWARGS={'add': 0}, n_proc=n_proc, checkpoint=retry,
+            show_progress_bars=False)
+    assert sorted(results) == [1, 2]
+    assert failed_elements(retry) == {}
+
+
+def test_costs_largest_first():
+    kwargs = dict(ITER_KWARGS={'i': [1, 2, 3, 4]}, STATIC_KWARGS={'add': 0},
+                  show_progress_bars=False)
+    assert list(iter_apply_to_elements(_func, costs=[1, 5, 2, 5],
+                                       **kwargs)) == [2, 4, 3, 1]
+    assert list(iter_apply_to_elements(_func, costs=lambda kws: -kws['i'],
+                                       **kwargs)) == [1, 2, 3, 4]
+    with pytest.warns(DeprecationWarning):
+        assert apply_to_elements(_func, costs=[1, 5, 2, 5],
+                                 **kwargs) == [2, 4, 3, 1]
+
+    # number of gpis per cell from the grid
+    grid = CellGrid(np.arange(6.), np.zeros(6), np.array([1, 2, 2, 3, 3, 3]))
+    assert list(iter_apply_to_elements(
+        lambda i, cell: i,
+        ITER_KWARGS={'i': [1, 2, 3, 4], 'cell': [1, 2, 3, 4]}, costs=grid,
+        show_progress_bars=False)) == [3, 2, 1, 4]
+
+
+@pytest.mark.parametrize("n_proc", [1, 2])
+def test_load_report(n_proc, caplog):
+    caplog.set_level('INFO')
+    results = list(iter_apply_to_elements(
+        _func, ITER_KWARGS={'i': [0, 1, 2, 3], 'sleep': [.3, .1, .1, .1]},
+        STATIC_KWARGS={'add': 0}, n_proc=n_proc, costs=[3, 1, 1, 1],
+        show_progress_bars=False))
+    assert sorted(results) == [0, 1, 2, 3]
+    assert 'workers were busy' in caplog.text
+
+
+async def _afunc(i, add, sleep=0.):
+    await asyncio.sleep(sleep)
+    if i < 0:
+        raise ValueError(f"Negative element {i}")
+    return i + add
+
+
+def test_thread_backend():
+    static = {'values': []}
+
+    def append(i, store):
+        store['values'].append(i)
+        return id(store)
+
+    results = list(iter_apply_to_elements(
+        append, ITER_KWARGS={'i': range(10)}, STATIC_KWARGS={'store': static},
+        n_proc=3, backend='thread', show_progress_bars=False))
+    # the static object is shared, not copied
+    assert set(results) == {id(static)}
+    assert sorted(static['values']) == list(range(10))
+
+    with pytest.warns(DeprecationWarning):
+        results = apply_to_elements(
+            _func, ITER_KWARGS={'i': [0, 1, 2, 3]}, STATIC_KWARGS={'add': 1},
+            n_proc=2, backend='thread', show_progress_bars=False)
+    assert sorted(results) == [1, 2, 3, 4]
+
+
+@pytest.mark.parametrize("n_proc", [1, 4])
+def test_asyncio_backend(n_proc):
+    t0 = time.perf_counter()
+    results = list(iter_apply_to_elements(
+        _afunc, ITER_KWARGS={'i': [0, 1, 2, 3], 'sleep': [.3] * 4},
+        STATIC_KWARGS={'add': 1}, n_proc=n_proc, backend='asyncio',
+        ordered=True, show_progress_bars=False))
+    assert results == [1, 2, 3, 4]
+    if n_proc == 4:  # at most n_proc elements are awaited at once
+        assert time.perf_counter() - t0 < 1.
+    else:
+        assert time.perf_counter() - t0 >= 1.2
+
+    with pytest.raises(ValueError):
+        list(iter_apply_to_elements(
+            _afunc, ITER_KWARGS={'i': [0, -1]}, STATIC_KWARGS={'add': 1},
+            n_proc=n_proc, backend='asyncio', show_progress_bars=False))
+
+    with pytest.warns(DeprecationWarning):
+        results = apply_to_elements(
+            _afunc, ITER_KWARGS={'i': [0, -1, 2]}, STATIC_KWARGS={'add': 1},
+            n_proc=n_proc, backend='asyncio', ignore_errors=True,
+            show_progress_bars=False)
+    assert sorted(results) == [1, 3]
+
+    with pytest.raises(TypeError):
+        list(iter_apply_to_elements(
+            _func, ITER_KWARGS={'i': [0]}, STATIC_KWARGS={'add': 1},
+            backend='asyncio', show_progress_bars=False))
+
+
+@pytest.mark.parametrize("backend", ['process', 'thread', 'asyncio'])
+@pytest.mark.parametrize("n_proc", [1, 2])
+def test_errors_are_raised(backend, n_proc):
+    FUNC = _afunc if backend == 'asyncio' else _func
+    kwargs = dict(ITER_KWARGS={'i': [0, -1, 2]}, STATIC_KWARGS={'add': 1},
+                  n_proc=n_proc, backend=backend, show_progress_bars=False)
+    with pytest.raises(ValueError, match="Negative element -1"), \
+            pytest.warns(DeprecationWarning):
+        apply_to_elements(FUNC, **kwargs)
+    with pytest.raises(ValueError, match="Negative element -1"):
+        list(iter_apply_to_elements(FUNC, **kwargs))
+
+
+def test_asyncio_pool_callback_errors():
+    def callback(r):
+        raise RuntimeError(f"Callback failed for {r}")
+
+    with _AsyncioPool(2) as pool:
+        pool.apply_async(_afunc, (1, 1), callback=callback)
+        pool.close()
+        with pytest.raises(RuntimeError, match="Callback failed for 2"):
+            pool.join()
+
+
+@pytest.mark.parametrize("n_proc", [1, 2])
+def test_telemetry(n_proc):
+    telemetry = Telemetry()
+    results = list(iter_apply_to_elements(
+        _func, ITER_KWARGS={'i': [0, 1, -2], 'sleep': [.2, 0., 0.]},
+        STATIC_KWARGS={'add': 0}, n_proc=n_proc, ignore_errors=True,
+        telemetry=telemetry, show_progress_bars=False))
+    assert sorted(results) == [0, 1]
+
+    df = telemetry.table.set_index('element')
+    assert list(df.columns) == Telemetry.columns[1:]
+    assert len(df) == 3
+    slow = '{"i": 0, "sleep": 0.2}'
+    assert df.loc[slow, 'wall'] >= .2
+    assert df.loc[slow, 'cpu'] < .2
+    assert df['failed'].sum() == 1
+    assert np.all(df['peak_rss_mb'] > 0)
+    if n_proc > 1:
+        assert os.getpid() not in df['pid'].values
+    assert telemetry.summary(n=1).splitlines()[2].endswith(slow)
+
+
+def test_telemetry_log_path():
+    with tempfile.TemporaryDirectory() as log_path:
+        with pytest.warns(DeprecationWarning):
+            apply_to_elements(
+                _func, ITER_KWARGS={'i': [0, 1, 2]}, STATIC_KWARGS={'add': 0},
+                n_proc=2, telemetry=True, log_path=log_path,
+                show_progress_bars=False)
+        files = [f for f in os.listdir(log_path) if f.endswith('.csv')]
+        assert len(files) == 1 and files[0].endswith('_telemetry.csv')
+        df = pd.read_csv(os.path.join(log_path, files[0]))
+        assert sorted(df['element']) == ['{"i": 0}', '{"i": 1}', '{"i": 2}']
+
+
+def _write_row(i, out):
+    out[i] = np.arange(4) + 10 * i
+    return os.getpid()
+
+
+@pytest.mark.parametrize("backend", ['process', 'thread'])
+@pytest.mark.parametrize("memmap", [False, True])
+def test_shared_output(backend, memmap):
+    with tempfile.TemporaryDirectory() as path:
+        path = os.path.join(path, 'out.dat') if memmap else None
+        with SharedArray((5, 4), dtype='int32', fill_value=-1,
+                         path=path) as out:
+            results = list(iter_apply_to_elements(
+                _write_row, ITER_KWARGS={'i': [0, 1, 2, 3]},
+                shared_output={'out': out}, n_proc=2, backend=backend,
+                show_progress_bars=False))
+            if backend == 'process':
+                assert os.getpid() not in results
+            data = out.to_numpy()
+        np.testing.assert_equal(data[:4],
+                                np.arange(4) + 10 * np.arange(4)[:, None])
+        np.testing.assert_equal(data[4], -1)
+
+
+def test_shared_output_apply_to_elements():
+    with SharedArray(3) as output:
+        with pytest.warns(DeprecationWarning):
+            results = apply_to_elements(
+                lambda i, output: output.__setitem__(i, i / 2),
+                ITER_KWARGS={'i': [0, 1, 2]}, shared_output=output,
+                show_progress_bars=False)
+        assert results == []
+        np.testing.assert_equal(output.array, [0, .5, 1])
+
+        # only the name is pickled, e.g. for spawned workers
+        attached = pickle.loads(pickle.dumps(output))
+        attached[0] = 5
+        assert output[0] == 5
+        attached.close()
+
+        with pytest.raises(ValueError), pytest.warns(DeprecationWarning):
+            apply_to_elements(
+                _write_row, ITER_KWARGS={'i': [0]},
+                STATIC_KWARGS={'output': 1}, shared_output=output)
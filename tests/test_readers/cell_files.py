@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""
+Synthetic cell files for the reader tests.
+"""
+
+import os
+
+import netCDF4 as nc
+import numpy as np
+from pygeogrids.grids import CellGrid
+
+
+def write_ragged_cell(path, cell, n_locs=10, n_times=365, density=0.5,
+                      seed=0, time_units='days since 1970-01-01 00:00:00'):
+    """
+    Write a synthetic contiguous ragged cell file <cell>.nc to path.
+    Each location has a random subset of the `n_times` (sub-daily) time
+    stamps, in ascending order.
+
+    Returns
+    -------
+    file_path: str
+        Path to the created file
+    """
+    rng = np.random.default_rng(seed)
+    all_times = np.arange(n_times) + rng.uniform(0, 1, n_times).round(4) + \
+        10000.
+
+    times, row_size = [], []
+    for _ in range(n_locs):
+        sel = rng.uniform(0, 1, n_times) < density
+        times.append(all_times[sel])
+        row_size.append(sel.sum())
+    times = np.concatenate(times)
+
+    file_path = os.path.join(path, f"{cell:04d}.nc")
+    with nc.Dataset(file_path, 'w') as ds:
+        ds.createDimension('locations', n_locs)
+        ds.createDimension('obs', times.size)
+        ds.createVariable('location_id', 'i8', ('locations',))[:] = \
+            np.arange(n_locs) + cell * 1000
+        ds.createVariable('row_size', 'i8', ('locations',))[:] = row_size
+        t = ds.createVariable('time', 'f8', ('obs',))
+        t.units = time_units
+        t[:] = times
+        ds.createVariable('sm', 'f4', ('obs',), fill_value=-9999.)[:] = \
+            rng.uniform(0, 50, times.size)
+        ds.createVariable('flag', 'u1', ('obs',))[:] = \
+            rng.integers(0, 4, times.size)
+
+    return file_path
+
+
+def write_orthomulti_cell(path, cell, n_locs=10, n_times=365, seed=0,
+                          time_units='days since 1970-01-01 00:00:00'):
+    """
+    Write a synthetic orthomulti cell file <cell>.nc to path with daily
+    time stamps. The first location only contains fill values.
+
+    Returns
+    -------
+    file_path: str
+        Path to the created file
+    """
+    rng = np.random.default_rng(seed)
+
+    file_path = os.path.join(path, f"{cell:04d}.nc")
+    with nc.Dataset(file_path, 'w') as ds:
+        ds.createDimension('locations', n_locs)
+        ds.createDimension('time', n_times)
+        ds.createVariable('location_id', 'i8', ('locations',))[:] = \
+            np.arange(n_locs) + cell * 1000
+        t = ds.createVariable('time', 'f8', ('time',))
+        t.units = time_units
+        t[:] = np.arange(n_times) + 10000.
+        sm = rng.uniform(0, 50, (n_locs, n_times))
+        sm[0, :] = -9999.
+        ds.createVariable('sm', 'f4', ('locations', 'time'),
+                          fill_value=-9999.)[:] = sm
+        ds.createVariable('flag', 'i2', ('locations', 'time'))[:] = \
+            rng.integers(0, 4, (n_locs, n_times))
+
+    return file_path
+
+
+def write_orthomulti_cells(path, cells, n_locs=10, n_times=50):
+    """
+    Write synthetic orthomulti files for all cells to path.
+
+    Returns
+    -------
+    grid: CellGrid
+        Grid of all locations in the files, along the equator with a
+        distance of 1 degree between neighbouring points.
+    """
+    gpis = []
+    for cell in cells:
+        write_orthomulti_cell(path, cell, n_locs=n_locs, n_times=n_times,
+                              seed=cell)
+        gpis.append(np.arange(n_locs) + cell * 1000)
+    gpis = np.concatenate(gpis)
+
+    return CellGrid(np.arange(float(gpis.size)), np.zeros(gpis.size),
+                    gpis // 1000, gpis=gpis)
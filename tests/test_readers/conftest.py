@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+import netCDF4 as nc
+import pytest
+
+from io_utils.data.read.geo_ts_readers import mixins
+from tests.test_readers.cell_files import write_orthomulti_cells
+
+
+@pytest.fixture
+def count_opens(monkeypatch):
+    # Count how often a netcdf file is opened for reading
+    opened = []
+    Dataset = nc.Dataset
+
+    def _Dataset(filename, mode='r', *args, **kwargs):
+        if mode == 'r':
+            opened.append(filename)
+        return Dataset(filename, mode, *args, **kwargs)
+
+    monkeypatch.setattr(mixins.nc, 'Dataset', _Dataset)
+    return opened
+
+
+@pytest.fixture
+def orthomulti_cells(tmp_path):
+    # Write synthetic orthomulti cells, returns their path and grid
+    def make(cells=(165,), n_locs=10, n_times=50):
+        path = tmp_path / 'cells'
+        path.mkdir(exist_ok=True)
+        return str(path), write_orthomulti_cells(str(path), cells, n_locs,
+                                                 n_times)
+
+    return make
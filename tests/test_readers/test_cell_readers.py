@@ -0,0 +1,685 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test the cell reader mixins on synthetic cell files.
+"""
+
+import os
+import tempfile
+import time
+from datetime import timedelta
+
+import netCDF4 as nc
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+from pygeogrids.grids import CellGrid
+from pygeogrids.netcdf import save_grid
+from pynetcf.time_series import GriddedNcOrthoMultiTs
+
+from io_utils.data.read.geo_ts_readers import mixins, SmecvTs
+from io_utils.data.read.geo_ts_readers.ascat_direx.base_reader import DirexTs
+from io_utils.data.read.geo_ts_readers.hsaf_ascat.base_reader import (
+    HSAFAscatSMDASTs,
+)
+from io_utils.data.read.geo_ts_readers.mixins import (
+    ContiguousRaggedTsCellReaderMixin,
+    OrthoMultiTsCellReaderMixin,
+)
+from io_utils.data.read.geo_ts_readers.ts_cache import nc_lock
+from tests.test_readers.cell_files import (
+    write_orthomulti_cell,
+    write_ragged_cell,
+)
+
+
+class RaggedCellReader(ContiguousRaggedTsCellReaderMixin):
+    # Minimal reader that only provides what the mixin needs
+    def __init__(self, path):
+        self.path = path
+
+
+class OrthoMultiCellReader(OrthoMultiTsCellReaderMixin):
+    # Minimal reader that only provides what the mixin needs
+    def __init__(self, path):
+        self.path = path
+
+
+def read_cell_reference(file_path, param, fill_value=None):
+    # The original, per location implementation of read_cell
+    with nc.Dataset(file_path) as ncfile:
+        loc_id = ncfile.variables['location_id'][:]
+        loc_id = loc_id[~loc_id.mask].data.flatten()
+        row_size = ncfile.variables['row_size'][:]
+        row_size = row_size[~row_size.mask].data.flatten()
+        time = ncfile.variables['time'][:].data
+        unit_time = ncfile.variables['time'].units
+        variable = ncfile.variables[param][:]
+        if fill_value is None:
+            fill_value = variable.fill_value
+        variable = variable.filled(fill_value)
+
+    cutoff_points = np.cumsum(row_size)
+    index = np.sort(np.unique(time))
+    times = np.split(time, cutoff_points)[:-1]
+
+    filled = np.full((len(times), len(index)), fill_value=fill_value)
+    idx = np.array([np.isin(index, t) for t in times])
+    filled[idx] = variable
+
+    since = pd.Timestamp(unit_time.split('since ')[1])
+    index = since + np.vectorize(lambda t: timedelta(t))(index)
+
+    return pd.DataFrame(index=index, data=np.transpose(filled),
+                        columns=loc_id)
+
+
+@pytest.mark.parametrize("param,fill_value", [
+    ('sm', None), ('sm', np.nan), ('flag', None),
+])
+def test_ragged_read_cell_same_as_reference(param, fill_value):
+    path = tempfile.mkdtemp()
+    file_path = write_ragged_cell(path, 165, n_locs=20, n_times=500)
+    reader = RaggedCellReader(path)
+
+    df = reader.read_cell(165, param, fill_value=fill_value)
+    ref = read_cell_reference(file_path, param, fill_value=fill_value)
+
+    pd.testing.assert_frame_equal(df, ref)
+
+
+def test_ragged_read_cell_testdata():
+    path = os.path.join(os.path.dirname(__file__), '..', '00_testdata',
+                        'read', 'esa_cci_sm', 'v07x', 'intermedncts')
+    reader = RaggedCellReader(path)
+    df = reader.read_cell(165, 'sm', fill_value=np.nan)
+    ref = read_cell_reference(os.path.join(path, '0165.nc'), 'sm',
+                              fill_value=np.nan)
+    pd.testing.assert_frame_equal(df, ref)
+    assert df.columns.size == 11
+
+
+@pytest.mark.parametrize("Reader,write_cell", [
+    (RaggedCellReader, write_ragged_cell),
+    (OrthoMultiCellReader, write_orthomulti_cell),
+])
+def test_read_cell_multiple_params(Reader, write_cell, count_opens):
+    path = tempfile.mkdtemp()
+    write_cell(path, 165)
+    reader = Reader(path)
+
+    data = reader.read_cell(165, ['sm', 'flag'])
+    assert len(count_opens) == 1
+    assert list(data.keys()) == ['sm', 'flag']
+    for p in ['sm', 'flag']:
+        pd.testing.assert_frame_equal(data[p], reader.read_cell(165, p))
+
+
+@pytest.mark.parametrize("Reader,write_cell", [
+    (RaggedCellReader, write_ragged_cell),
+    (OrthoMultiCellReader, write_orthomulti_cell),
+])
+@pytest.mark.parametrize("format", [
+    'pd_multicol_vargpi', 'pd_multidx_vartime', 'pd_multidx_timegpi',
+    'gpidict'
+])
+def test_read_agg_cell_data_single_open(Reader, write_cell, format,
+                                        count_opens):
+    path = tempfile.mkdtemp()
+    write_cell(path, 165, n_locs=5, n_times=50)
+    reader = Reader(path)
+
+    data = reader.read_agg_cell_data(165, ['sm', 'flag'], format=format)
+    assert len(count_opens) == 1
+
+    sm = reader.read_cell(165, 'sm')
+    if format == 'pd_multicol_vargpi':
+        np.testing.assert_equal(data['sm'].values, sm.values)
+        assert data.columns.names == ['var', 'gpi']
+    elif format == 'pd_multidx_vartime':
+        np.testing.assert_equal(data.loc['sm'].values, sm.values)
+        assert data.index.names == ['var', 'time']
+    else:
+        # long formats only contain actual observations, no padding
+        if Reader is RaggedCellReader:
+            sm = reader.read_cell(165, 'sm', fill_value=np.nan)
+        if format == 'pd_multidx_timegpi':
+            np.testing.assert_equal(data['sm'].dropna().values,
+                                    sm.stack().values)
+            assert data.index.names == ['time', 'gpi']
+        else:
+            assert sorted(data.keys()) == sorted(sm.columns)
+            gpi = sm.columns[1]
+            np.testing.assert_equal(data[gpi]['sm'].values,
+                                    sm[gpi].dropna().values)
+
+
+def agg_long_reference(reader, cell, params, format):
+    # The original construction of the long formats by stacking dense data
+    dfs = pd.concat([reader.read_cell(cell, p).stack().to_frame(p)
+                     for p in params], axis=1)
+    if format == 'pd_multidx_timegpi':
+        dfs.index = dfs.index.set_names(['time', 'gpi'])
+        return dfs.sort_index(level=[0, 1])
+    else:
+        dfs = dfs.sort_index(level=[0, 1])
+        dfs['gpi'] = dfs.index.get_level_values(1)
+        dfs.index = dfs.index.droplevel(1)
+        return dict(tuple(dfs.groupby(dfs.pop('gpi'))))
+
+
+@pytest.mark.parametrize("format", ['pd_multidx_timegpi', 'gpidict'])
+def test_orthomulti_long_formats_same_as_reference(format):
+    path = tempfile.mkdtemp()
+    write_orthomulti_cell(path, 165, n_locs=6, n_times=100)
+    reader = OrthoMultiCellReader(path)
+
+    data = reader.read_agg_cell_data(165, ['sm', 'flag'], format=format)
+    ref = agg_long_reference(reader, 165, ['sm', 'flag'], format)
+
+    if format == 'pd_multidx_timegpi':
+        pd.testing.assert_frame_equal(data, ref)
+    else:
+        assert list(data.keys()) == list(ref.keys())
+        for gpi in ref.keys():
+            pd.testing.assert_frame_equal(data[gpi], ref[gpi],
+                                          check_freq=False)
+
+
+@pytest.mark.parametrize("Reader,write_cell", [
+    (RaggedCellReader, write_ragged_cell),
+    (OrthoMultiCellReader, write_orthomulti_cell),
+])
+def test_read_agg_cell_data_ragged(Reader, write_cell):
+    path = tempfile.mkdtemp()
+    write_cell(path, 165, n_locs=5, n_times=50)
+    reader = Reader(path)
+
+    ragged = reader.read_agg_cell_data(165, ['sm', 'flag'], format='ragged')
+    assert isinstance(ragged, mixins.RaggedCellData)
+    assert ragged.parameters == ['sm', 'flag']
+    assert ragged.offsets[-1] == ragged.time.size == ragged.data['sm'].size
+    assert ragged.row_size.size == ragged.location_id.size == 5
+
+    sm = reader.read_cell(165, 'sm')
+    if Reader is RaggedCellReader:
+        pd.testing.assert_frame_equal(ragged.to_dense('sm'), sm)
+        sm = reader.read_cell(165, 'sm', fill_value=np.nan)
+
+    for i, gpi in enumerate(ragged.location_id):
+        time, values = ragged.gpi_view(gpi)
+        assert np.shares_memory(values['sm'], ragged.data['sm'])
+        assert time.size == ragged.row_size[i]
+        ts = sm[gpi].dropna()
+        np.testing.assert_equal(values['sm'][~np.isnan(values['sm'])],
+                                ts.values)
+        np.testing.assert_equal(time[~np.isnan(values['sm'])],
+                                ts.index.values)
+
+    start, end = sm.index[10], sm.index[20]
+    clipped = ragged.clip(start, end)
+    assert clipped.time.min() >= start and clipped.time.max() <= end
+    np.testing.assert_equal(clipped.to_timegpi().values,
+                            ragged.to_timegpi().loc[start:end].values)
+
+
+def test_lazy_gpidict():
+    path = tempfile.mkdtemp()
+    write_orthomulti_cell(path, 165, n_locs=6, n_times=100)
+    reader = OrthoMultiCellReader(path)
+
+    data = reader.read_agg_cell_data(165, ['sm', 'flag'], format='gpidict',
+                                     gpidict_cache_size=2)
+    ref = agg_long_reference(reader, 165, ['sm', 'flag'], 'gpidict')
+
+    assert isinstance(data, mixins.LazyGpiDict)
+    assert len(data) == len(ref) == 6
+    assert list(data) == list(ref.keys())
+    assert 165000 in data and 166000 not in data
+    with pytest.raises(KeyError):
+        data[166000]
+
+    df = data[165001]
+    assert np.shares_memory(df['sm'].values, data.ragged.data['sm'])
+    assert data[165001] is df  # cached
+    data[165002], data[165003]  # evicts 165001
+    assert data[165001] is not df
+    pd.testing.assert_frame_equal(data[165001], df)
+
+    assert dict(data).keys() == ref.keys()
+    for gpi, df in data.items():
+        pd.testing.assert_frame_equal(df, ref[gpi], check_freq=False)
+
+
+class ClippedOrthoMultiCellReader(OrthoMultiCellReader):
+    # Reader with clip dates like SmecvTs
+    def __init__(self, path, clip_dates=None):
+        super().__init__(path)
+        self.clip_dates = clip_dates
+
+    def _clip_dates(self, df):
+        return df.loc[self.clip_dates[0]:self.clip_dates[1]]
+
+
+@pytest.mark.parametrize("Reader,write_cell", [
+    (RaggedCellReader, write_ragged_cell),
+    (OrthoMultiCellReader, write_orthomulti_cell),
+])
+@pytest.mark.parametrize("start,end", [
+    ('1997-06-01', '1997-06-30'),
+    (None, '1997-06-30'),
+    ('1997-06-01', None),
+    ('1990-01-01', '1990-12-31'),  # no data in period
+])
+def test_read_cell_time_window(Reader, write_cell, start, end):
+    path = tempfile.mkdtemp()
+    write_cell(path, 165, n_locs=8, n_times=200)
+    reader = Reader(path)
+
+    full = reader.read_cell(165, ['sm', 'flag'])
+    data = reader.read_cell(165, ['sm', 'flag'], start=start, end=end)
+    for p in ['sm', 'flag']:
+        ref = full[p].loc[mixins._in_window(full[p].index.values, start,
+                                            end)]
+        pd.testing.assert_frame_equal(data[p], ref, check_freq=False,
+                                      check_index_type=False)
+
+    ragged = reader.read_agg_cell_data(165, ['sm', 'flag'], format='ragged',
+                                       start=start, end=end)
+    ref = reader.read_agg_cell_data(165, ['sm', 'flag'], format='ragged')
+    ref = ref.clip(start, end)
+    np.testing.assert_equal(ragged.row_size, ref.row_size)
+    np.testing.assert_equal(ragged.time, ref.time)
+    for p in ['sm', 'flag']:
+        np.testing.assert_equal(ragged.data[p], ref.data[p])
+
+
+def test_ragged_time_window_reads_ranges(monkeypatch):
+    path = tempfile.mkdtemp()
+    write_ragged_cell(path, 165, n_locs=6, n_times=300)
+    reader = RaggedCellReader(path)
+    reader._max_read_gap = 0
+
+    # count the number of observations read from the file
+    n_read = []
+    concatenate = np.ma.concatenate
+
+    def _concatenate(arrays, *args, **kwargs):
+        n_read.append(sum(a.size for a in arrays))
+        return concatenate(arrays, *args, **kwargs)
+
+    monkeypatch.setattr(mixins.np.ma, 'concatenate', _concatenate)
+
+    ragged = reader.read_agg_cell_data(165, 'sm', format='ragged',
+                                       start='1997-06-01', end='1997-06-30')
+    assert 0 < ragged.time.size < ragged.offsets.size * 300
+    assert n_read == [ragged.time.size]
+
+
+def test_orthomulti_time_window_with_clip_dates():
+    path = tempfile.mkdtemp()
+    write_orthomulti_cell(path, 165, n_locs=4, n_times=200)
+
+    reader = ClippedOrthoMultiCellReader(
+        path, clip_dates=('1997-06-10', '1997-07-31'))
+    full = OrthoMultiCellReader(path).read_cell(165, 'sm')
+
+    sm = reader.read_cell(165, 'sm')
+    pd.testing.assert_frame_equal(sm, full.loc['1997-06-10':'1997-07-31'],
+                                  check_freq=False)
+
+    # the passed period and clip_dates are intersected
+    sm = reader.read_cell(165, 'sm', start='1997-06-01', end='1997-06-30')
+    pd.testing.assert_frame_equal(sm, full.loc['1997-06-10':'1997-06-30'],
+                                  check_freq=False)
+
+    df = reader.read_agg_cell_data(165, 'sm', format='pd_multidx_timegpi',
+                                   end='1997-06-20')
+    times = df.index.get_level_values('time')
+    assert times.min() == pd.Timestamp('1997-06-10')
+    assert times.max() == pd.Timestamp('1997-06-20')
+
+
+class GriddedOrthoMultiCellReader(GriddedNcOrthoMultiTs,
+                                  OrthoMultiTsCellReaderMixin):
+    # pynetcf point reader with the cell reader mixin, like the readers
+    # in this package
+    _reads_cell_data = True
+
+    def read(self, *args, **kwargs):
+        df = self._read_cached_ts(*args, **kwargs)
+        if df is None:
+            df = super(GriddedOrthoMultiCellReader, self).read(*args,
+                                                                **kwargs)
+        df['sm_x2'] = df['sm'] * 2  # post-processing of point reads
+        return df
+
+
+def read_cells_reference(reader, cells, param=None):
+    # Reads all points in the cells one by one
+    cell_data = []
+    gpis, lons, lats = reader.grid.grid_points_for_cell(list(cells))
+    for gpi, lon, lat in zip(gpis, lons, lats):
+        df = reader.read(lon, lat)
+        if param is not None:
+            df = df[np.atleast_1d(param)]
+        df.columns = pd.MultiIndex.from_tuples((gpi, c) for c in df.columns)
+        if not df.empty:
+            cell_data.append(df)
+    return pd.concat(cell_data, axis=0)
+
+
+def test_orthomulti_read_cells_bulk(count_opens, orthomulti_cells):
+    path, grid = orthomulti_cells([165, 166])
+    reader = GriddedOrthoMultiCellReader(path, grid,
+                                         ioclass_kws={'read_bulk': False},
+                                         scale_factors={'sm': 0.5})
+
+    ref = read_cells_reference(reader, [165, 166])
+    count_opens.clear()
+    data = reader.read_cells([165, 166])
+    assert count_opens == [os.path.join(path, '0165.nc'),
+                           os.path.join(path, '0166.nc')]
+    pd.testing.assert_frame_equal(data, ref, check_freq=False)
+
+    # only the rows of the selected points are read
+    sel = [165002, 165003, 165007, 166004, 167000]
+    data = reader.read_cells([165, 166], param=['sm_x2'], gpis=sel)
+    assert data.columns.get_level_values(0).unique().tolist() == sel[:-1]
+    ref = ref.loc[:, ref.columns.isin([(g, 'sm_x2') for g in sel])]
+    pd.testing.assert_frame_equal(data.dropna(how='all'),
+                                  ref.dropna(how='all'), check_freq=False)
+
+
+def test_orthomulti_read_cached_ts_cell_data(orthomulti_cells):
+    # Points are taken from the passed cell data only, the period is applied
+    path, grid = orthomulti_cells()
+    reader = GriddedOrthoMultiCellReader(path, grid,
+                                         ioclass_kws={'read_bulk': False},
+                                         scale_factors={'sm': 0.5})
+    loc_id, time, variables = reader._read_orthomulti_cell(
+        165, None, gpis=[165002, 165003])
+    cell_data = ({gpi: i for i, gpi in enumerate(np.ma.getdata(loc_id))},
+                 time, variables)
+    period = [pd.Timestamp('1997-05-25'), pd.Timestamp('1997-06-05')]
+
+    assert reader._read_cached_ts(165003) is None
+    assert reader._read_cached_ts(165004, cell_data=cell_data) is None
+    df = reader._read_cached_ts(165003, cell_data=cell_data, period=period)
+    ref = GriddedNcOrthoMultiTs.read(reader, 165003, period=period)
+    pd.testing.assert_frame_equal(df, ref, check_freq=False)
+
+
+def test_orthomulti_read_cells_fallback(monkeypatch, orthomulti_cells):
+    # Readers whose read() does not take the cell data are read point by
+    # point instead of reading each cell twice
+    path, grid = orthomulti_cells([165, 166])
+
+    class Reader(GriddedOrthoMultiCellReader):
+        _reads_cell_data = False
+
+        def read(self, *args, **kwargs):
+            return GriddedNcOrthoMultiTs.read(self, *args, **kwargs)
+
+    reader = Reader(path, grid, ioclass_kws={'read_bulk': False})
+    ref = read_cells_reference(reader, [165, 166])
+
+    def _fail(*args, **kwargs):
+        raise AssertionError("cell read at once")
+
+    monkeypatch.setattr(Reader, '_read_orthomulti_cell', _fail)
+    data = reader.read_cells([165, 166])
+    pd.testing.assert_frame_equal(data, ref, check_freq=False)
+
+
+@pytest.mark.parametrize("Reader", [DirexTs, HSAFAscatSMDASTs])
+def test_orthomulti_read_cells_readers(monkeypatch, count_opens,
+                                       orthomulti_cells, Reader):
+    # The point readers of the package take the cells from read_cells()
+    path, grid = orthomulti_cells([165, 166])
+    save_grid(os.path.join(path, 'grid.nc'), grid)
+    reader = Reader(path, ioclass_kws={'read_bulk': False})
+    ref = read_cells_reference(reader, [165, 166])
+
+    def _fail(*args, **kwargs):
+        raise AssertionError("point read from file")
+
+    monkeypatch.setattr(GriddedNcOrthoMultiTs, 'read', _fail)
+    count_opens.clear()
+    data = reader.read_cells([165, 166])
+    assert count_opens == [os.path.join(path, '0165.nc'),
+                           os.path.join(path, '0166.nc')]
+    pd.testing.assert_frame_equal(data, ref, check_freq=False)
+
+
+@pytest.mark.parametrize("Reader,write_cell", [
+    (RaggedCellReader, write_ragged_cell),
+    (OrthoMultiCellReader, write_orthomulti_cell),
+])
+@pytest.mark.parametrize("prefetch", [0, 2])
+def test_iter_cells(Reader, write_cell, prefetch):
+    path = tempfile.mkdtemp()
+    cells = [165, 166, 167, 168, 169]
+    for cell in cells:
+        write_cell(path, cell, n_locs=4, n_times=30, seed=cell)
+    reader = Reader(path)
+
+    data = list(reader.iter_cells(cells, ['sm', 'flag'], prefetch=prefetch,
+                                  format='pd_multidx_timegpi',
+                                  end='1997-06-01'))
+    assert [cell for cell, _ in data] == cells
+    for cell, df in data:
+        pd.testing.assert_frame_equal(
+            df, reader.read_agg_cell_data(cell, ['sm', 'flag'],
+                                          format='pd_multidx_timegpi',
+                                          end='1997-06-01'))
+
+
+def test_iter_cells_prefetch_is_bounded():
+    path = tempfile.mkdtemp()
+    cells = list(range(165, 175))
+    for cell in cells:
+        write_orthomulti_cell(path, cell, n_locs=2, n_times=10)
+    reader = OrthoMultiCellReader(path)
+
+    read = []
+    read_agg_cell_data = reader.read_agg_cell_data
+
+    def _read_agg_cell_data(cell, *args, **kwargs):
+        read.append(cell)
+        return read_agg_cell_data(cell, *args, **kwargs)
+
+    reader.read_agg_cell_data = _read_agg_cell_data
+
+    it = reader.iter_cells(cells, 'sm', prefetch=3)
+    for i, (cell, _) in enumerate(it):
+        # the current cell and at most 3 following ones have been read
+        assert cell == cells[i]
+        assert len(read) <= i + 4
+        if i == 4:
+            break
+    it.close()
+    assert len(read) <= 8
+
+
+def test_iter_cells_netcdf_lock():
+    # netCDF I/O of the caller that holds the lock does not overlap with
+    # the reads in the background
+    path = tempfile.mkdtemp()
+    cells = list(range(165, 171))
+    for cell in cells:
+        write_orthomulti_cell(path, cell, n_locs=4, n_times=50)
+    reader = OrthoMultiCellReader(path)
+
+    reading = []
+    read_agg_cell_data = reader.read_agg_cell_data
+
+    def _read_agg_cell_data(cell, *args, **kwargs):
+        reading.append(cell)
+        time.sleep(.01)
+        data = read_agg_cell_data(cell, *args, **kwargs)
+        reading.remove(cell)
+        return data
+
+    reader.read_agg_cell_data = _read_agg_cell_data
+
+    for cell, data in reader.iter_cells(cells, 'sm', prefetch=2):
+        with nc_lock:
+            assert reading == []
+            xr.Dataset({'sm': (['time', 'gpi'], data['sm'].values)}) \
+                .to_netcdf(os.path.join(path, f"out_{cell}.nc"))
+            time.sleep(.01)
+            assert reading == []
+    for cell in cells:
+        with nc.Dataset(os.path.join(path, f"out_{cell}.nc")) as ds:
+            assert ds['sm'].shape == (50, 4)
+
+
+def test_cell_cache(count_opens, orthomulti_cells):
+    path, grid = orthomulti_cells()
+
+    reader = SmecvTs(path, grid=grid, parameters=['sm', 'flag'],
+                     ioclass_kws={'read_bulk': False})
+    ref_ts = reader.read(165003)
+    ref_cell = reader.read_agg_cell_data(165, ['sm', 'flag'])
+
+    cache = mixins.CellCache(max_bytes=2**20)
+    reader._cell_cache = cache
+    count_opens.clear()
+
+    pd.testing.assert_frame_equal(
+        reader.read_agg_cell_data(165, ['sm', 'flag']), ref_cell)
+    assert len(count_opens) == 1
+    assert cache.stats()['misses'] > 0 and cache.stats()['hits'] == 0
+
+    # cell data and points are now served from memory
+    pd.testing.assert_frame_equal(
+        reader.read_agg_cell_data(165, ['sm', 'flag']), ref_cell)
+    pd.testing.assert_frame_equal(reader.read(165003), ref_ts)
+    pd.testing.assert_frame_equal(reader.read(3., 0.), ref_ts)
+    assert len(count_opens) == 1
+    assert cache.stats()['hits'] > 0
+    assert cache.nbytes <= cache.max_bytes
+
+    _, _, variables = reader._read_orthomulti_cell(165, ['sm'])
+    assert not np.ma.getdata(variables['sm']).flags.writeable
+
+    # changed files are read again
+    os.utime(os.path.join(path, '0165.nc'), (1e9, 1e9))
+    reader.read_agg_cell_data(165, ['sm', 'flag'])
+    assert len(count_opens) == 2
+
+    # entries are evicted when the budget is exceeded
+    cache.resize(variables['sm'].nbytes * 1.5)
+    assert cache.stats()['evictions'] > 0
+    assert cache.nbytes <= cache.max_bytes
+    cache.clear()
+    assert len(cache) == 0 and cache.stats()['hits'] == 0
+
+
+def test_cell_cache_partial_params(orthomulti_cells):
+    # Reading some parameters of a cell must not limit later reads of all
+    # variables from the cache
+    path, grid = orthomulti_cells()
+
+    reader = SmecvTs(path, grid=grid, ioclass_kws={'read_bulk': False})
+    ref_ts = reader.read(165003)
+    assert list(ref_ts.columns) == ['sm', 'flag']
+
+    reader._cell_cache = mixins.CellCache(max_bytes=2**20)
+    reader.read_agg_cell_data(165, 'sm')
+    pd.testing.assert_frame_equal(reader.read(165003), ref_ts)
+
+    # the full read puts all variables in the cache
+    _, _, variables = reader._read_orthomulti_cell(165, None)
+    assert list(variables.keys()) == ['sm', 'flag']
+    pd.testing.assert_frame_equal(reader.read(165003), ref_ts)
+
+
+def test_read_agg_cell_cube():
+    # cell of 4x4 points, only 10 of them are in the cell file
+    path = tempfile.mkdtemp()
+    write_orthomulti_cell(path, 165, n_locs=10, n_times=50)
+    lons, lats = np.meshgrid(np.arange(4.) + 0.5, np.arange(4.) + 0.5)
+    gpis = np.arange(16) + 165000
+    grid = CellGrid(lons.flatten(), lats.flatten(), gpis // 1000, gpis=gpis)
+    grid.cellsize, grid.resolution = 4., 1.
+
+    reader = SmecvTs(path, grid=grid, parameters=['sm', 'flag'])
+    dt_index = pd.date_range('1997-06-01', '1997-06-10')
+    cube, coords = reader.read_agg_cell_cube(
+        165, dt_index, ['sm', 'flag'], param_fill_val={'flag': -1},
+        param_dtype={'flag': 'int16', 'sm': 'float32'},
+        param_scalf={'sm': 2.})
+
+    data = reader.read_agg_cell_data(165, ['sm', 'flag'])
+    data = data.loc[dt_index]
+    assert list(cube.keys()) == ['flag', 'sm']
+    assert cube['sm'].shape == cube['flag'].shape == (10, 4, 4)
+    assert cube['flag'].dtype == np.int16 and cube['sm'].dtype == np.float32
+    for i, gpi in enumerate(gpis):
+        row, col = i // 4, i % 4
+        if gpi in data['sm'].columns:
+            np.testing.assert_almost_equal(cube['sm'][:, row, col],
+                                           data['sm'][gpi].values * 2, 5)
+            np.testing.assert_equal(cube['flag'][:, row, col].filled(),
+                                    data['flag'][gpi].values)
+        else:
+            assert np.isnan(cube['sm'][:, row, col]).all()
+            assert cube['flag'][:, row, col].mask.all()
+    assert cube['flag'].fill_value == -1
+    np.testing.assert_equal(coords['gpi'], np.flipud(gpis.reshape(4, 4)))
+
+    ds = reader.read_agg_cell_cube(165, dt_index, ['sm', 'flag'],
+                                   param_fill_val={'flag': -1},
+                                   param_dtype={'flag': 'int16'}, as_xr=True)
+    assert ds['flag'].dims == ('time', 'lat', 'lon')
+    np.testing.assert_equal(ds['flag'].values, cube['flag'].filled())
+    np.testing.assert_equal(ds['time'].values,
+                            dt_index.values.astype('datetime64[s]'))
+
+    with pytest.raises(ValueError):
+        reader.read_agg_cell_cube(165, dt_index, ['flag'],
+                                  param_dtype={'flag': 'int16'})
+
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_read_region_cube(n_workers):
+    # two cells of 4x4 points next to each other
+    path = tempfile.mkdtemp()
+    for cell in [165, 166]:
+        write_orthomulti_cell(path, cell, n_locs=10, n_times=50, seed=cell)
+    rows, cols = np.meshgrid(np.arange(4), np.arange(8), indexing='ij')
+    cells = np.where(cols < 4, 165, 166).flatten()
+    gpis = cells * 1000 + (rows * 4 + cols % 4).flatten()
+    grid = CellGrid(cols.flatten() + 0.5, rows.flatten() + 0.5, cells,
+                    gpis=gpis)
+    grid.cellsize, grid.resolution = 4., 1.
+
+    reader = SmecvTs(path, grid=grid, parameters=['sm', 'flag'])
+    dt_index = pd.date_range('1997-06-01', '1997-06-10')
+    kwargs = dict(param_fill_val={'flag': -1}, param_dtype={'flag': 'int16'},
+                  param_scalf={'sm': 2.})
+
+    # workers are processes, the open cell file is not sent to them
+    reader.read(165001)
+    cube = reader.read_region_cube(dt_index, ['sm', 'flag'],
+                                   cells=[165, 166], n_workers=n_workers,
+                                   **kwargs)
+    assert reader.fid is not None
+    assert dict(cube.sizes) == {'time': 10, 'lat': 4, 'lon': 8}
+    for cell, lons in [(165, slice(0, 4)), (166, slice(4, 8))]:
+        ref = reader.read_agg_cell_cube(cell, dt_index, ['sm', 'flag'],
+                                        as_xr=True, **kwargs)
+        xr.testing.assert_identical(cube.isel(lon=lons), ref)
+
+    bbox = reader.read_region_cube(dt_index, ['sm'], bbox=(2, 1, 5, 3),
+                                   **kwargs)
+    np.testing.assert_equal(bbox['lon'].values, [2.5, 3.5, 4.5])
+    np.testing.assert_equal(bbox['lat'].values, [1.5, 2.5])
+    xr.testing.assert_identical(
+        bbox['sm'], cube['sm'].sel(lon=bbox['lon'], lat=bbox['lat']))
+
+    with pytest.raises(ValueError):
+        reader.read_region_cube(dt_index, ['sm'])
@@ -1,8 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import functools
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import pytest
-from io_utils.data.read.geo_ts_readers.ts_reader import GeoTsReader
+from io_utils.data.read.geo_ts_readers.ts_reader import GeoTsReader, StageTimer
+from io_utils.data.read.geo_ts_readers.ts_cache import ResultCache
 from io_utils.data.read.geo_ts_readers import (
+    SmecvTs,
     GeoCCISMv6Ts,
     GeoGLDAS21Ts,
     GeoISMNTs,
@@ -409,6 +416,284 @@ def test_other_function_than_read():
     assert np.any(data["swi5"] < 0)  # make sure it's an anom
 
 
+@pytest.mark.parametrize("adapters,resample", [
+    (None, None),
+    (None, ('W', 'mean')),
+    (None, ('ddekad', 'median')),
+    ({'01-SelfMaskingAdapter': {'op': '<', 'threshold': 2,
+                                'column_name': 'flag'}}, ('W', 'mean')),
+])
+def test_read_multiple_cell_mode(adapters, resample, count_opens,
+                                 orthomulti_cells):
+    path, grid = orthomulti_cells([165, 166])
+
+    reader = GeoTsReader(SmecvTs, {'ts_path': path, 'grid': grid,
+                                   'parameters': ['sm', 'flag']},
+                         adapters=adapters, resample=resample,
+                         filter_months=[6], remove_nans={'flag': 3},
+                         params_rename={'sm': 'soil_moisture'})
+
+    # the first gpi of a cell is also read
+    locs = [165000, 165003, 165007, 166001, 166009]
+    ref = reader.read_multiple(locs, var=['soil_moisture', 'flag'])
+    count_opens.clear()
+    data = reader.read_multiple(locs, var=['soil_moisture', 'flag'],
+                                mode='cell')
+    assert len(count_opens) == 2
+
+    for v in ['soil_moisture', 'flag']:
+        assert data[v].columns.tolist() == locs
+        pd.testing.assert_frame_equal(data[v], ref[v], check_freq=False)
+
+    with pytest.raises(ValueError):
+        reader.read_multiple(locs, mode='bulk')
+
+
+@pytest.mark.parametrize("adapters", [
+    None,
+    {'01-SelfMaskingAdapter': {'op': '<', 'threshold': 2,
+                               'column_name': 'flag'}},
+])
+def test_read_multiple_cell_mode_scaling(adapters, orthomulti_cells):
+    # dtypes, scale factors and offsets of the base reader are applied
+    path, grid = orthomulti_cells([165, 166])
+
+    reader = GeoTsReader(SmecvTs, {'ts_path': path, 'grid': grid,
+                                   'parameters': ['sm', 'flag'],
+                                   'dtypes': {'sm': 'float64'},
+                                   'scale_factors': {'sm': 0.5},
+                                   'offsets': {'flag': 1.}},
+                         adapters=adapters)
+
+    locs = [165003, 165007, 166001]
+    ref = reader.read_multiple(locs, var=['sm', 'flag'], dtype='float64')
+    data = reader.read_multiple(locs, var=['sm', 'flag'], dtype='float64',
+                                mode='cell')
+    for v in ['sm', 'flag']:
+        pd.testing.assert_frame_equal(data[v], ref[v], check_freq=False)
+    assert ref['sm'].max().max() <= 25.
+
+    # integer dtypes can not be applied to cells with missing time stamps
+    reader = GeoTsReader(SmecvTs, {'ts_path': path, 'grid': grid,
+                                   'parameters': ['sm', 'flag'],
+                                   'dtypes': {'flag': 'int8'}})
+    ref = reader.read_multiple(locs, var='flag')
+    with pytest.warns(UserWarning, match="mode='gpi'"):
+        data = reader.read_multiple(locs, var='flag', mode='cell')
+    pd.testing.assert_frame_equal(data['flag'], ref['flag'])
+
+
+def test_read_multiple_lonlat_locs(orthomulti_cells):
+    path, grid = orthomulti_cells([165, 166])
+    reader = GeoTsReader(SmecvTs, {'ts_path': path, 'grid': grid,
+                                   'parameters': ['sm']})
+
+    locs = [(11.1, 0.1), 165004, (3., 0.), (50., 50.), (12.9, 0.)]
+    assert {c: g.tolist() for c, g in reader._locs_by_cell(locs).items()} \
+        == {166: [166001, 166009, 166003], 165: [165004, 165003]}
+    with pytest.warns(UserWarning, match='No gpi found'):
+        by_cell = reader._locs_by_cell(locs, max_dist=50000)
+    assert {c: g.tolist() for c, g in by_cell.items()} \
+        == {166: [166001, 166003], 165: [165004, 165003]}
+
+    with pytest.warns(UserWarning, match='No gpi found'):
+        data = reader.read_multiple(locs, var='sm', mode='cell',
+                                    max_dist=50000)
+    assert data['sm'].columns.tolist() == [166001, 166003, 165004, 165003]
+
+
+@pytest.mark.parametrize("mode", ['gpi', 'cell'])
+def test_read_multiple_parallel(mode, orthomulti_cells):
+    path, grid = orthomulti_cells([165, 166, 167], n_locs=4)
+    reader = GeoTsReader(SmecvTs, {'ts_path': path, 'grid': grid,
+                                   'parameters': ['sm', 'flag']},
+                         resample=('W', 'mean'))
+
+    locs = [167001, 165000, 165002, 166003, 167002, 165003]
+    ref = reader.read_multiple(locs, var=['sm', 'flag'], mode=mode)
+    data = reader.read_multiple(locs, var=['sm', 'flag'], mode=mode,
+                                n_workers=2)
+    for v in ['sm', 'flag']:
+        assert data[v].columns.tolist() == \
+            [167001, 167002, 165000, 165002, 165003, 166003]
+        pd.testing.assert_frame_equal(data[v], ref[v])
+
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_read_multiple_cell_mode_errors(n_workers, orthomulti_cells):
+    # a cell that can not be read is not skipped silently
+    path, grid = orthomulti_cells([165, 166], n_locs=4)
+    os.remove(os.path.join(path, '0166.nc'))
+    reader = GeoTsReader(SmecvTs, {'ts_path': path, 'grid': grid,
+                                   'parameters': ['sm', 'flag']})
+
+    with pytest.raises(OSError):
+        reader.read_multiple([165001, 166001], mode='cell',
+                             n_workers=n_workers)
+
+
+def test_geotsreader_timing(orthomulti_cells):
+    path, grid = orthomulti_cells(n_locs=4)
+    reader = GeoTsReader(
+        SmecvTs, {'ts_path': path, 'grid': grid, 'parameters': ['sm', 'flag']},
+        adapters={'01-SelfMaskingAdapter': {'op': '<', 'threshold': 2,
+                                            'column_name': 'flag'}},
+        resample=('W', 'mean'), remove_nans={'flag': 3})
+    ref = reader.read(165001)
+    assert reader.timings.empty
+
+    reader.enable_timing()
+    pd.testing.assert_frame_equal(reader.read(165001), ref)
+    reader.read(165002)
+    timings = reader.timings
+    assert timings.index.tolist() == [
+        'adapter:BasicAdapter', 'adapter:01-SelfMaskingAdapter', 'read',
+        'remove_nans', 'resample']
+    assert timings['calls'].tolist() == [2] * 5
+    assert np.all(timings['time'] > 0)
+
+    reader.enable_timing(False)
+    reader.read(165001)
+    assert reader.timings['calls'].tolist() == [2] * 5
+    assert '_adapt' not in reader.reader.__dict__
+    reader.reset_timings()
+    assert reader.timings.empty
+
+
+def test_stage_timer_threads():
+    timer = StageTimer()
+
+    def outer():
+        with timer.stage('outer'):
+            time.sleep(.1)
+            with timer.stage('inner'):
+                time.sleep(.2)
+
+    def other():
+        with timer.stage('other'):
+            time.sleep(.2)
+
+    # stages in other threads are not subtracted
+    with ThreadPoolExecutor(2) as executor:
+        for future in [executor.submit(outer), executor.submit(other)]:
+            future.result()
+    times = timer.to_dict()
+    assert .1 <= times['outer']['time'] < .18
+    assert times['inner']['time'] >= .2
+    assert times['other']['time'] >= .2
+
+
+def test_geotsreader_result_cache(orthomulti_cells, tmp_path):
+    path, grid = orthomulti_cells(n_locs=4)
+    cache_path = str(tmp_path / 'cache')
+    kwargs = dict(adapters={'01-SelfMaskingAdapter': {
+        'op': '<', 'threshold': 2, 'column_name': 'flag'}},
+        params_rename={'sm': 'soil_moisture'}, remove_nans={'flag': 3})
+
+    def make_reader(**kws):
+        return GeoTsReader(SmecvTs, {'ts_path': path, 'grid': grid,
+                                     'parameters': ['sm', 'flag']},
+                           **kwargs, **kws)
+
+    ref = make_reader().read(165001)
+    pd.testing.assert_frame_equal(
+        make_reader(cache_path=cache_path).read(165001), ref)
+
+    # the cached data is used in a new reader with the same settings
+    reader = make_reader(cache_path=cache_path)
+    base_reads = []
+    base_read = reader.base_reader.read
+    reader.base_reader.read = \
+        lambda *args: base_reads.append(args) or base_read(*args)
+    pd.testing.assert_frame_equal(reader.read(165001), ref)
+    pd.testing.assert_frame_equal(reader.read(1., 0.), ref)
+    assert base_reads == []
+    reader.read(165002)
+    assert base_reads == [(165002,)]
+    pd.testing.assert_frame_equal(reader.read(165002),
+                                  make_reader().read(165002))
+    assert base_reads == [(165002,)]
+
+    # changed source files are read again
+    file_path = os.path.join(path, '0165.nc')
+    os.utime(file_path, ns=(0, os.stat(file_path).st_mtime_ns + 10 ** 9))
+    pd.testing.assert_frame_equal(reader.read(165001), ref)
+    assert base_reads == [(165002,), (165001,)]
+
+    # other settings use other data
+    reader = make_reader(cache_path=cache_path, resample=('W', 'mean'))
+    pd.testing.assert_frame_equal(
+        reader.read(165001), make_reader(resample=('W', 'mean')).read(165001),
+        check_freq=False)
+    assert len(os.listdir(cache_path)) == 2
+
+
+def _same_file(file_path, cell):
+    return file_path
+
+
+def _put_gpis(cache, gpis):
+    for gpi in gpis:
+        df = pd.DataFrame({'sm': np.arange(100.) + gpi},
+                          index=pd.date_range('2000-01-01', periods=100))
+        assert cache.put(165, gpi, df)
+
+
+def test_result_cache_processes(tmp_path):
+    # processes that write to the same cell file at once do not corrupt it
+    path = str(tmp_path)
+    source = os.path.join(path, 'source.nc')
+    open(source, 'w').close()
+    cache = ResultCache(path, 'key', functools.partial(_same_file, source))
+
+    gpis = np.arange(80).reshape(4, 20)
+    with ProcessPoolExecutor(4) as executor:
+        list(executor.map(_put_gpis, [cache] * 4, gpis))
+
+    for gpi in gpis.flatten():
+        np.testing.assert_equal(cache.get(165, gpi)['sm'].values,
+                                np.arange(100.) + gpi)
+    assert not any([f.endswith('.tmp') for f in os.listdir(cache.path)])
+
+    # outdated data is replaced
+    os.utime(source, ns=(0, os.stat(source).st_mtime_ns + 10 ** 9))
+    assert cache.get(165, 0) is None
+    _put_gpis(cache, [1])
+    assert cache.get(165, 0) is None
+    assert cache.get(165, 1) is not None
+    cache.clear()
+    assert cache.get(165, 1) is None
+
+
+def _read_with(reader, gpi):
+    return reader.read(gpi)
+
+
+def test_geotsreader_lazy_and_picklable(orthomulti_cells):
+    path, grid = orthomulti_cells(n_locs=4)
+    reader = GeoTsReader(
+        SmecvTs, {'ts_path': path, 'grid': grid, 'parameters': ['sm', 'flag']},
+        adapters={'01-SelfMaskingAdapter': {'op': '<', 'threshold': 2,
+                                            'column_name': 'flag'}},
+        resample=('W', 'mean'), timing=True, lazy=True)
+    assert reader._base_reader is None
+    ref = reader.read(165001)
+    assert isinstance(reader._base_reader, SmecvTs)
+    assert reader.timings.loc['adapter:01-SelfMaskingAdapter', 'calls'] == 1
+
+    # only the settings are pickled
+    unpickled = pickle.loads(pickle.dumps(reader))
+    assert unpickled._base_reader is None
+    assert unpickled.grid is not None
+    pd.testing.assert_frame_equal(unpickled.read(165001), ref)
+    assert unpickled.timings['calls'].tolist() == [1, 1, 1, 1]
+
+    with ProcessPoolExecutor(2) as executor:
+        data = list(executor.map(_read_with, [reader] * 2, [165001, 165002]))
+    pd.testing.assert_frame_equal(data[0], ref)
+    pd.testing.assert_frame_equal(data[1], reader.read(165002))
+
+
 if __name__ == "__main__":
     test_smap_sat_data()
     test_other_function_than_read()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+import pytest
+from cadati.dekad import dekad_startdate_from_date
+from pygeogrids.grids import genreg_grid
+from io_utils.utils import (
+    split_cells_gpi_equal,
+    split_by_weight,
+    gpis_per_cell,
+    ddek,
+)
+
+
+def split_cells_reference(all_cells, n, grid):
+    # the previous, loop based implementation
+    parts = {i: [0, []] for i in range(n)}
+    min_part = 0
+    for cell in all_cells:
+        g = grid.grid_points_for_cell(cell)[0].size
+        parts[min_part][1] += [cell]
+        parts[min_part][0] += g
+
+        counter = {k: v[0] for k, v in parts.items()}
+        min_part = min(counter, key=counter.get)
+
+    return tuple([np.array(parts[j][1]) for j in range(n)])
+
+
+@pytest.fixture
+def land_grid():
+    grid = genreg_grid(1, 1).to_cell_grid(5.)
+    # subgrid with a different number of points in each cell
+    rng = np.random.default_rng(0)
+    return grid.subgrid_from_gpis(
+        grid.activegpis[rng.uniform(0, 1, grid.activegpis.size) <
+                        np.abs(grid.activearrlat) / 90.])
+
+
+@pytest.mark.parametrize("n", [1, 3, 8])
+def test_split_cells_gpi_equal(land_grid, n):
+    cells = land_grid.get_cells()[::-1][:200]
+    parts = split_cells_gpi_equal(cells, n, land_grid)
+    ref = split_cells_reference(cells, n, land_grid)
+    assert len(parts) == n
+    for part, ref_part in zip(parts, ref):
+        np.testing.assert_equal(part, ref_part)
+
+
+@pytest.mark.parametrize("n", [1, 3, 8])
+def test_split_cells_gpi_equal_contiguous(land_grid, n):
+    cells = land_grid.get_cells()
+    parts = split_cells_gpi_equal(cells, n, land_grid, contiguous=True)
+    np.testing.assert_equal(np.concatenate(parts), cells)
+
+    n_gpis = np.array([land_grid.grid_points_for_cell(p)[0].size
+                       for p in parts])
+    largest_cell = max([land_grid.grid_points_for_cell(c)[0].size
+                        for c in cells])
+    assert np.all(np.abs(n_gpis - n_gpis.mean()) <= largest_cell)
+
+
+def test_ddek():
+    index = pd.date_range('1999-12-25', '2000-03-05 18:00', freq='6h')
+    labels = ddek(index)
+    ref = [dekad_startdate_from_date(dt) for dt in index.to_pydatetime()]
+    np.testing.assert_equal(labels, np.array(ref, dtype='datetime64[ns]'))
+    assert len(np.unique(labels)) == 8
+
+
+def test_split_by_weight():
+    part = split_by_weight([4, 2, 2, 1], 2)
+    np.testing.assert_equal(part, [0, 1, 1, 0])
+    # more parts than items
+    np.testing.assert_equal(split_by_weight([4, 2], 3), [0, 1])
+
+
+def test_gpis_per_cell(land_grid):
+    cells = np.unique(land_grid.activearrcell)[::7]
+    ref = [land_grid.grid_points_for_cell(cell)[0].size for cell in cells]
+    np.testing.assert_equal(gpis_per_cell(land_grid, cells), ref)
+    empty = land_grid.activearrcell.max() + 1
+    np.testing.assert_equal(gpis_per_cell(land_grid, [empty]), [0])